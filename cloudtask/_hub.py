@@ -9,6 +9,11 @@
 # option) any later version.
 # 
 
+import time
+import random
+import threading
+import traceback
+
 from hub import Spawner
 
 class Error(Exception):
@@ -32,3 +37,237 @@ class Hub(Spawner):
 
         name = snapshot_id or ami_id or 'core'
         return Spawner.launch(self, name, howmany, logfh, callback, **kwargs)
+
+class Launcher:
+    """Launch broker: hands out launched workers on a queue.
+
+    Requests to launch workers (e.g., from the executor and its
+    autoscaler) that arrive within COALESCE seconds of each other are
+    coalesced and spread over up to <concurrency> launch calls running at
+    the same time, of at least <batch> workers each. That way the launch
+    API calls and the boot status polling of many instances run
+    concurrently instead of one launch call making them all in turn.
+
+    Each launched worker is put on the queue as (ipaddress, instanceid) as
+    soon as it boots, and None for each worker that failed to launch.
+
+    spawner is anything with Hub's launch() (e.g., FakeHub). If callback
+    returns False, we stop launching.
+    """
+
+    # how long we wait for more requests before launching
+    COALESCE = 1
+
+    BATCH = 10
+    CONCURRENCY = 8
+
+    def __init__(self, spawner, queue, logfh=None, callback=None,
+                 batch=BATCH, concurrency=CONCURRENCY, **kwargs):
+        self.spawner = spawner
+        self.queue = queue
+        self.logfh = logfh
+        self.callback = callback
+        self.batch = batch
+        self.concurrency = concurrency
+        self.kwargs = kwargs
+
+        self.cond = threading.Condition()
+        self.thread = None
+
+        # requested workers we haven't started launching
+        self.pending = 0
+
+        # launch calls in progress
+        self.running = 0
+
+        # the fleet is the workers requested since we were last idle
+        self.requested = 0
+        self.launched = 0
+        self.failed = 0
+
+        self.started = None
+        self.time_first = None
+        self.time_full = None
+
+    def launch(self, howmany):
+        """Request <howmany> more workers"""
+
+        with self.cond:
+            if self.requested == self.launched + self.failed:
+                self.requested = self.launched = self.failed = 0
+                self.started = time.time()
+                self.time_first = self.time_full = None
+
+            self.requested += howmany
+            self.pending += howmany
+            self.cond.notify_all()
+
+            if not self.thread:
+                self.thread = threading.Thread(target=self._dispatch)
+                self.thread.start()
+
+    def _stopped(self):
+        return self.callback is not None and self.callback() is False
+
+    def _dispatch(self):
+        time.sleep(self.COALESCE)
+
+        with self.cond:
+            while self.pending:
+                while self.running >= self.concurrency:
+                    self.cond.wait()
+
+                if self._stopped():
+                    for i in range(self.pending):
+                        self._launched(None)
+                    self.pending = 0
+                    break
+
+                # spread what's pending over the free launch calls
+                slots = self.concurrency - self.running
+                howmany = min(self.pending,
+                              max(self.batch, (self.pending + slots - 1) / slots))
+
+                self.pending -= howmany
+                self.running += 1
+
+                threading.Thread(target=self._launch, args=(howmany,)).start()
+
+            self.thread = None
+
+    def _launch(self, howmany):
+        launched = 0
+        try:
+            for instance in self.spawner.launch(howmany, self.logfh, self.callback, **self.kwargs):
+                launched += 1
+                self._launched(instance)
+
+        except Exception, e:
+            if not isinstance(e, self.spawner.Stopped) and self.logfh:
+                traceback.print_exc(file=self.logfh)
+
+        finally:
+            for i in range(howmany - launched):
+                self._launched(None)
+
+            with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
+
+    def _launched(self, instance):
+        with self.cond:
+            elapsed = time.time() - self.started
+
+            first = False
+            if instance:
+                self.launched += 1
+                if self.time_first is None:
+                    self.time_first = elapsed
+                    first = True
+            else:
+                self.failed += 1
+
+            full = (self.launched + self.failed == self.requested)
+            if full:
+                self.time_full = elapsed
+
+            launched, requested = self.launched, self.requested
+
+        self.queue.put(instance)
+
+        if not self.logfh:
+            return
+
+        if first:
+            self.logfh.write("launched first worker in %d seconds\n" % self.time_first)
+
+        if full:
+            self.logfh.write("launched %d/%d workers in %d seconds (first in %s seconds)\n" %
+                             (launched, requested, elapsed,
+                              "%d" % self.time_first if self.time_first is not None else "-"))
+
+class FakeHub:
+    """Offline stand-in for Hub, for testing launches without the Hub API.
+
+    Like Spawner, launch() makes a launch API call per worker, taking
+    <api_latency> seconds each, then polls the status of the instances it
+    launched every <poll_interval> seconds, yielding each instance once it
+    has booted (after a random boot time within <boot_time>).
+    """
+
+    class Error(Exception):
+        pass
+
+    class Stopped(Error):
+        pass
+
+    def __init__(self, api_latency=1, poll_interval=10, boot_time=(60, 120), seed=None):
+        self.api_latency = api_latency
+        self.poll_interval = poll_interval
+        self.boot_time = boot_time
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.instances = 0
+        self.api_calls = 0
+
+        # instanceid -> ipaddress of instances that weren't destroyed
+        self.running = {}
+
+    def _api_call(self):
+        time.sleep(self.api_latency)
+        with self.lock:
+            self.api_calls += 1
+
+    def _new_instance(self):
+        with self.lock:
+            self.instances += 1
+            id = self.instances
+            boot_time = self.random.uniform(*self.boot_time)
+
+            ipaddress, instanceid = "10.0.%d.%d" % (id / 256, id % 256), "i-%08x" % id
+            self.running[instanceid] = ipaddress
+
+        return (ipaddress, instanceid), time.time() + boot_time
+
+    def launch(self, howmany, logfh=None, callback=None, **kwargs):
+        pending = []
+        for i in range(howmany):
+            if callback and callback() is False:
+                raise self.Stopped
+
+            self._api_call()
+            pending.append(self._new_instance())
+
+        while pending:
+            if callback and callback() is False:
+                raise self.Stopped
+
+            time.sleep(self.poll_interval)
+            self._api_call()
+
+            now = time.time()
+            for instance, booted in pending[:]:
+                if booted <= now:
+                    pending.remove((instance, booted))
+                    yield instance
+
+    def destroy(self, *addresses):
+        """addresses are ipaddresses or instanceids. Instances we didn't
+        launch are assumed to exist."""
+
+        for address in addresses:
+            self._api_call()
+
+            with self.lock:
+                for instanceid, ipaddress in self.running.items():
+                    if address in (instanceid, ipaddress):
+                        del self.running[instanceid]
+                        break
+                else:
+                    if address.startswith("i-"):
+                        ipaddress, instanceid = None, address
+                    else:
+                        ipaddress, instanceid = address, None
+
+            yield ipaddress, instanceid
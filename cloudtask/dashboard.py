@@ -0,0 +1,321 @@
+#
+# Copyright (c) 2010-2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+import os
+from os.path import *
+
+import re
+import time
+from collections import deque
+from StringIO import StringIO
+
+from session import Session
+from logwatch import Watcher, Tail
+from logalyzer import WorkersLog, fmt_elapsed, fmt_table
+
+class Worker:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.ipaddress = None
+        self.instanceid = None
+
+        self.job = None
+        self.started = None
+
+        # timestamp of the last status line
+        self.last = None
+        self.idle_since = None
+
+        self.jobs = 0
+        self.failures = 0
+        self.destroyed = False
+
+    def state(self, now):
+        if self.destroyed:
+            return "destroyed"
+
+        if self.job:
+            return "%s %s" % (fmt_elapsed(int(now - self.started)), self.job)
+
+        if self.idle_since:
+            return "idle %s" % fmt_elapsed(int(now - self.idle_since))
+
+        return "setup"
+
+    def sortkey(self, now):
+        """busy workers first (longest running job first), then idle workers
+        (longest idle first), then workers in setup, then destroyed workers"""
+
+        if self.destroyed:
+            return (3, self.worker_id)
+
+        if self.job:
+            return (0, self.started)
+
+        if self.idle_since:
+            return (1, self.idle_since)
+
+        return (2, self.worker_id)
+
+class Dashboard:
+    """Live view of a session, updated incrementally from its logs.
+
+    The session's worker logs, manager log and jobs journal are tailed as
+    they grow, so every byte is only read once. Worker logs are scanned for
+    status lines, which are the only lines we keep.
+    """
+
+    STATUS = re.compile(r'# (\d{4}-\d+-\d+ \d\d:\d\d:\d\d) \[(.*?)\] (.*)')
+
+    # throughput is averaged over jobs that finished in this many seconds
+    WINDOW = 600
+
+    # how many lines of the manager log we show
+    LOG_LINES = 5
+
+    def __init__(self, session_path, poll=False):
+        self.paths = Session.Paths(session_path)
+
+        conf = eval(file(self.paths.conf).read())
+        self.command = conf['command']
+        self.id = int(basename(abspath(session_path)))
+
+        self.pat_finished = re.compile(r'^(exit \d+|timeout) # %s (.*)' % re.escape(self.command))
+        self.pat_aborted = re.compile(r'^(terminated|worker died.*|worker unreachable|worker stuck) # ')
+
+        self.workers = {}
+        self.finished = []
+
+        # timestamp of the first status line, where throughput starts
+        self.first = None
+        self.log = deque(maxlen=self.LOG_LINES)
+
+        # last state of each job in the journal and how many jobs are in each state
+        self.states = {}
+        self.counts = {}
+
+        self.tails = {}
+        self.tails[self.paths.log] = Tail(self.paths.log)
+        self.tails[self.paths.jobs] = Tail(self.paths.jobs, restarted=self._reset_jobs)
+
+        if not isdir(self.paths.workers):
+            os.makedirs(self.paths.workers)
+
+        self.watcher = Watcher([ self.paths.path, self.paths.workers ], poll)
+
+    @staticmethod
+    def _parse_timestamp(timestamp):
+        return time.mktime(WorkersLog.LogEntry.parse_timestamp(timestamp).timetuple())
+
+    def _worker_status(self, worker, timestamp, ipaddress, title):
+        if self.first is None or timestamp < self.first:
+            self.first = timestamp
+
+        worker.ipaddress = ipaddress
+        worker.last = timestamp
+
+        if title.startswith(self.command + " "):
+            worker.job = title[len(self.command) + 1:]
+            worker.started = timestamp
+            return
+
+        m = self.pat_finished.match(title)
+        if m:
+            result = m.group(1)
+
+            worker.jobs += 1
+            if result != 'exit 0':
+                worker.failures += 1
+
+            worker.job = None
+            worker.idle_since = timestamp
+            self.finished.append(timestamp)
+            return
+
+        if self.pat_aborted.match(title):
+            worker.job = None
+            worker.idle_since = timestamp
+            return
+
+        m = re.match(r'(?:launched|claimed) worker (.*)', title)
+        if m:
+            worker.instanceid = m.group(1)
+            worker.destroyed = False
+            return
+
+        if title.startswith('destroyed worker') or title.startswith('parked worker'):
+            worker.destroyed = True
+            worker.job = None
+
+    def _read_segments(self, tail, worker):
+        """read the rotated segments of a worker log, which come before the
+        log that is tailed"""
+
+        reader = Session.Logs.WorkerReader(tail.path)
+        end = reader.active.start if reader.active else None
+
+        def read():
+            partial = ""
+            while end is None or reader.tell() < end:
+                size = Tail.BLOCKSIZE if end is None else min(Tail.BLOCKSIZE, end - reader.tell())
+                block = reader.read(size)
+                if not block:
+                    break
+
+                block = partial + block
+                i = block.rfind("\n") + 1
+                partial = block[i:]
+                if i:
+                    yield block[:i]
+
+            # the rest of the line is in the tailed log
+            tail.partial = partial
+
+        self._scan_worker_log(read(), worker)
+        reader.close()
+
+    def _read_worker_log(self, tail, worker):
+        self._scan_worker_log(tail.read(), worker)
+
+    def _scan_worker_log(self, bufs, worker):
+        for buf in bufs:
+            pos = 0 if buf.startswith('# ') else buf.find('\n# ')
+            while pos != -1:
+                if buf[pos] == '\n':
+                    pos += 1
+
+                m = self.STATUS.match(buf, pos)
+                if m:
+                    timestamp, ipaddress, title = m.groups()
+                    self._worker_status(worker, self._parse_timestamp(timestamp),
+                                        ipaddress, title.rstrip())
+
+                pos = buf.find('\n# ', pos)
+
+    def _reset_jobs(self):
+        # e.g., the journal was compacted
+        self.states.clear()
+        self.counts.clear()
+
+    def _read_jobs(self, tail):
+        states = self.states
+        counts = self.counts
+        for buf in tail.read():
+            for line in buf.splitlines():
+                if '\t' not in line:
+                    continue
+
+                state, command = line.split('\t', 1)
+                if command in states:
+                    counts[states[command]] -= 1
+                states[command] = state
+                counts[state] = counts.get(state, 0) + 1
+
+    def _read_log(self, tail):
+        for buf in tail.read():
+            self.log.extend(buf.splitlines())
+
+    def update(self, timeout=0):
+        """Wait up to timeout seconds for the logs to change and read what
+        was appended to them"""
+
+        for path in self.watcher.wait(timeout):
+            if path not in self.tails:
+                dir, fname = split(path)
+                if dir != self.paths.workers or not fname.isdigit():
+                    continue
+
+                self.tails[path] = Tail(path, rotating=True)
+                self.workers[path] = Worker(int(fname))
+                self._read_segments(self.tails[path], self.workers[path])
+
+            tail = self.tails[path]
+            if path == self.paths.jobs:
+                self._read_jobs(tail)
+            elif path == self.paths.log:
+                self._read_log(tail)
+            else:
+                self._read_worker_log(tail, self.workers[path])
+
+    def throughput(self, now):
+        """returns (jobs finished per second, seconds it is averaged over).
+        That's the last WINDOW seconds, or less early in the session."""
+
+        # worker logs are read one after the other, so this isn't sorted
+        self.finished = [ timestamp for timestamp in self.finished
+                          if timestamp >= now - self.WINDOW ]
+
+        span = self.WINDOW
+        if self.first is not None:
+            span = min(span, now - self.first)
+
+        # status line timestamps only have a resolution of seconds
+        span = max(span, 1)
+
+        return len(self.finished) / float(span), span
+
+    def fmt(self, now=None, height=None):
+        if now is None:
+            now = time.time()
+
+        total = len(self.states)
+        pending = self.counts.get(Session.Jobs.PENDING, 0)
+        failed = total - pending - self.counts.get('EXIT=0', 0)
+
+        throughput, span = self.throughput(now)
+        if not pending:
+            eta = "done"
+        elif throughput:
+            eta = fmt_elapsed(int(pending / throughput))
+        else:
+            eta = "unknown"
+
+        workers = sorted(self.workers.values(), key=lambda worker: worker.sortkey(now))
+        busy = len([ worker for worker in workers if worker.job and not worker.destroyed ])
+        destroyed = len([ worker for worker in workers if worker.destroyed ])
+        idle = len(workers) - busy - destroyed
+
+        sio = StringIO()
+        print >> sio, "session %d: %d/%d jobs finished (%d failed), %d pending" % \
+                      (self.id, total - pending, total, failed, pending)
+        print >> sio, "throughput: %.1f jobs/minute over the last %s, ETA %s" % \
+                      (throughput * 60, fmt_elapsed(int(span)), eta)
+        print >> sio, "workers: %d busy, %d idle, %d destroyed" % (busy, idle, destroyed)
+        print >> sio
+
+        for line in self.log:
+            print >> sio, line
+        print >> sio
+
+        hidden = 0
+        if height:
+            # leave room for the table's title and the hidden workers line
+            room = max(height - len(sio.getvalue().splitlines()) - 3, 1)
+            if len(workers) > room:
+                hidden = len(workers) - room
+                workers = workers[:room]
+
+        if workers:
+            rows = [ (worker.worker_id, worker.ipaddress, worker.instanceid,
+                      worker.jobs, worker.failures, worker.state(now))
+                     for worker in workers ]
+
+            sio.write(fmt_table(rows, ["WORKER", "IP", "INSTANCE", "JOBS", "FAILED", "STATE"]))
+
+        if hidden:
+            print >> sio, "... %d more workers" % hidden
+
+        return sio.getvalue()
+
+    def close(self):
+        self.watcher.close()
+        for tail in self.tails.values():
+            tail.close()
@@ -15,14 +15,19 @@ import traceback
 import copy
 import signal
 import re
+import math
 
-from multiprocessing import Event, Queue
+from multiprocessing import Event, Queue, Value
 from multiprocessing_utils import Parallelize, Deferred
+from Queue import Queue as ThreadQueue, Empty
+from collections import deque
 
 import sighandle
 
 from ssh import SSH
-from _hub import Hub
+from overlay import Overlay, Fanout
+from reactor import Reactor
+from _hub import Hub, Launcher
 
 import threading
 
@@ -40,6 +45,23 @@ class Timeout:
     def reset(self):
         self.started = time.time()
 
+class Stages:
+    """Measures how long each stage of provisioning a worker takes"""
+
+    def __init__(self):
+        self.started = self.last = time.time()
+        self.elapsed = []
+
+    def finished(self, stage):
+        now = time.time()
+        self.elapsed.append((stage, now - self.last))
+        self.last = now
+
+    def __str__(self):
+        return "provisioned in %.1f seconds (%s)" % (self.last - self.started,
+                                                     ", ".join([ "%s %.1fs" % (stage, elapsed)
+                                                                 for stage, elapsed in self.elapsed ]))
+
 class Job:
     class Retry(Parallelize.Worker.Retry):
         pass
@@ -49,14 +71,102 @@ class Job:
         self.retry = 0
         self.retry_limit = retry_limit
 
+class JobBatch:
+    """Jobs that a worker executes together in a single SSH round-trip"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def __len__(self):
+        return len(self.jobs)
+
+class BatchDemux:
+    """Demultiplex the output of a batch script into per-job output and events.
+
+    The remote script brackets the output of each job with marker lines:
+
+        <token> <index> start
+        <token> <index> exit <exitcode>
+
+    Output is passed on to <output> as it arrives (holding back only what might
+    be the beginning of a marker). Markers invoke event(index, name, exitcode).
+    """
+
+    def __init__(self, commands, output, event):
+        self.token = "__cloudtask_%s__" % os.urandom(8).encode('hex')
+        self.output = output
+        self.event = event
+
+        self.script = "\n".join([ "echo %s %d start; (%s\n); printf '\\n%s %d exit %%d\\n' $?" %
+                                  (self.token, i, command, self.token, i)
+                                  for i, command in enumerate(commands) ])
+
+        self.pat = re.compile(r'(?:\r?\n)?%s (\d+) (start|exit)(?: (\d+))?\r?\n' % self.token)
+        self.prefixes = [ self.token, "\n" + self.token, "\r\n" + self.token ]
+
+        self.pending = ""
+
+    def _marker_start(self, data):
+        """returns index where a possible (incomplete) marker begins in data"""
+        i = data.find(self.token)
+        if i != -1:
+            for c in ('\n', '\r'):
+                if i and data[i - 1] == c:
+                    i -= 1
+            return i
+
+        for size in range(min(len(data), len(self.token) + 2), 0, -1):
+            tail = data[-size:]
+            for prefix in self.prefixes:
+                if prefix.startswith(tail):
+                    return len(data) - size
+
+        return len(data)
+
+    def _output(self, buf):
+        if buf:
+            self.output(buf)
+
+    def feed(self, buf):
+        data = self.pending + buf
+        self.pending = ""
+
+        while data:
+            m = self.pat.search(data)
+            if not m:
+                i = self._marker_start(data)
+                self._output(data[:i])
+                self.pending = data[i:]
+                break
+
+            self._output(data[:m.start()])
+
+            index, name, exitcode = m.groups()
+            self.event(int(index), name, int(exitcode) if exitcode is not None else None)
+
+            data = data[m.end():]
+
+    def flush(self):
+        self._output(self.pending)
+        self.pending = ""
+
 class CloudWorker:
     SSH_PING_RETRIES = 3
 
+    # how long to wait for sshd on a freshly launched worker
+    SSH_READY_TIMEOUT = 300
+
     Terminated = Parallelize.Worker.Terminated
 
     class Error(Terminated):
         pass
 
+    # sent by the watchdog to a worker it finds stuck running a job
+    STUCK_SIGNAL = signal.SIGUSR1
+
+    class Stuck(Error):
+        pass
+
     @classmethod
     def _stop_handler(cls, event_stop):
         def func():
@@ -68,14 +178,27 @@ class CloudWorker:
 
         return func
 
-    def __init__(self, session_logs, taskconf, sshkey, ipaddress=None, destroy=None, event_stop=None, launchq=None):
+    def __init__(self, session_logs, taskconf, sshkey, ipaddress=None, destroy=None, event_stop=None, launchq=None, done=None, session_jobs=None, overlay=None, fanout=None, signals=True, pool=None, claimed=None):
+        """If signals is False, don't touch signal handlers (e.g., in a thread).
+
+        claimed is (ipaddress, instanceid) of a worker claimed from the pool,
+        which already has the overlay. We still run pre, because the
+        session that parked the worker ran post. Workers we launched or
+        claimed are parked in the pool (if any) instead of being destroyed."""
 
         self.pid = os.getpid()
+        self.done = done
+        self.session_jobs = session_jobs
+
+        self.overlay = overlay if overlay else taskconf.overlay
+        self.fanout = fanout
 
-        if event_stop:
+        if event_stop and signals:
             signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(self.STUCK_SIGNAL, signal.SIG_IGN)
 
         self.event_stop = event_stop
+        self.signals = signals
 
         self.logs = session_logs
         self.sshkey = sshkey
@@ -90,9 +213,16 @@ class CloudWorker:
         self.ipaddress = ipaddress
         self.instanceid = None
 
+        # when the running job started and where its output starts in the log
+        self.started = None
+        self.output_start = None
+
         self.hub = None
         self.ssh = None
 
+        self.pool = pool
+        self.provisioned = False
+
         if destroy is None:
             if ipaddress:
                 destroy = False
@@ -100,12 +230,25 @@ class CloudWorker:
                 destroy = True
         self.destroy = destroy
 
-        if not ipaddress:
+        stages = Stages()
+
+        if claimed:
+            self.hub = Hub(taskconf.hub_apikey)
+            self.ipaddress, self.instanceid = claimed
+
+            self.event(self.status("claimed worker %s" % self.instanceid),
+                       'claim', self.instanceid, self.ipaddress)
+            stages.finished("claim")
+
+        elif not ipaddress:
             if not taskconf.hub_apikey:
                 raise self.Error("can't auto launch a worker without a Hub API KEY")
             self.hub = Hub(taskconf.hub_apikey)
 
-            if launchq:
+            if launchq and not signals:
+                instance = launchq.get()
+
+            elif launchq:
                 with sighandle.sigignore(signal.SIGINT, signal.SIGTERM):
                     instance = launchq.get()
             else:
@@ -127,7 +270,9 @@ class CloudWorker:
 
             self.ipaddress, self.instanceid = instance
 
-            self.status("launched worker %s" % self.instanceid)
+            self.event(self.status("launched worker %s" % self.instanceid),
+                       'launch', self.instanceid, self.ipaddress)
+            stages.finished("launch")
 
         else:
             self.status("using existing worker")
@@ -138,21 +283,29 @@ class CloudWorker:
             self.ssh = SSH(self.ipaddress, 
                            identity_file=self.sshkey.path, 
                            login_name=taskconf.user,
-                           callback=self.handle_stop)
+                           callback=self.handle_stop,
+                           ready_timeout=self.SSH_READY_TIMEOUT if self.instanceid else None)
         except SSH.Error, e:
             self.status("unreachable via ssh: " + str(e))
             traceback.print_exc(file=self.logs.worker)
 
             raise self.Error(e)
 
+        stages.finished("ssh")
+
         try:
             self.ssh.copy_id(self.sshkey)
+            stages.finished("copy-id")
 
-            if taskconf.overlay:
-                self.ssh.apply_overlay(taskconf.overlay)
+            # claimed workers have the overlay of the session that parked
+            # them, but its post command may have undone what pre set up
+            if self.overlay and not claimed:
+                self._apply_overlay(self.overlay)
+                stages.finished("overlay")
 
             if taskconf.pre:
                 self.ssh.command(taskconf.pre).close()
+                stages.finished("pre")
 
         except Exception, e:
             self.status("setup failed")
@@ -160,7 +313,49 @@ class CloudWorker:
 
             raise self.Error(e)
 
+        self.event(self.status(str(stages)), 'setup', self.ipaddress,
+                   "%.1f" % (stages.last - stages.started),
+                   " ".join([ "%s=%.1f" % (stage, elapsed) for stage, elapsed in stages.elapsed ]))
+        self.provisioned = True
+
+    def _apply_overlay(self, overlay):
+        if not isinstance(overlay, Overlay) or not self.fanout:
+            return self.ssh.apply_overlay(overlay)
+
+        if not self.ssh.has_overlay(overlay):
+            seed = self.fanout.acquire(self.handle_stop)
+
+            if seed is not None:
+                try:
+                    seed_ssh = SSH(seed,
+                                   identity_file=self.sshkey.path,
+                                   login_name=self.user,
+                                   callback=self.handle_stop,
+                                   multiplex=False)
+                    seed_ssh.seed_overlay(overlay, self.ssh)
+                    self.fanout.add_seed(seed)
+
+                except SSH.Error, e:
+                    self.status("can't seed overlay from %s: %s" % (seed, e))
+
+                    # wait for our turn to upload, or a burst of seed failures
+                    # would upload all at once
+                    seed = self.fanout.acquire(self.handle_stop, seed=False)
+
+            if seed is None:
+                try:
+                    self.ssh.apply_overlay(overlay)
+                finally:
+                    self.fanout.release()
+
+        # we can seed other workers now
+        self.fanout.add_seed(self.ipaddress)
+
     def _cleanup(self):
+        if self.session_jobs:
+            self.session_jobs.flush()
+
+        reachable = False
         if self.ssh:
             try:
                 self.ssh.callback = None
@@ -168,10 +363,27 @@ class CloudWorker:
                     self.ssh.command(self.cleanup_command).close()
 
                 self.ssh.remove_id(self.sshkey)
+                reachable = True
             except:
                 pass
 
+            self.ssh.close()
+            self.ssh = None
+
+        if self.destroy and self.ipaddress and self.hub and \
+           self.pool and self.provisioned and reachable:
+            try:
+                if self.pool.park(self.ipaddress, self.instanceid):
+                    self.destroy = False
+                    self.event(self.status("parked worker %s" % self.instanceid), 'park', self.instanceid)
+                    return
+            except:
+                self.status("failed to park worker %s" % self.instanceid)
+                traceback.print_exc(file=self.logs.worker)
+
         if self.destroy and self.ipaddress and self.hub:
+            self.destroy = False
+
             try:
                 destroyed = [ (ipaddress, instanceid) 
                               for ipaddress, instanceid in self.hub.destroy(self.ipaddress) 
@@ -179,7 +391,7 @@ class CloudWorker:
                 
                 if destroyed:
                     ipaddress, instanceid = destroyed[0]
-                    self.status("destroyed worker %s" % instanceid)
+                    self.event(self.status("destroyed worker %s" % instanceid), 'destroy', instanceid)
             except:
                 self.status("failed to destroy worker %s" % self.instanceid)
                 traceback.print_exc(file=self.logs.worker)
@@ -192,96 +404,321 @@ class CloudWorker:
         (self.ipaddress, self.pid) = state
 
     def status(self, msg, after_output=False):
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        """log status line. Returns its time, for the event it records (if any)"""
+        now = time.time()
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
 
         c = "\n" if after_output else ""
         self.logs.worker.status.write(c + "# %s [%s] %s\n" % (timestamp, self.ipaddress, msg))
-        self.logs.manager.write("%s (%d): %s\n" % (self.ipaddress, os.getpid(), msg))
+        self.logs.manager.write("%s (%d): %s\n" % (self.ipaddress, self.logs.worker_id or os.getpid(), msg))
+
+        return now
+
+    def event(self, timestamp, type, *fields):
+        """record structured event (see Session.Events)"""
+        if self.logs.events:
+            self.logs.events.record(timestamp, self.logs.worker_id or os.getpid(), type, *fields)
+
+    def job_started(self, command):
+        self.started = self.status(str(command))
+        self.output_start = self.logs.worker.offset
+
+        self.event(self.started, 'start', self.output_start, command)
+
+    def job_finished(self, result, command, after_output=True):
+        """log the end of a job. result is e.g., 'exit 0', 'timeout' or why
+        the job was aborted"""
+
+        timestamp = self.status("%s # %s" % (result, command), after_output)
+        self.event(timestamp, 'end', "%.3f" % self.started, result,
+                   self.output_start, self.logs.worker.status_offset, command)
+
+    class CommandTimeout(Exception):
+        pass
+
+    class WorkerDied(Exception):
+        pass
+
+    def _check(self, ssh_command, timeout, read_timeout):
+        """called regularly while reading a command's output"""
+
+        if ssh_command.running and timeout.expired():
+            raise self.CommandTimeout
+
+        if read_timeout.expired():
+            for retry in range(self.SSH_PING_RETRIES):
+                try:
+                    self.ssh.ping()
+                    break
+                except self.ssh.Error, e:
+                    pass
+            else:
+                raise self.WorkerDied(e)
+
+            read_timeout.reset()
+
+        # output may be buffered, keep the log up to date
+        self.logs.worker.poll()
+
+        self.handle_stop()
+
+    def _read(self, ssh_command, handler):
+        """read command output. The watchdog signals us if we're stuck,
+        so that our job is put back into the queue for another worker"""
+
+        if not self.signals:
+            return ssh_command.read(handler)
+
+        def stuck(s, f):
+            raise self.Stuck
+
+        with sighandle.sighandle(stuck, self.STUCK_SIGNAL):
+            return ssh_command.read(handler)
+
+    def _account(self, job, exitcode):
+        """Count strikes against the worker. Returns True if job should be retried"""
+
+        if exitcode == 0:
+            self.strike = 0
+            return False
+
+        self.strike += 1
+        if self.strikes and self.strike >= self.strikes:
+            self.status("terminating worker after %d strikes" % self.strikes)
+            raise self.Error
+
+        if job.retry < job.retry_limit:
+            job.retry += 1
+            self.event(self.status("will retry (%d of %d)" % (job.retry, job.retry_limit)),
+                       'retry', job.retry, job.retry_limit, job.command)
+            return True
+
+        return False
+
+    def _result(self, job, exitcode):
+        # commit result to the session before returning it
+        if self.session_jobs:
+            self.session_jobs.record_result(str(job.command), exitcode)
+
+        return (str(job.command), exitcode)
+
+    def _unreachable(self, ssh_command):
+        return ssh_command.exitcode == 255 and \
+               re.match(r'^ssh: connect to host.*:.*$', ssh_command.output)
 
     def __call__(self, job):
+        if isinstance(job, JobBatch):
+            result = self._execute_batch(job)
+        else:
+            result = self._execute_job(job)
+
+        # let the executor know a job is off the queue. Jobs we raise on
+        # (e.g., Retry, Terminated) are put back into the queue.
+        if self.done:
+            with self.done.get_lock():
+                self.done.value += 1
+
+        return result
+
+    def _execute_job(self, job):
         command = job.command
         timeout = self.timeout
 
         self.handle_stop()
 
-        self.status(str(command))
+        self.job_started(command)
         ssh_command = self.ssh.command(command, pty=True)
 
         timeout = Timeout(timeout)
         read_timeout = Timeout(self.ssh.TIMEOUT)
 
-        class CommandTimeout(Exception):
-            pass
-
-        class WorkerDied(Exception):
-            pass
-
         def handler(ssh_command, buf):
             if buf:
                 read_timeout.reset()
                 self.logs.worker.write(buf)
 
-            if ssh_command.running and timeout.expired():
-                raise CommandTimeout
-
-            if read_timeout.expired():
-                for retry in range(self.SSH_PING_RETRIES):
-                    try:
-                        self.ssh.ping()
-                        break
-                    except self.ssh.Error, e:
-                        pass
-                else:
-                    raise WorkerDied(e)
-
-                read_timeout.reset()
-
-            self.handle_stop()
+            self._check(ssh_command, timeout, read_timeout)
             return True
 
         try:
-            out = ssh_command.read(handler)
+            out = self._read(ssh_command, handler)
+
+        except self.Stuck:
+            self.job_finished("worker stuck", command)
+            raise
 
         # SigTerminate raised in serial mode, the other in Parallelized mode
         except self.Terminated:
-            self.status("terminated # %s" % command, True)
+            self.job_finished("terminated", command)
             raise
 
-        except WorkerDied, e:
-            self.status("worker died (%s) # %s" % (e, command), True)
+        except self.WorkerDied, e:
+            self.job_finished("worker died (%s)" % e, command)
             raise self.Error(e)
 
-        except CommandTimeout:
-            self.status("timeout # %s" % command, True)
+        except self.CommandTimeout:
+            self.job_finished("timeout", command)
             exitcode = None
 
         else:
-            if ssh_command.exitcode == 255 and re.match(r'^ssh: connect to host.*:.*$', ssh_command.output):
-                self.status("worker unreachable # %s" % command)
+            if self._unreachable(ssh_command):
+                self.job_finished("worker unreachable", command, False)
                 self.logs.worker.write("%s\n" % ssh_command.output)
                 raise self.Error(SSH.Error(ssh_command.output))
 
-            self.status("exit %d # %s" % (ssh_command.exitcode, command), True)
+            self.job_finished("exit %d" % ssh_command.exitcode, command)
             exitcode = ssh_command.exitcode
 
         finally:
             ssh_command.terminate()
 
-        if ssh_command.exitcode != 0:
-            self.strike += 1
-            if self.strikes and self.strike >= self.strikes:
-                self.status("terminating worker after %d strikes" % self.strikes)
-                raise self.Error
+        if self._account(job, ssh_command.exitcode):
+            raise job.Retry
 
-            if job.retry < job.retry_limit:
-                job.retry += 1
-                self.status("will retry (%d of %d)" % (job.retry, job.retry_limit))
+        return self._result(job, exitcode)
 
-                raise job.Retry
-        else:
-            self.strike = 0
+    def _execute_batch(self, batch):
+        """Execute a batch of jobs in as many rounds as it takes.
+
+        If the worker is cut short (e.g., stuck, terminated, died or struck
+        out), the results of finished jobs are already recorded and the batch
+        is left with just the jobs that didn't finish, so that's all that is
+        put back into the job queue."""
+
+        results = []
+        while batch.jobs:
+            self._execute_batch_round(batch, results)
+
+        return results
+
+    def _execute_batch_round(self, batch, results):
+        """Execute jobs in a single SSH round-trip.
+
+        Appends finished job results to <results> and leaves batch.jobs
+        with the jobs that still need to be executed (not started, retried
+        or cut short)."""
+
+        self.handle_stop()
+
+        jobs = batch.jobs
+
+        class state:
+            running = None
+
+        started = set()
+        exits = []
+
+        timeout = Timeout(self.timeout)
+        read_timeout = Timeout(self.ssh.TIMEOUT)
+
+        def event(i, name, exitcode):
+            job = jobs[i]
+            if name == 'start':
+                started.add(i)
+                state.running = job
+                timeout.reset()
+                self.job_started(job.command)
+            else:
+                state.running = None
+                self.job_finished("exit %d" % exitcode, job.command)
+                exits.append((job, exitcode))
+
+        demux = BatchDemux([ job.command for job in jobs ], self.logs.worker.write, event)
+        ssh_command = self.ssh.command(demux.script, pty=True)
+
+        def handler(ssh_command, buf):
+            if buf:
+                read_timeout.reset()
+                demux.feed(buf)
+
+            self._check(ssh_command, timeout, read_timeout)
+            return True
 
-        return (str(command), exitcode)
+        def running():
+            return state.running.command if state.running else "batch of %d jobs" % len(jobs)
+
+        def aborted(result):
+            if state.running:
+                self.job_finished(result, state.running.command)
+            else:
+                self.status("%s # %s" % (result, running()), True)
+
+        try:
+            try:
+                self._read(ssh_command, handler)
+
+            except self.Stuck:
+                aborted("worker stuck")
+                raise
+
+            except self.Terminated:
+                aborted("terminated")
+                raise
+
+            except self.WorkerDied, e:
+                aborted("worker died (%s)" % e)
+                raise self.Error(e)
+
+            except self.CommandTimeout:
+                aborted("timeout")
+                if state.running:
+                    exits.append((state.running, None))
+
+            else:
+                demux.flush()
+
+                if not started and self._unreachable(ssh_command):
+                    self.status("worker unreachable # %s" % running())
+                    self.logs.worker.write("%s\n" % ssh_command.output)
+                    raise self.Error(SSH.Error(ssh_command.output))
+
+                # remote shell went away before the job's exit was reported
+                if state.running:
+                    self.job_finished("exit %d" % ssh_command.exitcode, state.running.command)
+                    exits.append((state.running, ssh_command.exitcode))
+
+            finally:
+                ssh_command.terminate()
+
+        except self.Terminated:
+            # jobs that exited before we were cut short are finished
+            self._batch_exits(batch, exits, results)
+            raise
+
+        self._batch_exits(batch, exits, results)
+
+    def _batch_exits(self, batch, exits, results):
+        """Records the results of batch jobs that exited and leaves
+        batch.jobs with the rest. Raises Error if the worker strikes out."""
+
+        finished = set()
+        retried = []
+
+        struck_out = None
+        for job, exitcode in exits:
+            if struck_out:
+                # the worker is done for, so its failures are put back too
+                if exitcode != 0:
+                    continue
+
+            else:
+                try:
+                    if self._account(job, exitcode):
+                        retried.append(job)
+                        continue
+
+                except self.Error, e:
+                    struck_out = e
+                    continue
+
+            results.append(self._result(job, exitcode))
+            finished.add(id(job))
+
+        batch.jobs = [ job for job in batch.jobs
+                       if id(job) not in finished and job not in retried ] + retried
+
+        if struck_out:
+            raise struck_out
 
     def __del__(self):
         if os.getpid() != self.pid:
@@ -296,11 +733,21 @@ class VerboseLog:
     def write(self, s):
         self.fh.write("# " + s)
 
+def launcher(session_logs, taskconf, launchq, event_stop):
+    """Returns a Launcher that puts (ipaddress, instanceid) of each launched
+    worker on launchq, and None for each worker that failed to launch."""
+
+    def callback():
+        return not event_stop.is_set()
+
+    return Launcher(Hub(taskconf.hub_apikey), launchq, VerboseLog(session_logs.manager),
+                    callback, **taskconf.ec2_opts)
+
 class CloudExecutor:
     class Error(Exception):
         pass
 
-    def __init__(self, session_logs, taskconf, sshkey):
+    def __init__(self, session_logs, taskconf, sshkey, session_jobs=None, overlay=None, pool=None):
         ipaddresses = taskconf.workers
 
         split = taskconf.split
@@ -308,80 +755,131 @@ class CloudExecutor:
             split = False
 
         if not split:
+            claimed = None
             if ipaddresses:
                 ipaddress = ipaddresses[0]
             else:
                 ipaddress = None
-            self._execute = CloudWorker(session_logs, taskconf, sshkey, ipaddress)
-            self.results = []
+                if pool:
+                    claimed = (pool.claim(1) or [ None ])[0]
+
+            self._execute = CloudWorker(session_logs, taskconf, sshkey, ipaddress,
+                                        session_jobs=session_jobs, overlay=overlay,
+                                        pool=pool, claimed=claimed)
+            self._results = []
 
         else:
             ipaddresses = copy.copy(ipaddresses)
 
             workers = []
             self.event_stop = Event()
+            self.done = Value('l', 0)
             
             launchq = None
 
+            fanout = None
+            if overlay and taskconf.overlay_fanout:
+                fanout = Fanout(taskconf.overlay_fanout)
+
             new_workers = split - len(ipaddresses)
+
+            claimed = []
+            if new_workers > 0 and pool:
+                claimed = pool.claim(new_workers)
+                new_workers -= len(claimed)
+
             if new_workers > 0:
                 if not taskconf.hub_apikey:
                     raise self.Error("need API KEY to launch %d new workers" % new_workers)
 
                 launchq = Queue()
-                def thread():
-
-                    def callback():
-                        return not self.event_stop.is_set()
-
-                    hub = Hub(taskconf.hub_apikey)
-                    i = None
-                    try:
-                        for i, instance in enumerate(hub.launch(new_workers, VerboseLog(session_logs.manager), callback, **taskconf.ec2_opts)):
-                            launchq.put(instance)
-                    except Exception, e:
-                        unlaunched_workers = new_workers - (i + 1) \
-                                             if i is not None \
-                                             else new_workers
-
-                        for i in range(unlaunched_workers):
-                            launchq.put(None)
-
-                        if not isinstance(e, hub.Stopped):
-                            traceback.print_exc(file=session_logs.manager)
-
-                threading.Thread(target=thread).start()
+                launcher(session_logs, taskconf, launchq, self.event_stop).launch(new_workers)
 
             for i in range(split):
+                ipaddress = None
+                claim = None
+
                 if ipaddresses:
                     ipaddress = ipaddresses.pop(0)
-                else:
-                    ipaddress = None
+                elif claimed:
+                    claim = claimed.pop(0)
 
                 worker = Deferred(CloudWorker, session_logs, taskconf, sshkey, ipaddress, 
-                                  event_stop=self.event_stop, launchq=launchq)
+                                  event_stop=self.event_stop, launchq=launchq, done=self.done,
+                                  session_jobs=session_jobs, overlay=overlay, fanout=fanout,
+                                  pool=pool, claimed=claim)
 
                 workers.append(worker)
 
             self._execute = Parallelize(workers)
-            self.results = self._execute.results
+            self._results = self._execute.results
 
         self.split = split
         self.job_retry_limit = taskconf.retries
 
-    def __call__(self, job):
-        if not isinstance(job, Job):
-            job = Job(job, self.job_retry_limit)
+        self.batch = taskconf.batch if taskconf.batch and taskconf.batch > 1 else None
+        self.batched = []
+
+        # how many jobs (or batches) we queue ahead of the workers
+        self.readahead = max(1, taskconf.readahead / (self.batch or 1))
+        self.submitted = 0
+
+    @property
+    def results(self):
+        if not self.batch:
+            return self._results
+
+        # batches return a list of results
+        results = []
+        for batch_results in self._results:
+            results += batch_results
+
+        return results
 
+    def _throttle(self):
+        """wait until the workers catch up with the readahead"""
+
+        while self.submitted - self.done.value >= self.readahead:
+            if not [ executor for executor in self._execute.executors
+                     if executor.is_alive() ]:
+                break
+
+            time.sleep(0.1)
+
+    def _submit(self, job):
         if self.split:
+            self._throttle()
+            self.submitted += 1
+
             return self._execute(job)
 
         try:
             result = self._execute(job)
-        except job.Retry:
-            return self(job)
+        except Job.Retry:
+            return self._submit(job)
+
+        self._results.append(result)
+
+    def __call__(self, job):
+        if not isinstance(job, Job):
+            job = Job(job, self.job_retry_limit)
+
+        if not self.batch:
+            return self._submit(job)
 
-        self.results.append(result)
+        self.batched.append(job)
+        if len(self.batched) == self.batch:
+            self.flush()
+
+    def flush(self):
+        """submit jobs queued for a partial batch"""
+        if not self.batched:
+            return
+
+        batch = JobBatch(self.batched)
+        self.batched = []
+
+        self._submit(batch)
 
     def stop(self):
         if not self.split:
@@ -393,7 +891,443 @@ class CloudExecutor:
         self._execute.stop()
 
     def join(self):
+        self.flush()
+
         if self.split:
             self._execute.wait(keepalive=False, keepalive_spares=1)
 
         self.stop()
+
+class AsyncJob:
+    """Executes a job on a CloudWorker without blocking.
+
+    The reactor reads the job's output and fires its timeouts. When the job
+    is finished, callback(asyncjob, outcome, value) is called where outcome
+    is one of:
+
+        'result'        value is the job's result
+        'retry'         job needs to be executed again
+        'error'         value is the CloudWorker.Error that retires the worker
+    """
+
+    # output we keep to tell if the worker is unreachable
+    HEAD = 1024
+
+    def __init__(self, reactor, worker, job, callback):
+        self.reactor = reactor
+        self.worker = worker
+        self.job = job
+        self.callback = callback
+
+        self.exitcode = None
+        self.output = ""
+        self.finished = False
+
+        self.ping = None
+        self.pings = 0
+
+        worker.job_started(job.command)
+        self.started = time.time()
+        self.process = reactor.spawn(worker.ssh.argv(job.command, pty=True),
+                                     self._output, self._exited, pty=True)
+
+        self.timeout = None
+        if worker.timeout:
+            self.timeout = reactor.call_later(worker.timeout, self._timeout)
+
+        self.last_output = time.time()
+        self.read_timeout = reactor.call_later(worker.ssh.TIMEOUT, self._read_timeout)
+
+    def _output(self, buf):
+        self.last_output = time.time()
+
+        if len(self.output) < self.HEAD:
+            self.output += buf[:self.HEAD]
+
+        self.worker.logs.worker.write(buf)
+
+    def _exited(self, exitcode):
+        if self.finished:
+            return
+
+        self.exitcode = exitcode
+        if self.worker._unreachable(self):
+            self.worker.job_finished("worker unreachable", self.job.command, False)
+            self.worker.logs.worker.write("%s\n" % self.output)
+            return self._error(SSH.Error(self.output))
+
+        self.worker.job_finished("exit %d" % exitcode, self.job.command)
+        self._finish(exitcode)
+
+    def _timeout(self):
+        self.worker.job_finished("timeout", self.job.command)
+        self._finish(None)
+
+    def _read_timeout(self):
+        # resetting the timer on every read would be expensive
+        idle = time.time() - self.last_output
+        if idle < self.worker.ssh.TIMEOUT:
+            self.read_timeout = self.reactor.call_later(self.worker.ssh.TIMEOUT - idle,
+                                                        self._read_timeout)
+            return
+
+        self._ping()
+
+    def _ping(self):
+        output = []
+        def exited(exitcode):
+            ping_timeout.cancel()
+            self._pinged(exitcode, "".join(output).strip())
+
+        self.ping = self.reactor.spawn(self.worker.ssh.argv('true'), output.append, exited)
+        ping_timeout = self.reactor.call_later(self.worker.ssh.TIMEOUT, self.ping.terminate)
+
+    def _pinged(self, exitcode, output):
+        self.ping = None
+        if self.finished:
+            return
+
+        if exitcode == 0:
+            self.pings = 0
+            self.last_output = time.time()
+            self.read_timeout = self.reactor.call_later(self.worker.ssh.TIMEOUT,
+                                                        self._read_timeout)
+            return
+
+        self.pings += 1
+        if self.pings < self.worker.SSH_PING_RETRIES:
+            return self._ping()
+
+        e = SSH.Error(output or "ssh ping failed (%d)" % exitcode)
+        self.worker.job_finished("worker died (%s)" % e, self.job.command)
+        self._error(e)
+
+    def _close(self):
+        self.finished = True
+
+        if self.timeout:
+            self.timeout.cancel()
+        self.read_timeout.cancel()
+
+        self.process.terminate()
+        if self.ping:
+            self.ping.terminate()
+
+    def _error(self, e):
+        self._close()
+        self.callback(self, 'error', CloudWorker.Error(e))
+
+    def _finish(self, exitcode):
+        self._close()
+
+        try:
+            retry = self.worker._account(self.job, exitcode)
+        except CloudWorker.Error, e:
+            return self.callback(self, 'error', e)
+
+        if retry:
+            return self.callback(self, 'retry', None)
+
+        self.callback(self, 'result', self.worker._result(self.job, exitcode))
+
+    def terminate(self):
+        if self.finished:
+            return
+
+        self.worker.job_finished("terminated", self.job.command)
+        self._close()
+
+class Autoscaler:
+    """Decides how many workers we want so the queued jobs are finished
+    within target_time seconds, given how long jobs take on average."""
+
+    # how often we reconsider (seconds)
+    INTERVAL = 60
+
+    def __init__(self, split_min, split_max, target_time):
+        self.split_min = split_min or 1
+        self.split_max = split_max
+        self.target_time = target_time
+
+    def __call__(self, queued, average):
+        wanted = int(math.ceil(queued * average / self.target_time))
+        return max(self.split_min, min(self.split_max, wanted))
+
+class EventExecutor:
+    """Executes jobs on split workers from a single process.
+
+    CloudExecutor forks a process per worker that polls the output of its
+    jobs. Here workers are provisioned in threads instead, and the output
+    of the jobs running on all of them is multiplexed by a single Reactor,
+    which also fires the job and read timeouts.
+
+    If taskconf.split_max is set, the pool is elastic: an Autoscaler
+    launches more workers when the queue is deep and retires workers as it
+    drains.
+    """
+
+    class Error(Exception):
+        pass
+
+    # how long to wait for events before checking on new workers
+    TICK = 1
+
+    def __init__(self, session_logs, taskconf, sshkey, session_jobs=None, overlay=None, pool=None):
+        self.logs = session_logs
+        self.reactor = Reactor()
+        self.event_stop = threading.Event()
+
+        self.job_retry_limit = taskconf.retries
+        self.readahead = taskconf.readahead
+
+        self.results = []
+        self.pending = deque()
+
+        self.workers = []
+        self.idle = []
+        self.running = {}
+
+        self.ready = ThreadQueue()
+        self.threads = []
+
+        self.taskconf = taskconf
+        self.sshkey = sshkey
+        self.session_jobs = session_jobs
+        self.overlay = overlay
+        self.pool = pool
+
+        self.fanout = None
+        if overlay and taskconf.overlay_fanout:
+            self.fanout = Fanout(taskconf.overlay_fanout)
+
+        # job durations, for the autoscaler
+        self.elapsed = 0
+        self.finished = 0
+
+        self.autoscaler = None
+        if taskconf.split_max:
+            self.autoscaler = Autoscaler(taskconf.split_min, taskconf.split_max, taskconf.target_time)
+        self.autoscaled = time.time()
+        self.wanted = None
+
+        self.launchq = None
+        self.launcher = None
+        self.provisioning = []
+
+        ipaddresses = copy.copy(taskconf.workers)
+        split = taskconf.split or 1
+
+        new_workers = split - len(ipaddresses)
+        if new_workers > 0:
+            if not taskconf.hub_apikey:
+                raise self.Error("need API KEY to launch %d new workers" % new_workers)
+
+            self._launch(new_workers)
+
+        for ipaddress in ipaddresses[:split]:
+            self._spawn(ipaddress)
+
+    def _spawn(self, ipaddress=None, claimed=None):
+        """provision a worker in a thread"""
+
+        logs = self.logs.for_worker(len(self.provisioning))
+
+        thread = threading.Thread(target=self._provision, args=(logs, ipaddress, claimed))
+        thread.daemon = True
+        thread.start()
+
+        self.provisioning.append(thread)
+
+    def _launch(self, howmany):
+        if self.pool:
+            for claimed in self.pool.claim(howmany):
+                self._spawn(claimed=claimed)
+                howmany -= 1
+
+        if howmany < 1:
+            return
+
+        if self.launcher is None:
+            self.launchq = ThreadQueue()
+            self.launcher = launcher(self.logs, self.taskconf, self.launchq, self.event_stop)
+
+        self.launcher.launch(howmany)
+        for i in range(howmany):
+            self._spawn()
+
+    def _provision(self, logs, ipaddress, claimed=None):
+        try:
+            worker = CloudWorker(logs, self.taskconf, self.sshkey, ipaddress,
+                                 event_stop=self.event_stop, launchq=self.launchq,
+                                 session_jobs=self.session_jobs, overlay=self.overlay,
+                                 fanout=self.fanout, signals=False,
+                                 pool=self.pool, claimed=claimed)
+        except CloudWorker.Terminated:
+            return
+        except:
+            traceback.print_exc(file=logs.manager)
+            return
+
+        self.ready.put(worker)
+
+    def _cleanup(self, workers):
+        """clean up workers in the background"""
+
+        def cleanup(worker):
+            try:
+                worker._cleanup()
+            except:
+                traceback.print_exc(file=self.logs.manager)
+
+        for worker in workers:
+            thread = threading.Thread(target=cleanup, args=(worker,))
+            thread.start()
+
+            self.threads.append(thread)
+
+    def _retire(self, worker):
+        self.workers.remove(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+
+        self._cleanup([worker])
+
+    def _alive(self):
+        if self.workers or not self.ready.empty():
+            return True
+
+        return any([ thread.is_alive() for thread in self.provisioning ])
+
+    def _finished(self, asyncjob, outcome, value):
+        worker = asyncjob.worker
+        del self.running[worker]
+
+        if outcome == 'error':
+            return self._retire(worker)
+
+        self.elapsed += time.time() - asyncjob.started
+        self.finished += 1
+
+        if outcome == 'retry':
+            self.pending.append(asyncjob.job)
+        else:
+            self.results.append(value)
+
+        if self.wanted is not None and len(self.workers) > self.wanted:
+            self._log("retiring worker %s" % worker.ipaddress)
+            return self._retire(worker)
+
+        self.idle.append(worker)
+
+    def _log(self, msg):
+        self.logs.manager.write("# autoscaler: %s\n" % msg)
+
+    def _autoscale(self):
+        if not self.autoscaler or not self.finished:
+            return
+
+        if time.time() - self.autoscaled < self.autoscaler.INTERVAL:
+            return
+        self.autoscaled = time.time()
+
+        provisioning = len([ thread for thread in self.provisioning if thread.is_alive() ])
+        workers = len(self.workers) + provisioning
+
+        queued = len(self.pending) + len(self.running)
+        average = self.elapsed / self.finished
+
+        self.wanted = self.autoscaler(queued, average)
+        if self.wanted > workers and not provisioning:
+            self._log("launching %d workers (%d queued jobs, %d seconds average)" %
+                      (self.wanted - workers, queued, average))
+            self._launch(self.wanted - workers)
+
+        elif self.wanted < workers:
+            for worker in self.idle[:workers - self.wanted]:
+                self._log("retiring worker %s" % worker.ipaddress)
+                self._retire(worker)
+
+    def _dispatch(self):
+        while self.idle and self.pending:
+            worker = self.idle.pop()
+            job = self.pending.popleft()
+
+            try:
+                self.running[worker] = AsyncJob(self.reactor, worker, job, self._finished)
+            except Exception, e:
+                worker.status("can't execute job: %s" % e)
+                self.pending.appendleft(job)
+                self._retire(worker)
+
+    def _step(self, timeout):
+        while True:
+            try:
+                worker = self.ready.get_nowait()
+            except Empty:
+                break
+
+            self.workers.append(worker)
+            self.idle.append(worker)
+
+        self._autoscale()
+
+        self._dispatch()
+        self.reactor.run_once(timeout)
+        self._dispatch()
+
+        for worker in self.running:
+            worker.logs.worker.poll()
+
+    def __call__(self, job):
+        if not isinstance(job, Job):
+            job = Job(job, self.job_retry_limit)
+
+        self.pending.append(job)
+        self._step(0)
+
+        while len(self.pending) >= self.readahead and self._alive():
+            self._step(self.TICK)
+
+    def join(self):
+        while (self.pending or self.running) and self._alive():
+            self._step(self.TICK)
+
+            # release idle workers we won't need, keeping a spare for retries
+            if not self.pending:
+                for worker in self.idle[1:]:
+                    self._retire(worker)
+
+        self.stop()
+
+    def stop(self):
+        self.event_stop.set()
+
+        for asyncjob in self.running.values():
+            asyncjob.terminate()
+        self.running = {}
+
+        # reap terminated commands
+        started = time.time()
+        while self.reactor.readers and time.time() - started < self.TICK * 5:
+            self.reactor.run_once(0.1)
+
+        # join() with a timeout so signals still get through
+        for thread in self.provisioning:
+            while thread.is_alive():
+                thread.join(self.TICK)
+
+        while True:
+            try:
+                self.workers.append(self.ready.get_nowait())
+            except Empty:
+                break
+
+        workers = self.workers
+        self.workers = []
+        self.idle = []
+
+        self._cleanup(workers)
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(self.TICK)
+        self.threads = []
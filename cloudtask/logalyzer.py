@@ -16,7 +16,9 @@ import paths
 import re
 
 from StringIO import StringIO
+import cPickle
 from datetime import datetime
+from multiprocessing import Pool
 
 import ec2cost
 
@@ -42,40 +44,250 @@ class WorkersLog:
     class LogEntry:
         TIMESTAMP_FMT = "%Y-%m-%d %H:%M:%S"
         def __init__(self, timestamp, title):
-            self.timestamp = datetime.strptime(timestamp, self.TIMESTAMP_FMT)
+            self.timestamp = self.parse_timestamp(timestamp)
             self.title = title
+
+            # offset of the entry in the log
+            self.offset = None
+
+            # last lines of the body and its byte offsets in the log
             self.body = ""
+            self.body_start = self.body_end = None
+
+        @staticmethod
+        def parse_timestamp(timestamp):
+            """faster equivalent of strptime(timestamp, TIMESTAMP_FMT)"""
+            date, time = timestamp.split(' ')
+            return datetime(*map(int, date.split('-') + time.split(':')))
 
         def __repr__(self):
             return "LogEntry%s" % `datetime.strftime(self.timestamp, self.TIMESTAMP_FMT), self.title`
 
+    # how many lines at the end of an entry's body we keep
+    TAIL_LINES = 5
+
+    STATUS = re.compile(r'^# (\d{4}-\d+-\d+ \d\d:\d\d:\d\d) \[.*?\] (.*)$', re.MULTILINE)
+
+    BLOCKSIZE = 1024 * 1024
+
+    # lines longer than this can't be status lines
+    MAXLINE = 64 * 1024
+
+    # how much of the scanned log we keep to read back the tails of bodies
+    # from, so we rarely need to seek back (which is slow when compressed)
+    KEEP = 64 * 1024
+
     @classmethod
-    def parse_worker_log(cls, fpath):
-        entries = []
-        body = ""
-        for line in file(fpath).readlines():
-            m = re.match(r'^# (\d{4}-\d+-\d+ \d\d:\d\d:\d\d) \[.*?\] (.*)', line)
-            if not m:
-                body += line
-                continue
-            else:
-                body = body.strip()
-                if entries and body:
-                    entries[-1].body = body
-                body = ""
-                timestamp, title = m.groups()
-                entries.append(cls.LogEntry(timestamp, title))
+    def _tail(cls, read, start, end):
+        """returns the last lines of the stripped body between offsets start
+        and end, which we read(start, end) from the end backwards"""
 
-        return entries
+        size = 4096
+        while True:
+            pos = max(start, end - size)
+            if pos == start:
+                lines = read(pos, end).strip().splitlines()
+                return "\n".join(lines[-cls.TAIL_LINES:])
+
+            # the first line may be partial
+            lines = read(pos, end).rstrip().splitlines()
+            if len(lines) > cls.TAIL_LINES:
+                return "\n".join(lines[-cls.TAIL_LINES:])
+
+            size *= 4
+
+    @classmethod
+    def parse_worker_log(cls, fpath, offset=0, segments=None):
+        """Generator that scans a worker log in a single pass, yielding
+        LogEntry's as they are completed. If offset is given, scanning
+        starts there (i.e., where an entry begins). Rotated segments of the
+        log are read first (see Session.Logs.WorkerReader).
+
+        The log is scanned in blocks for status lines. Bodies are never
+        accumulated, we just record their offsets and read back their last
+        lines.
+        """
+
+        fh = Session.Logs.WorkerReader(fpath, segments)
+        fh_tail = Session.Logs.WorkerReader(fpath, [ part.path for part in fh.parts
+                                                     if part is not fh.active ])
+
+        fh.seek(offset)
+
+        class state:
+            pass
+
+        state.buf = ""
+        state.offset = offset   # offset of buf in the log
+        scanned = 0             # buf before this has been scanned
+
+        def read(start, end):
+            if start >= state.offset:
+                return state.buf[start - state.offset:end - state.offset]
+
+            fh_tail.seek(start)
+            return fh_tail.read(end - start)
+
+        def finish(entry, end):
+            entry.body_end = max(entry.body_start, end)
+            entry.body = cls._tail(read, entry.body_start, entry.body_end)
+            return entry
+
+        entry = None
+        skipping = False
+        eof = False
+
+        while not eof:
+            block = fh.read(cls.BLOCKSIZE)
+            if block:
+                state.buf += block
+
+                # scan complete lines
+                end = state.buf.rfind("\n") + 1
+                if end <= scanned:
+                    if len(state.buf) - scanned > cls.MAXLINE:
+                        state.offset += len(state.buf)
+                        state.buf = ""
+                        scanned = 0
+                        skipping = True
+                    continue
+            else:
+                # a partial last line is still being written
+                eof = True
+                end = max(state.buf.rfind("\n") + 1, scanned)
+
+            pos = scanned
+            if skipping:
+                pos = state.buf.find("\n", pos) + 1
+                skipping = False
+
+            # find() is much faster than matching the regex at every line
+            i = pos
+            while i < end:
+                m = cls.STATUS.match(state.buf, i, end) if state.buf.startswith('# ', i) else None
+                if m:
+                    if entry:
+                        yield finish(entry, state.offset + m.start())
+
+                    timestamp, title = m.groups()
+                    entry = cls.LogEntry(timestamp, title)
+                    entry.offset = state.offset + m.start()
+                    entry.body_start = min(state.offset + m.end() + 1, state.offset + end)
+
+                i = state.buf.find('\n# ', i, end)
+                if i == -1:
+                    break
+                i += 1
+
+            keep = max(0, end - cls.KEEP)
+            state.offset += keep
+            state.buf = state.buf[keep:]
+            scanned = end - keep
+
+        if entry:
+            yield finish(entry, state.offset + len(state.buf))
+
+        fh.close()
+        fh_tail.close()
 
     class Job:
-        def __init__(self, worker_id, name, result, timestamp, elapsed, output):
+        def __init__(self, worker_id, name, result, timestamp, elapsed, output_tail,
+                     path=None, output_start=None, output_end=None):
             self.worker_id = worker_id
             self.name = name
             self.result = result
             self.timestamp = timestamp
             self.elapsed = elapsed
-            self.output = output
+
+            # output is a slice of the worker log, only read when needed.
+            # output_tail is None until it is read.
+            self._output_tail = output_tail
+            self.path = path
+            self.output_start = output_start
+            self.output_end = output_end
+
+        CHUNKSIZE = 1024 * 1024
+
+        def _strip(self, fh, start, end):
+            """returns offsets of output slice without surrounding whitespace"""
+
+            # search forwards for the first non-whitespace character
+            while start < end:
+                fh.seek(start)
+                chunk = fh.read(min(self.CHUNKSIZE, end - start))
+                stripped = chunk.lstrip()
+                if stripped:
+                    start += len(chunk) - len(stripped)
+                    break
+                start += len(chunk)
+
+            # search backwards for the last non-whitespace character
+            while end > start:
+                chunk_start = max(start, end - self.CHUNKSIZE)
+                fh.seek(chunk_start)
+                stripped = fh.read(end - chunk_start).rstrip()
+                if stripped:
+                    return start, chunk_start + len(stripped)
+                end = chunk_start
+
+            return start, start
+
+        def write_output(self, fh, log=None):
+            """write output to fh, copying it from the worker log a chunk at
+            a time so that large outputs aren't read into memory.
+
+            log is an open Session.Logs.WorkerReader of the worker log. Reading
+            the outputs of a log's jobs in order through the same reader is
+            much cheaper if the log is compressed.
+            """
+
+            if self.path is None:
+                fh.write(self.output_tail)
+                return
+
+            close = log is None
+            if close:
+                log = Session.Logs.WorkerReader(self.path)
+            try:
+                # small outputs are stripped in memory, which saves seeking
+                # backwards (expensive in a compressed segment)
+                if self.output_end - self.output_start <= self.CHUNKSIZE:
+                    log.seek(self.output_start)
+                    fh.write(log.read(self.output_end - self.output_start).strip())
+                    return
+
+                start, end = self._strip(log, self.output_start, self.output_end)
+
+                log.seek(start)
+                while start < end:
+                    chunk = log.read(min(self.CHUNKSIZE, end - start))
+                    if not chunk:
+                        break
+                    fh.write(chunk)
+                    start += len(chunk)
+            finally:
+                if close:
+                    log.close()
+
+        @property
+        def output(self):
+            sio = StringIO()
+            self.write_output(sio)
+            return sio.getvalue()
+
+        @property
+        def output_tail(self):
+            if self._output_tail is None:
+                log = Session.Logs.WorkerReader(self.path)
+
+                def read(start, end):
+                    log.seek(start)
+                    return log.read(end - start)
+
+                self._output_tail = WorkersLog._tail(read, self.output_start, self.output_end)
+                log.close()
+
+            return self._output_tail
 
         def __repr__(self):
             return "Job%s" % `self.worker_id, self.name, self.result, self.elapsed`
@@ -93,37 +305,46 @@ class WorkersLog:
 
     @classmethod
     def get_jobs(cls, log_entries, command):
-        pat = re.compile(r'^(.*?) # %s (.*)' % command)
+        pat = re.compile(r'^(.*?) # %s (.*)' % re.escape(command))
 
         jobs = []
-        for i, entry in enumerate(log_entries):
+        started = None
+        for entry in log_entries:
             m = pat.match(entry.title)
-            if m:
+            if m and started:
                 result, name = m.groups()
-                started = log_entries[i-1]
                 delta = (entry.timestamp - started.timestamp)
                 elapsed = delta.seconds + delta.days * 86400
-                jobs.append((name, result, started.timestamp, elapsed, started.body))
+                jobs.append((name, result, started.timestamp, elapsed, started.body,
+                             started.body_start, started.body_end))
+
+            started = entry
 
         return jobs
 
     @classmethod
-    def get_instance_time(cls, log_entries):
-        launched = None
-        destroyed = None
+    def get_instance_events(cls, log_entries, launched=None, destroyed=None):
+        """returns the last (timestamp, instanceid) the worker was launched
+        and destroyed, if ever"""
 
         for log_entry in log_entries:
-            m = re.match(r'launched worker (.*)', log_entry.title)
+            # claimed and parked are where a session's use of a worker
+            # from the warm pool begins and ends
+            m = re.match(r'(?:launched|claimed) worker (.*)', log_entry.title)
             if m:
                 instanceid = m.group(1)
                 launched = (log_entry.timestamp, instanceid)
                 continue
 
-            m = re.match(r'destroyed worker (.*)', log_entry.title)
+            m = re.match(r'(?:destroyed|parked) worker (.*)', log_entry.title)
             if m:
                 instanceid = m.group(1)
                 destroyed = (log_entry.timestamp, instanceid)
 
+        return launched, destroyed
+
+    @staticmethod
+    def get_instance_time(launched, destroyed):
         if not launched:
             return None, None
 
@@ -138,17 +359,208 @@ class WorkersLog:
         delta = destroyed[0] - launched[0]
         return launched[1], delta.seconds + delta.days * 86400
 
-    def __init__(self, dpath, command):
+    @classmethod
+    def parse_worker(cls, fpath, command, offset=0, segments=None):
+        """Parse a worker log from offset (where an entry begins).
+
+        Returns (jobs, launched, destroyed, checkpoint) where checkpoint is
+        the offset of the last entry, which may not be complete yet. Parsing
+        can resume there if the log grows.
+        """
+
+        log_entries = list(cls.parse_worker_log(fpath, offset, segments))
+
+        launched, destroyed = cls.get_instance_events(log_entries)
+        checkpoint = log_entries[-1].offset if log_entries else offset
+
+        return cls.get_jobs(log_entries, command), launched, destroyed, checkpoint
+
+    @classmethod
+    def parse_events(cls, path, command):
+        """Returns dict of worker_id -> (jobs, launched, destroyed) from the
+        session's events (see Session.Events), like parse_worker does from
+        a worker log. The tails of job outputs are only read when needed."""
+
+        workers = {}
+        prefix = command + " "
+        for event in Session.Events(path):
+            worker = workers.setdefault(event.worker_id, [ [], None, None ])
+            timestamp = datetime.fromtimestamp(int(event.timestamp))
+
+            if event.type == 'end' and event.command.startswith(prefix):
+                started = datetime.fromtimestamp(int(event.started))
+                delta = timestamp - started
+                worker[0].append((event.command[len(prefix):], event.result, started,
+                                  delta.seconds + delta.days * 86400, None,
+                                  event.output_start, event.output_end))
+
+            elif event.type in ('launch', 'claim'):
+                worker[1] = (timestamp, event.instanceid)
+
+            elif event.type in ('destroy', 'park'):
+                worker[2] = (timestamp, event.instanceid)
+
+        return dict([ (worker_id, tuple(worker)) for worker_id, worker in workers.items() ])
+
+    class Index:
+        """Persistent index of parsed worker logs.
+
+        Per worker log we keep its stat (see Session.Logs.WorkerReader), the
+        parsed jobs and instance events, and a checkpoint offset. If a log is
+        unchanged we use the index as is, if it has grown (or been rotated)
+        we only parse from the checkpoint, otherwise we parse it again from
+        scratch.
+        """
+
+        # bumped when the way we parse worker logs changes
+        VERSION = 2
+
+        def __init__(self, path, command):
+            self.path = path
+            self.command = command
+
+            self.workers = {}
+            if exists(path):
+                try:
+                    index = cPickle.load(file(path, "rb"))
+                    if index.get('version') == self.VERSION and index['command'] == command:
+                        self.workers = index['workers']
+                except Exception:
+                    pass
+
+        def lookup(self, fname, stat):
+            """returns (cached, offset) we need to parse the worker log from,
+            given its current stat. If offset is None, cached is up to date."""
+
+            cached = self.workers.get(fname)
+            if not cached:
+                return None, 0
+
+            if stat == cached['stat']:
+                return cached, None
+
+            if len(cached['stat']) != len(stat):
+                return None, 0
+
+            inode, size, mtime, segments = stat
+            cached_inode, cached_size, cached_mtime, cached_segments = cached['stat']
+
+            if size > cached_size and \
+               (segments > cached_segments or (segments == cached_segments and inode == cached_inode)):
+                return cached, cached['checkpoint']
+
+            return None, 0
+
+        def update(self, fname, stat, jobs, launched, destroyed, checkpoint):
+            self.workers[fname] = dict(stat=stat, jobs=jobs,
+                                       launched=launched, destroyed=destroyed,
+                                       checkpoint=checkpoint)
+
+        def save(self, fnames):
+            workers = dict([ (fname, self.workers[fname]) for fname in fnames
+                             if fname in self.workers ])
+
+            path_tmp = self.path + ".tmp.%d" % os.getpid()
+            try:
+                fh = file(path_tmp, "wb")
+                cPickle.dump(dict(version=self.VERSION, command=self.command,
+                                  workers=workers), fh, 2)
+                fh.close()
+
+                os.rename(path_tmp, self.path)
+
+            # e.g., read-only session
+            except (IOError, OSError):
+                if exists(path_tmp):
+                    os.remove(path_tmp)
+
+    def __init__(self, dpath, command, processes=None, index=None, events=None):
+        """If processes > 1, parse worker logs in a pool of processes.
+        If index is a path, parsed worker logs are indexed there.
+        If events is a path, workers that have events recorded there are
+        analyzed from their events instead of their logs."""
+
         jobs = {}
         workers = []
 
-        for fname in os.listdir(dpath):
+        listdir = os.listdir(dpath)
+        worker_logs = Session.Logs.worker_logs(dpath, listdir)
+
+        # worker logs, in the order they are listed
+        fnames = []
+        for fname in listdir:
+            parsed = Session.Logs.parse_worker_fname(fname)
+            if parsed and str(parsed[0]) not in fnames:
+                fnames.append(str(parsed[0]))
+
+        if index:
+            index = self.Index(index, command)
+
+        # sessions run before events were recorded only have logs
+        from_events = {}
+        if events and exists(events):
+            from_events = self.parse_events(events, command)
+
+        parsed = {}
+        todo = []
+        for fname in fnames:
+            if int(fname) in from_events:
+                parsed[fname] = from_events[int(fname)] + (None,)
+                continue
+
+            fpath = join(dpath, fname)
+            segments = worker_logs[int(fname)]
+
+            cached, offset, stat = None, 0, None
+            if index:
+                # stat before parsing, in case the log grows meanwhile
+                stat = Session.Logs.WorkerReader(fpath, segments).stat()
+
+                cached, offset = index.lookup(fname, stat)
+                if offset is None:
+                    parsed[fname] = (cached['jobs'], cached['launched'],
+                                     cached['destroyed'], cached['checkpoint'])
+                    continue
+
+            todo.append((fname, (fpath, command, offset, segments), cached, stat))
+
+        args = [ args for fname, args, cached, stat in todo ]
+        if processes > 1 and len(args) > 1:
+            pool = Pool(processes)
+            try:
+                results = pool.map(_parse_worker, args, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_parse_worker, args)
+
+        for (fname, args, cached, stat), (worker_jobs, launched, destroyed, checkpoint) in zip(todo, results):
+            if cached:
+                worker_jobs = cached['jobs'] + worker_jobs
+                launched = launched or cached['launched']
+                destroyed = destroyed or cached['destroyed']
+
+            if index:
+                index.update(fname, stat, worker_jobs, launched, destroyed, checkpoint)
+
+            parsed[fname] = (worker_jobs, launched, destroyed, checkpoint)
+
+        if index:
+            index.save(fnames)
+
+        # merge in listdir order, so conflicts are resolved like before
+        for fname in fnames:
+            worker_jobs, launched, destroyed, checkpoint = parsed[fname]
+            instanceid, instancetime = self.get_instance_time(launched, destroyed)
+
             worker_id = int(fname)
             fpath = join(dpath, fname)
-            log_entries = self.parse_worker_log(fpath)
 
-            worker_jobs = [ self.Job(worker_id, *job_args) for 
-                            job_args in self.get_jobs(log_entries, command) ]
+            worker_jobs = [ self.Job(worker_id, name, result, timestamp, elapsed, tail,
+                                     fpath, start, end)
+                            for name, result, timestamp, elapsed, tail, start, end
+                            in worker_jobs ]
 
             for job in worker_jobs:
                 name = job.name
@@ -159,13 +571,36 @@ class WorkersLog:
                 else:
                     jobs[name] = job
 
-            instanceid, instancetime = self.get_instance_time(log_entries)
             worktime = sum([ job.elapsed for job in worker_jobs ])
             workers.append(self.Worker(worker_id, instanceid, len(worker_jobs), instancetime, worktime))
 
         self.jobs = jobs.values()
         self.workers = workers
 
+def _parse_worker(args):
+    # module level so a Pool can pickle it
+    return WorkersLog.parse_worker(*args)
+
+def write_outputs(dpath, jobs):
+    """write the output of each job to dpath/<job name>, reading each worker
+    log in order through a single reader"""
+
+    jobs = sorted(jobs, key=lambda job: (job.path, job.output_start))
+
+    log = None
+    for job in jobs:
+        if job.path and (log is None or log.path != job.path):
+            if log:
+                log.close()
+            log = Session.Logs.WorkerReader(job.path)
+
+        fh = file(join(dpath, job.name), "w")
+        job.write_output(fh, log if job.path else None)
+        fh.close()
+
+    if log:
+        log.close()
+
 def fmt_table(rows, title=[], groupby=None):
     col_widths = []
     for col_index in range(len(rows[0])):
@@ -199,7 +634,8 @@ def mkdir(path):
 class OutputsPaths(paths.Paths):
     files = ['failures', 'succeeded']
 
-def logalyzer(session_path, outputs_dir=None):
+def logalyzer(session_path, outputs_dir=None, processes=None):
+    """If processes > 1, worker logs are parsed in a pool of processes"""
     session_paths = Session.Paths(session_path)
 
     if outputs_dir:
@@ -239,7 +675,9 @@ def logalyzer(session_path, outputs_dir=None):
     print >> sio, header(0, "session %d: %s elapsed, %d jobs - %d pending, %d failed, %d completed" % 
                             (id, fmt_elapsed(elapsed), stats.total, stats.pending, stats.failures, stats.succeeded))
 
-    wl = WorkersLog(session_paths.workers, conf['command'])
+    wl = WorkersLog(session_paths.workers, conf['command'], processes,
+                    index=session_paths.workers + ".index",
+                    events=session_paths.events)
 
     instance_hours = sum([ worker.instancetime/3600 + 1 
                            for worker in wl.workers 
@@ -262,7 +700,13 @@ def logalyzer(session_path, outputs_dir=None):
     print >> sio
 
     c = conf
-    workers = "%d x (%s)" % (c['split'] if c['split'] else 1,
+
+    # elastic pools are billed per worker lifetime, see workers table
+    split = c['split'] if c['split'] else 1
+    if c.get('split_max'):
+        split = "%d-%d" % (c.get('split_min') or 1, c['split_max'])
+
+    workers = "%s x (%s)" % (split,
                              " : ".join([ c[attr] 
                                        for attr in ('ec2_region', 'ec2_size', 'ec2_type', 'ami_id', 'snapshot_id') 
                                        if attr in c and c[attr] ]))
@@ -270,8 +714,8 @@ def logalyzer(session_path, outputs_dir=None):
     fields = conf
 
     fields['params'] = " ".join([ "%s=%s" % (k, c[k]) 
-                                  for k in ('timeout', 'retries', 'strikes') 
-                                  if k in c ])
+                                  for k in ('timeout', 'retries', 'strikes', 'batch') 
+                                  if k in c and c[k] is not None ])
 
     fields['workers'] = workers
 
@@ -324,9 +768,7 @@ def logalyzer(session_path, outputs_dir=None):
         failures = [ job for job in jobs if job.result != 'exit 0' ]
         if outputs_dir:
             mkdir(outputs_dir.failures)
-            for job in failures:
-                fpath = join(outputs_dir.failures, job.name)
-                file(fpath, "w").write(job.output)
+            write_outputs(outputs_dir.failures, failures)
 
         rows = [ (job.name, fmt_elapsed(job.elapsed), job.result, job.worker_id)
                   for job in failures ]
@@ -344,8 +786,8 @@ def logalyzer(session_path, outputs_dir=None):
                 print >> sio, fmted_row
                 print >> sio
 
-            if failures[i].output:
-                print >> sio, indent(4, "\n".join(failures[i].output.splitlines()[-5:]))
+            if failures[i].output_tail:
+                print >> sio, indent(4, "\n".join(failures[i].output_tail.splitlines()[-5:]))
                 print >> sio
 
     if stats.succeeded:
@@ -354,9 +796,7 @@ def logalyzer(session_path, outputs_dir=None):
         completed = [ job for job in jobs if job.result == 'exit 0' ]
         if outputs_dir:
             mkdir(outputs_dir.succeeded)
-            for job in completed:
-                fpath = join(outputs_dir.succeeded, job.name)
-                file(fpath, "w").write(job.output)
+            write_outputs(outputs_dir.succeeded, completed)
         
         rows = [ (job.name, fmt_elapsed(job.elapsed), job.worker_id)
                   for job in completed ]
@@ -0,0 +1,326 @@
+#
+# Copyright (c) 2010-2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+import os
+from os.path import *
+
+import time
+import errno
+import struct
+import select
+
+import ctypes
+import ctypes.util
+
+class Inotify:
+    """Minimal inotify(7) binding"""
+
+    class Error(Exception):
+        pass
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init
+        except (OSError, AttributeError), e:
+            raise self.Error("inotify not available: " + str(e))
+
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise self.Error("inotify_init: " + os.strerror(ctypes.get_errno()))
+
+        self.libc = libc
+        self.fd = fd
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise self.Error("inotify_add_watch(%s): %s" % (path, os.strerror(ctypes.get_errno())))
+
+        self.watches[wd] = path
+        return wd
+
+    def rm_watch(self, wd):
+        if self.libc.inotify_rm_watch(self.fd, wd) < 0:
+            raise self.Error("inotify_rm_watch(%s): %s" % (self.watches.get(wd),
+                                                           os.strerror(ctypes.get_errno())))
+
+        del self.watches[wd]
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Returns list of (path, mask, name) events. Blocks if there are none."""
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return []
+            raise
+
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, size = self.EVENT_HEADER.unpack_from(buf, pos)
+            pos += self.EVENT_HEADER.size
+
+            name = buf[pos:pos + size].rstrip('\0')
+            pos += size
+
+            events.append((self.watches.get(wd), mask, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    """Watches directories for files that are created, appended to or replaced.
+
+    Uses inotify where available, otherwise polls. The first call to wait()
+    returns all the files that already exist.
+    """
+
+    MASK = Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE | Inotify.IN_CREATE | Inotify.IN_MOVED_TO
+
+    def __init__(self, dirs, poll=False):
+        self.dirs = dirs
+        self.inotify = None
+
+        if not poll:
+            try:
+                inotify = Inotify()
+            except Inotify.Error:
+                inotify = None
+
+            if inotify:
+                # e.g., we hit the limit on watches or a dir is missing
+                try:
+                    for dir in dirs:
+                        inotify.add_watch(dir, self.MASK)
+
+                    self.inotify = inotify
+                except Inotify.Error:
+                    inotify.close()
+
+        # (ino, size, mtime) of watched files and directories
+        self.stats = {}
+        self.initialized = False
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def _listdir(self, dir):
+        try:
+            return [ join(dir, fname) for fname in os.listdir(dir) ]
+        except OSError:
+            return []
+
+    def _all(self):
+        paths = []
+        for dir in self.dirs:
+            self.stats[dir] = self._stat(dir)
+            paths += self._listdir(dir)
+
+        return paths
+
+    def _poll(self):
+        """Returns files whose stat changed. A directory is only listed when
+        its own stat changes, so we don't list an unchanged directory."""
+
+        paths = set()
+        for dir in self.dirs:
+            stat = self._stat(dir)
+            if stat != self.stats.get(dir):
+                self.stats[dir] = stat
+                paths.update(self._listdir(dir))
+
+        paths.update([ path for path in self.stats if path not in self.dirs ])
+
+        changed = []
+        for path in paths:
+            stat = self._stat(path)
+            if stat is None:
+                self.stats.pop(path, None)
+                continue
+
+            if stat != self.stats.get(path):
+                self.stats[path] = stat
+                changed.append(path)
+
+        return changed
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for files to change.
+        Returns list of paths that changed."""
+
+        if not self.initialized:
+            self.initialized = True
+
+            paths = self._all()
+            if not self.inotify:
+                for path in paths:
+                    self.stats[path] = self._stat(path)
+            return paths
+
+        if not self.inotify:
+            changed = self._poll()
+            if not changed:
+                time.sleep(timeout)
+                changed = self._poll()
+
+            return changed
+
+        try:
+            readable = select.select([ self.inotify ], [], [], timeout)[0]
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+
+        if not readable:
+            return []
+
+        changed = set()
+        for dir, mask, name in self.inotify.read():
+            # we lost events, so anything could have changed
+            if mask & Inotify.IN_Q_OVERFLOW:
+                return self._all()
+
+            if dir and name:
+                changed.add(join(dir, name))
+
+        return list(changed)
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+class Tail:
+    """Incremental reader of a growing file.
+
+    read() is a generator that yields blocks of the complete lines appended
+    since the last read. The remainder of a partially written last line is
+    kept until it is completed, unless it is longer than maxline, in which
+    case we skip the rest of it. If the file is replaced or truncated we
+    call restarted() and read it again from the beginning.
+
+    If rotating, a replaced file is assumed to have been rotated (i.e.,
+    renamed) and continued in the new file, so we finish reading the old
+    file and carry on from the beginning of the new one.
+    """
+
+    BLOCKSIZE = 1024 * 1024
+    MAXLINE = 64 * 1024
+
+    def __init__(self, path, restarted=None, maxline=MAXLINE, rotating=False):
+        self.path = path
+        self.restarted = restarted
+        self.maxline = maxline
+        self.rotating = rotating
+
+        self.fh = None
+        self.ino = None
+        self.offset = 0
+        self.partial = ""
+        self.skipping = False
+
+    def _open(self, ino, rotated=False):
+        if self.fh:
+            self.fh.close()
+
+        self.fh = file(self.path, "rb")
+        self.ino = ino
+        self.offset = 0
+        if not rotated:
+            self.partial = ""
+            self.skipping = False
+
+    def read(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+
+        rotated = self.rotating and self.fh is not None and st.st_ino != self.ino
+        if rotated:
+            # whatever was written to the old file before it was rotated
+            for lines in self._read(os.fstat(self.fh.fileno()).st_size):
+                yield lines
+
+        if self.fh is None or st.st_ino != self.ino or st.st_size < self.offset:
+            try:
+                self._open(st.st_ino, rotated)
+            except IOError:
+                return
+
+            if self.restarted and not rotated:
+                self.restarted()
+
+        for lines in self._read(st.st_size):
+            yield lines
+
+    def _read(self, size):
+        self.fh.seek(self.offset)
+        while self.offset < size:
+            block = self.fh.read(min(self.BLOCKSIZE, size - self.offset))
+            if not block:
+                break
+            self.offset += len(block)
+
+            if self.skipping:
+                i = block.find("\n")
+                if i == -1:
+                    continue
+
+                block = block[i + 1:]
+                self.skipping = False
+
+            end = block.rfind("\n") + 1
+            if not end:
+                self.partial += block
+                if len(self.partial) > self.maxline:
+                    self.partial = ""
+                    self.skipping = True
+                continue
+
+            lines = self.partial + block[:end]
+            self.partial = block[end:]
+            if len(self.partial) > self.maxline:
+                self.partial = ""
+                self.skipping = True
+
+            yield lines
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
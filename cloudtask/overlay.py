@@ -0,0 +1,156 @@
+#
+# Copyright (c) 2010-2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+import os
+from os.path import *
+
+import time
+import hashlib
+import tarfile
+
+from multiprocessing import Queue, Semaphore
+from Queue import Empty
+
+from session import makedirs
+
+class Overlay:
+    """Content-addressed tarball of a worker filesystem overlay.
+
+    The tarball is named after a hash of the overlay's contents and cached,
+    so it only needs to be packed when the overlay changes. Mapping the
+    overlay's stat signature (paths, sizes, modes, mtimes) to its content
+    hash saves us from rehashing an unchanged overlay.
+    """
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, path, cache_path):
+        if not isdir(path):
+            raise self.Error("overlay path '%s' is not a directory" % path)
+
+        self.path = abspath(path)
+        self.cache_path = cache_path
+
+        makedirs(cache_path)
+
+        signature = self._signature()
+        path_signature = join(cache_path, signature + ".sig")
+
+        digest = None
+        if exists(path_signature):
+            digest = file(path_signature).read().strip()
+            if not exists(join(cache_path, digest + ".tar.gz")):
+                digest = None
+
+        if not digest:
+            digest = self._digest()
+            self._pack(join(cache_path, digest + ".tar.gz"))
+            print >> file(path_signature, "w"), digest
+
+        self.digest = digest
+        self.tarball = join(cache_path, digest + ".tar.gz")
+
+    def _walk(self):
+        """yields (relative path, path) of overlay contents in sorted order.
+
+        Like rsync -L, symlinks are followed.
+        """
+
+        for dirpath, dirnames, filenames in os.walk(self.path, followlinks=True):
+            dirnames.sort()
+            for fname in sorted(dirnames + filenames):
+                fpath = join(dirpath, fname)
+                if not exists(fpath):
+                    continue
+
+                yield fpath[len(self.path):].lstrip('/'), fpath
+
+    def _signature(self):
+        sha1 = hashlib.sha1()
+        for relpath, fpath in self._walk():
+            st = os.stat(fpath)
+            sha1.update("%s\0%o\0%d\0%d\0" % (relpath, st.st_mode, st.st_size, st.st_mtime))
+
+        return sha1.hexdigest()
+
+    def _digest(self):
+        sha1 = hashlib.sha1()
+        for relpath, fpath in self._walk():
+            st = os.stat(fpath)
+            sha1.update("%s\0%o\0" % (relpath, st.st_mode))
+
+            if isfile(fpath):
+                fh = file(fpath, "rb")
+                while True:
+                    buf = fh.read(1024 * 1024)
+                    if not buf:
+                        break
+                    sha1.update(buf)
+                fh.close()
+
+        return sha1.hexdigest()
+
+    def _pack(self, path):
+        path_tmp = path + ".tmp.%d" % os.getpid()
+
+        tar = tarfile.open(path_tmp, "w:gz", dereference=True)
+        for relpath, fpath in self._walk():
+            tar.add(fpath, arcname=relpath, recursive=False)
+        tar.close()
+
+        os.rename(path_tmp, path)
+
+    def __str__(self):
+        return "%s (%s)" % (self.path, self.digest)
+
+class Fanout:
+    """Coordinates workers seeding the overlay to each other.
+
+    At most <uploads> workers at a time get the overlay uploaded from the
+    manager. Workers that hold the overlay become seeds that upload it to
+    other workers, so the number of seeds grows exponentially while the
+    manager's uplink is spared.
+    """
+
+    def __init__(self, uploads):
+        self.seeds = Queue()
+        self.uploads = Semaphore(uploads)
+
+    def acquire(self, callback=None, seed=True):
+        """Returns the address of a seed to take the overlay from.
+
+        Returns None if we should upload from the manager, in which case the
+        caller needs to release() when finished. If not seed, we only wait
+        for our turn to upload (e.g., after failing to take the overlay
+        from a seed).
+        """
+
+        while True:
+            if seed:
+                try:
+                    return self.seeds.get(False)
+                except Empty:
+                    pass
+
+            if self.uploads.acquire(False):
+                return None
+
+            if callback:
+                callback()
+
+            time.sleep(1)
+
+    def release(self):
+        self.uploads.release()
+
+    def add_seed(self, address):
+        self.seeds.put(address)
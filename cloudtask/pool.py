@@ -0,0 +1,255 @@
+#
+# Copyright (c) 2010-2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+import os
+from os.path import *
+
+import sys
+import time
+import fcntl
+import hashlib
+import traceback
+
+from _hub import Hub
+
+class Pool:
+    """Warm pool of idle workers, parked after a session for later sessions
+    to claim instead of launching and setting up new workers.
+
+    Workers are only claimed by sessions with the same fingerprint (e.g.,
+    same Hub account, image, instance size, user, overlay, pre and post
+    commands), so a claimed worker doesn't need the overlay again. Its pre
+    command is run again, since post ran before it was parked. Workers that
+    aren't claimed within <ttl> seconds of being parked expire and are
+    destroyed by a reaper process.
+
+    The pool is a state file with a line per parked worker:
+
+        <ipaddress>\t<instanceid>\t<fingerprint>\t<expires>
+
+    Which is locked while it is read and rewritten. Each Hub account has
+    its own pool (see account), so the reaper of a pool can destroy all
+    of its workers with a single API key.
+    """
+
+    class Error(Exception):
+        pass
+
+    class Worker:
+        def __init__(self, ipaddress, instanceid, fingerprint, expires):
+            self.ipaddress = ipaddress
+            self.instanceid = instanceid
+            self.fingerprint = fingerprint
+            self.expires = expires
+
+        def __repr__(self):
+            return "Worker%s" % `self.ipaddress, self.instanceid, self.expires`
+
+    # how often the reaper checks for expired workers (at most)
+    REAP_INTERVAL = 60
+
+    @staticmethod
+    def account(hub_apikey):
+        """Returns hash of a Hub API key, which names the account's pool"""
+        return hashlib.sha1(hub_apikey or '').hexdigest()
+
+    @classmethod
+    def fingerprint(cls, taskconf, overlay=None):
+        """Returns fingerprint of the workers a session sets up"""
+
+        if overlay is None:
+            overlay = taskconf.overlay
+
+        overlay = getattr(overlay, 'digest', overlay)
+
+        vals = [ cls.account(taskconf.hub_apikey),
+                 taskconf.backup_id, taskconf.ami_id, taskconf.snapshot_id,
+                 taskconf.ec2_region, taskconf.ec2_size, taskconf.ec2_type,
+                 taskconf.user, overlay, taskconf.pre, taskconf.post ]
+
+        return hashlib.sha1(repr(vals)).hexdigest()
+
+    def __init__(self, path, fingerprint=None, ttl=0):
+        """fingerprint and ttl are of the workers we park and claim"""
+        self.path = path
+        self.fingerprint = fingerprint
+        self.ttl = ttl
+
+    def _lock(self):
+        fh = file(self.path + ".lock", "a")
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        return fh
+
+    def _read(self):
+        workers = []
+        if not exists(self.path):
+            return workers
+
+        for line in file(self.path):
+            vals = line.rstrip("\n").split("\t")
+            if len(vals) != 4:
+                continue
+
+            ipaddress, instanceid, fingerprint, expires = vals
+            try:
+                workers.append(self.Worker(ipaddress, instanceid, fingerprint, float(expires)))
+            except ValueError:
+                continue
+
+        return workers
+
+    def _write(self, workers):
+        path_tmp = self.path + ".tmp"
+
+        fh = file(path_tmp, "w")
+        for worker in workers:
+            print >> fh, "%s\t%s\t%s\t%.3f" % (worker.ipaddress, worker.instanceid,
+                                                worker.fingerprint, worker.expires)
+        fh.close()
+
+        os.rename(path_tmp, self.path)
+
+    def workers(self):
+        """Returns workers parked in the pool"""
+        lock = self._lock()
+        try:
+            return self._read()
+        finally:
+            lock.close()
+
+    def park(self, ipaddress, instanceid):
+        """Parks a worker. Returns False if we don't park workers (ttl 0)"""
+
+        if not self.ttl or not self.fingerprint:
+            return False
+
+        lock = self._lock()
+        try:
+            workers = [ worker for worker in self._read()
+                        if worker.ipaddress != ipaddress ]
+            workers.append(self.Worker(ipaddress, instanceid, self.fingerprint,
+                                       time.time() + self.ttl))
+            self._write(workers)
+        finally:
+            lock.close()
+
+        return True
+
+    def claim(self, howmany):
+        """Claims up to <howmany> parked workers with our fingerprint that
+        haven't expired. Returns list of (ipaddress, instanceid)"""
+
+        if not self.fingerprint or howmany < 1 or not exists(self.path):
+            return []
+
+        lock = self._lock()
+        try:
+            now = time.time()
+
+            claimed = []
+            workers = []
+            for worker in self._read():
+                if len(claimed) < howmany and \
+                   worker.fingerprint == self.fingerprint and worker.expires > now:
+                    claimed.append((worker.ipaddress, worker.instanceid))
+                else:
+                    workers.append(worker)
+
+            if claimed:
+                self._write(workers)
+        finally:
+            lock.close()
+
+        return claimed
+
+    def reap(self, hub, logfh=None):
+        """Destroys expired workers. Returns instanceids destroyed"""
+
+        now = time.time()
+        expired = [ worker for worker in self.workers() if worker.expires <= now ]
+        if not expired:
+            return []
+
+        # workers stay in the pool until they're destroyed, so if we fail
+        # we'll try again. Claiming skips expired workers.
+        destroyed = [ instanceid for ipaddress, instanceid
+                      in hub.destroy(*[ worker.instanceid for worker in expired ]) ]
+
+        lock = self._lock()
+        try:
+            self._write([ worker for worker in self._read()
+                          if worker.instanceid not in destroyed ])
+        finally:
+            lock.close()
+
+        if logfh and destroyed:
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+            print >> logfh, "%s :: destroyed expired workers: %s" % (timestamp, " ".join(sorted(destroyed)))
+            logfh.flush()
+
+        return destroyed
+
+    def reaper(self, hub_apikey):
+        """Starts a detached reaper process that destroys parked workers as
+        they expire, and exits when the pool is empty. If a reaper is
+        already running, the new one exits right away.
+
+        hub_apikey is of the account the pool belongs to (see account)"""
+
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+
+            reaper_lock = file(self.path + ".reaper", "a")
+            try:
+                fcntl.flock(reaper_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os._exit(0)
+
+            null = os.open("/dev/null", os.O_RDWR)
+            os.dup2(null, 0)
+
+            logfh = file(self.path + ".log", "a")
+            os.dup2(logfh.fileno(), 1)
+            os.dup2(logfh.fileno(), 2)
+
+            hub = Hub(hub_apikey)
+            while True:
+                try:
+                    self.reap(hub, logfh)
+                except Exception:
+                    traceback.print_exc(file=logfh)
+
+                lock = self._lock()
+                try:
+                    workers = self._read()
+
+                    # released while the pool is locked, so a worker parked
+                    # after we looked starts a new reaper
+                    if not workers:
+                        reaper_lock.close()
+                        break
+                finally:
+                    lock.close()
+
+                expires = min([ worker.expires for worker in workers ])
+                time.sleep(min(self.REAP_INTERVAL, max(1, expires - time.time())))
+
+        except:
+            traceback.print_exc(file=sys.stderr)
+
+        os._exit(0)
@@ -0,0 +1,174 @@
+#
+# Copyright (c) 2010-2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import signal
+import select
+import subprocess
+
+class Timer:
+    def __init__(self, reactor, seconds, callback):
+        self.reactor = reactor
+        self.seconds = seconds
+        self.callback = callback
+        self.cancelled = False
+
+        self.reset()
+
+    def reset(self):
+        """restart countdown"""
+        self.deadline = time.time() + self.seconds
+        self.reactor._schedule(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+class Process:
+    """Child process whose output is read by the reactor.
+
+    output(buf) is called with output as it arrives.
+    exited(exitcode) is called after the process exits.
+    """
+
+    REAP_INTERVAL = 0.05
+
+    def __init__(self, reactor, argv, output=None, exited=None, pty=False):
+        self.reactor = reactor
+        self.output = output
+        self.exited = exited
+
+        if pty:
+            fd, child_fd = os.openpty()
+            stdin = child_fd
+        else:
+            fd, child_fd = os.pipe()
+            stdin = file(os.devnull)
+
+        try:
+            self.popen = subprocess.Popen(argv,
+                                          stdin=stdin, stdout=child_fd, stderr=child_fd,
+                                          close_fds=True, preexec_fn=os.setpgrp)
+        finally:
+            os.close(child_fd)
+
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.fd = fd
+        reactor.add_reader(fd, self._read)
+
+    @property
+    def pid(self):
+        return self.popen.pid
+
+    def _read(self):
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+
+            # reading a pty whose other side was closed raises EIO
+            if e.errno != errno.EIO:
+                raise
+
+            buf = ""
+
+        if buf:
+            if self.output:
+                self.output(buf)
+            return
+
+        self.reactor.remove_reader(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+        self._reap()
+
+    def _reap(self):
+        if self.popen.poll() is None:
+            self.reactor.call_later(self.REAP_INTERVAL, self._reap)
+            return
+
+        if self.exited:
+            self.exited(self.popen.returncode)
+
+    def terminate(self, sig=signal.SIGTERM):
+        try:
+            os.killpg(self.popen.pid, sig)
+        except OSError:
+            pass
+
+class Reactor:
+    """Single threaded event loop multiplexing many file descriptors and timers.
+
+    Timers are kept in a heap. A reset or cancelled timer leaves a stale
+    entry behind in the heap which is ignored when it comes up.
+    """
+
+    def __init__(self):
+        self.poll = select.poll()
+        self.readers = {}
+        self.timers = []
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+        self.poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def remove_reader(self, fd):
+        if fd in self.readers:
+            del self.readers[fd]
+            self.poll.unregister(fd)
+
+    def _schedule(self, timer):
+        heapq.heappush(self.timers, (timer.deadline, id(timer), timer))
+
+    def call_later(self, seconds, callback):
+        return Timer(self, seconds, callback)
+
+    def spawn(self, argv, output=None, exited=None, pty=False):
+        return Process(self, argv, output, exited, pty)
+
+    def _run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, _, timer = heapq.heappop(self.timers)
+            if timer.cancelled or timer.deadline != deadline:
+                continue
+
+            timer.cancelled = True
+            timer.callback()
+
+    def run_once(self, timeout=None):
+        """Wait up to timeout seconds for events and dispatch them"""
+        self._run_timers()
+
+        if self.timers:
+            next_deadline = self.timers[0][0] - time.time()
+            if timeout is None or next_deadline < timeout:
+                timeout = max(0, next_deadline)
+
+        try:
+            events = self.poll.poll(None if timeout is None else int(timeout * 1000))
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            events = []
+
+        for fd, event in events:
+            callback = self.readers.get(fd)
+            if callback:
+                callback()
+
+        self._run_timers()
@@ -100,8 +100,10 @@ class MailHandler:
     def __call__(self, session):
         taskconf = session.taskconf
 
-        jobs_total = len(session.jobs.pending) + len(session.jobs.finished)
-        jobs_completed = len([ job for job, result in session.jobs.finished if result=="EXIT=0" ])
+        counts = session.jobs.counts
+
+        jobs_total = sum(counts.values())
+        jobs_completed = counts.get("EXIT=0", 0)
         jobs_incomplete = jobs_total - jobs_completed
 
         command = re.sub(r'^\S*/', '', taskconf['command'])
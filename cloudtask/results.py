@@ -0,0 +1,425 @@
+#
+# Copyright (c) 2010-2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+import os
+from os.path import *
+
+import time
+import fcntl
+import itertools
+from array import array
+
+import paths
+from session import Session, makedirs
+
+class Results:
+    """Columnar store of job results across sessions.
+
+    Every job a session ran is a row. Each column is a file of native
+    machine values (see the array module), so a column is loaded with a
+    single read, or can be memory mapped by other tools (e.g., numpy.memmap)
+    without parsing anything.
+
+    Job names and task commands are stored once in the names file (one per
+    line) and referenced by their line number.
+
+    Sessions are exported as a whole once they have no pending jobs. For
+    every exported session the exported file records:
+
+        <session id> <rows> <names> <command>
+
+    Where rows and names are the number of rows and names after it was
+    exported. Anything past what the last exported session accounts for
+    (e.g., after a crash) is ignored and truncated on the next export.
+    """
+
+    class Error(Exception):
+        pass
+
+    class Paths(paths.Paths):
+        files = ['exported', 'names', 'lock',
+                 'session', 'job', 'worker', 'exitcode', 'elapsed', 'started']
+
+    COLUMNS = (('session', 'i'),
+               ('job', 'i'),
+               ('worker', 'l'),
+               ('exitcode', 'h'),
+               ('elapsed', 'i'),
+               ('started', 'l'))
+
+    EXPORTED = 'l'
+    EXPORTED_FIELDS = 4
+
+    # exit codes of jobs that didn't exit
+    TIMEOUT = -1
+    ABORTED = -2
+
+    class Table:
+        """Exported results, one array per column"""
+
+        class Session:
+            def __init__(self, id, command, start, end):
+                self.id = id
+                self.command = command
+                self.start = start
+                self.end = end
+
+            def __len__(self):
+                return self.end - self.start
+
+            def __repr__(self):
+                return "Session%s" % `self.id, self.command, self.start, self.end`
+
+        def __init__(self, sessions, columns, names):
+            self.sessions = sessions
+            self.names = names
+
+            for name, column in columns.items():
+                setattr(self, name, column)
+
+        def __len__(self):
+            return len(self.session)
+
+        def select(self, command=None, last=None):
+            """Returns exported sessions of <command> (or any command),
+            ordered by id. If last is set, only the <last> most recent."""
+
+            sessions = [ session for session in self.sessions
+                         if command is None or self.names[session.command] == command ]
+            sessions.sort(key=lambda session: session.id)
+
+            if last:
+                sessions = sessions[-last:]
+
+            return sessions
+
+        def rows(self, sessions, *columns):
+            """Iterates over (session, values of columns...) of sessions"""
+
+            columns = [ getattr(self, column) for column in columns ]
+            for session in sessions:
+                values = [ column[session.start:session.end] for column in columns ]
+                for row in itertools.izip(*values):
+                    yield (session,) + row
+
+        def summary(self, sessions):
+            """Returns (session, started, jobs, failed, worktime) rows"""
+
+            rows = []
+            for session in sessions:
+                exitcodes = self.exitcode[session.start:session.end]
+                started = self.started[session.start:session.end]
+
+                rows.append((session,
+                             min(started) if started else None,
+                             len(session),
+                             len(exitcodes) - exitcodes.count(0),
+                             sum(self.elapsed[session.start:session.end])))
+
+            return rows
+
+        def slower(self, sessions, recent):
+            """Compares how long jobs took to succeed in the <recent> most
+            recent sessions with how long they took before. Returns
+            (job, runs before, average before, runs recently, average
+            recently) rows of jobs that got slower, slowest first."""
+
+            recent = set([ session.id for session in sessions[-recent:] ])
+
+            before = {}
+            after = {}
+            for session, job, exitcode, elapsed in self.rows(sessions, 'job', 'exitcode', 'elapsed'):
+                if exitcode != 0:
+                    continue
+
+                totals = after if session.id in recent else before
+                key = (session.command, job)
+
+                total = totals.get(key)
+                if total:
+                    total[0] += 1
+                    total[1] += elapsed
+                else:
+                    totals[key] = [ 1, elapsed ]
+
+            rows = []
+            for key, (runs_after, elapsed_after) in after.iteritems():
+                if key not in before:
+                    continue
+
+                runs_before, elapsed_before = before[key]
+                avg_before = float(elapsed_before) / runs_before
+                avg_after = float(elapsed_after) / runs_after
+
+                if avg_after > avg_before:
+                    rows.append((self.job_name(*key), runs_before, avg_before, runs_after, avg_after))
+
+            rows.sort(key=lambda row: (row[2] - row[4], row[0]))
+            return rows
+
+        def flaky(self, sessions):
+            """Returns (job, runs, failures, last failed session) rows of
+            jobs that both succeeded and failed, most failures first."""
+
+            jobs = {}
+            for session, job, exitcode in self.rows(sessions, 'job', 'exitcode'):
+                key = (session.command, job)
+
+                stats = jobs.get(key)
+                if not stats:
+                    stats = jobs[key] = [ 0, 0, None ]
+
+                stats[0] += 1
+                if exitcode != 0:
+                    stats[1] += 1
+                    stats[2] = session.id
+
+            rows = [ (self.job_name(*key), runs, failures, last_failed)
+                     for key, (runs, failures, last_failed) in jobs.iteritems()
+                     if 0 < failures < runs ]
+
+            rows.sort(key=lambda row: (-row[2], row[0]))
+            return rows
+
+        def history(self, sessions, name):
+            """Returns (session, worker, exitcode, started, elapsed) rows of
+            job <name>, which may include the command (e.g., "cmd arg")"""
+
+            ids = dict([ (job, id) for id, job in enumerate(self.names) ])
+
+            rows = []
+            for session in sessions:
+                command = self.names[session.command]
+
+                if name.startswith(command + " "):
+                    job = ids.get(name[len(command) + 1:])
+                else:
+                    job = ids.get(name)
+
+                if job is None:
+                    continue
+
+                for row in self.rows([ session ], 'job', 'worker', 'exitcode', 'started', 'elapsed'):
+                    if row[1] == job:
+                        rows.append((session,) + row[2:])
+
+            return rows
+
+        def job_name(self, command, job):
+            return "%s %s" % (self.names[command], self.names[job])
+
+    @classmethod
+    def exitcode(cls, result):
+        """Converts a job result (e.g., 'exit 0') to an exit code"""
+
+        if result.startswith('exit '):
+            try:
+                return int(result[len('exit '):])
+            except ValueError:
+                pass
+
+        if result == 'timeout':
+            return cls.TIMEOUT
+
+        return cls.ABORTED
+
+    @staticmethod
+    def session_finished(session_paths):
+        """Returns command of a session that has no pending jobs, or None"""
+
+        if not exists(session_paths.conf) or not exists(session_paths.jobs):
+            return None
+
+        counts = Session.Jobs(session_paths.jobs).counts
+        if not counts or counts.get(Session.Jobs.PENDING):
+            return None
+
+        try:
+            conf = eval(file(session_paths.conf).read())
+        except Exception:
+            return None
+
+        return conf.get('command')
+
+    def __init__(self, path):
+        self.path = path
+        self.paths = self.Paths(path)
+
+    def _read_exported(self):
+        exported = array(self.EXPORTED)
+        if exists(self.paths.exported):
+            fh = file(self.paths.exported, "rb")
+            size = getsize(self.paths.exported)
+            count = size / exported.itemsize
+            exported.fromfile(fh, count - count % self.EXPORTED_FIELDS)
+            fh.close()
+
+        return [ tuple(exported[i:i + self.EXPORTED_FIELDS])
+                 for i in range(0, len(exported), self.EXPORTED_FIELDS) ]
+
+    def _read_names(self, count):
+        names = []
+        if count:
+            fh = file(self.paths.names)
+            names = [ line[:-1] for line in itertools.islice(fh, count) ]
+            fh.close()
+
+        if len(names) != count:
+            raise self.Error("names file is shorter than exported (%d < %d)" % (len(names), count))
+
+        return names
+
+    def exported(self):
+        """Returns ids of exported sessions"""
+        return [ record[0] for record in self._read_exported() ]
+
+    def load(self):
+        """Returns a Table of the exported results"""
+
+        exported = self._read_exported()
+
+        sessions = []
+        start = 0
+        for id, end, names, command in exported:
+            sessions.append(self.Table.Session(id, command, start, end))
+            start = end
+
+        rows = exported[-1][1] if exported else 0
+
+        columns = {}
+        for name, typecode in self.COLUMNS:
+            column = array(typecode)
+            if rows:
+                fh = file(getattr(self.paths, name), "rb")
+                try:
+                    column.fromfile(fh, rows)
+                except EOFError:
+                    raise self.Error("%s column is shorter than exported (%d rows)" % (name, rows))
+                fh.close()
+
+            columns[name] = column
+
+        names = self._read_names(exported[-1][2] if exported else 0)
+        return self.Table(sessions, columns, names)
+
+    def _lock(self):
+        makedirs(self.path)
+
+        fh = file(self.paths.lock, "w")
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        return fh
+
+    @staticmethod
+    def _truncate(path, size):
+        if exists(path) and getsize(path) > size:
+            fh = file(path, "r+b")
+            fh.truncate(size)
+            fh.close()
+
+    def _export(self, session_id, command, jobs):
+        exported = self._read_exported()
+        if session_id in [ record[0] for record in exported ]:
+            return False
+
+        rows = exported[-1][1] if exported else 0
+        names = self._read_names(exported[-1][2] if exported else 0)
+        names_size = sum([ len(name) + 1 for name in names ])
+
+        # discard whatever an interrupted export left behind
+        self._truncate(self.paths.exported,
+                       len(exported) * self.EXPORTED_FIELDS * array(self.EXPORTED).itemsize)
+        self._truncate(self.paths.names, names_size)
+        for name, typecode in self.COLUMNS:
+            self._truncate(getattr(self.paths, name), rows * array(typecode).itemsize)
+
+        ids = dict([ (name, id) for id, name in enumerate(names) ])
+        new_names = []
+
+        def name_id(name):
+            name = name.replace("\n", " ")
+            if name not in ids:
+                ids[name] = len(names) + len(new_names)
+                new_names.append(name)
+            return ids[name]
+
+        command_id = name_id(command)
+
+        columns = dict([ (name, array(typecode)) for name, typecode in self.COLUMNS ])
+        for job in jobs:
+            columns['session'].append(session_id)
+            columns['job'].append(name_id(job.name))
+            columns['worker'].append(job.worker_id)
+            columns['exitcode'].append(self.exitcode(job.result))
+            columns['elapsed'].append(job.elapsed)
+            columns['started'].append(int(time.mktime(job.timestamp.timetuple())))
+
+        def append(path, write):
+            fh = file(path, "ab")
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+            fh.close()
+
+        append(self.paths.names,
+               lambda fh: fh.write("".join([ name + "\n" for name in new_names ])))
+
+        for name, typecode in self.COLUMNS:
+            append(getattr(self.paths, name), columns[name].tofile)
+
+        record = array(self.EXPORTED, [ session_id,
+                                        rows + len(columns['session']),
+                                        len(names) + len(new_names),
+                                        command_id ])
+        append(self.paths.exported, record.tofile)
+
+        return True
+
+    def export(self, session_path):
+        """Exports a finished session's jobs. Returns True if exported,
+        False if the session isn't finished or was already exported."""
+
+        # imported here because logalyzer depends on ec2cost
+        from logalyzer import WorkersLog
+
+        session_paths = Session.Paths(session_path)
+        session_id = int(basename(abspath(session_path)))
+
+        command = self.session_finished(session_paths)
+        if command is None:
+            return False
+
+        lock = self._lock()
+        try:
+            if session_id in self.exported():
+                return False
+
+            if isdir(session_paths.workers):
+                jobs = WorkersLog(session_paths.workers, command,
+                                  index=session_paths.workers + ".index",
+                                  events=session_paths.events).jobs
+            else:
+                jobs = []
+
+            jobs.sort(key=lambda job: (job.timestamp, job.name))
+            return self._export(session_id, command, jobs)
+        finally:
+            lock.close()
+
+    def update(self, sessions_path):
+        """Exports finished sessions that haven't been exported yet.
+        Returns ids of the sessions exported."""
+
+        exported = set(self.exported())
+        ids = sorted([ int(fname) for fname in os.listdir(sessions_path)
+                       if fname.isdigit() and int(fname) not in exported ])
+
+        return [ id for id in ids
+                 if self.export(join(sessions_path, str(id))) ]
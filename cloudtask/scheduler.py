@@ -0,0 +1,132 @@
+#
+# Copyright (c) 2010-2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+from os.path import *
+
+import heapq
+import itertools
+
+from session import Session
+
+class Durations:
+    """Job durations recorded in the worker logs of previous sessions.
+
+    Maps job commands to how many seconds they took the last time they
+    were executed by one of the <history> most recent sessions of the same
+    command (other than session <exclude>, e.g., the current session).
+    Sessions are looked up in the session catalog, so sessions created by
+    older versions are only learned from once they are added to it (see
+    cloudtask-sessions --scan).
+    """
+
+    # how many of the most recent sessions we learn from
+    HISTORY = 10
+
+    @staticmethod
+    def _matches(record, command):
+        # commands that don't fit a catalog record are truncated
+        if record.command.endswith("...") and record.command != command:
+            return command.startswith(record.command[:-3])
+
+        return record.command == command
+
+    def __init__(self, sessions_path, command, history=HISTORY, exclude=None):
+        # imported here because logalyzer depends on ec2cost
+        from logalyzer import WorkersLog
+
+        self.durations = {}
+
+        catalog = Session.Catalog(join(sessions_path, 'catalog'))
+
+        sessions = []
+        for record in reversed(catalog.records()):
+            if len(sessions) == history:
+                break
+
+            if record.id == exclude or not self._matches(record, command):
+                continue
+
+            paths = Session.Paths(join(sessions_path, str(record.id)))
+            if not exists(paths.conf) or not isdir(paths.workers):
+                continue
+
+            try:
+                conf = eval(file(paths.conf).read())
+            except Exception:
+                continue
+
+            if conf.get('command') != command:
+                continue
+
+            sessions.append(paths)
+
+        # most recent durations win
+        for paths in reversed(sessions):
+            for job in WorkersLog(paths.workers, command,
+                                  index=paths.workers + ".index",
+                                  events=paths.events).jobs:
+                self.durations["%s %s" % (command, job.name)] = job.elapsed
+
+    def get(self, job, default=None):
+        return self.durations.get(job, default)
+
+    def __len__(self):
+        return len(self.durations)
+
+class Scheduler:
+    """Orders jobs longest first.
+
+    Jobs are streamed, so they are ordered within windows of <window> jobs.
+    estimate(job) returns the expected duration of a job, or None if it is
+    unknown, in which case we guess the job takes the average of the known
+    durations in its window. Jobs with the same estimate keep their order.
+    """
+
+    def __init__(self, estimate, window):
+        self.estimate = estimate
+        self.window = window
+
+    def order(self, jobs):
+        estimates = [ self.estimate(job) for job in jobs ]
+
+        known = [ estimate for estimate in estimates if estimate is not None ]
+        if not known:
+            return list(jobs)
+
+        default = sum(known) / float(len(known))
+
+        decorated = [ (-(estimate if estimate is not None else default), i, job)
+                      for i, (estimate, job) in enumerate(zip(estimates, jobs)) ]
+        decorated.sort()
+
+        return [ job for estimate, i, job in decorated ]
+
+    def __call__(self, jobs):
+        """Generator that yields jobs in scheduled order"""
+
+        jobs = iter(jobs)
+        while True:
+            window = list(itertools.islice(jobs, self.window))
+            if not window:
+                break
+
+            for job in self.order(window):
+                yield job
+
+def simulate(durations, workers):
+    """Replays job durations (in dispatch order) on workers that take the
+    next job as soon as they are idle. Returns the makespan."""
+
+    idle = [ 0 ] * workers
+    for duration in durations:
+        heapq.heappush(idle, heapq.heappop(idle) + duration)
+
+    return max(idle)
@@ -12,14 +12,22 @@
 import os
 from os.path import *
 import sys
+import time
 
 import paths
 import errno
 
 from taskconf import TaskConf
 import pprint
+import copy
 
 import re
+import gzip
+import zlib
+import struct
+import fcntl
+import tempfile
+import threading
 
 def makedirs(path, mode=0750):
     try:
@@ -36,82 +44,763 @@ class Session(object):
         pass
 
     class Paths(paths.Paths):
-        files = ['conf', 'workers', 'log', 'jobs']
+        files = ['conf', 'workers', 'log', 'jobs', 'events']
 
     class Jobs:
-        def __init__(self, path):
-            self.pending = []
-            self.finished = []
+        """Append-only journal of job states.
+
+        Every state transition is appended to the journal as a line:
+
+            <state>\t<command>
+
+        Where state is PENDING, TIMEOUT or EXIT=<exitcode>. Replaying the
+        journal, the last recorded state of a job wins and jobs keep the order
+        in which they were first recorded. The old jobs file format (one line
+        per job) is just a compacted journal.
+
+        A partially written last line (e.g., after a crash) is ignored until
+        repair() truncates it.
+
+        Worker processes record job results in the journal as they finish.
+        If sync is set, the journal is fsync'ed every <sync> records.
+
+        The index (<path>.index) caches the number of jobs in each state and
+        the journal size it is valid for, so we don't need to replay the
+        journal just to count jobs.
+        """
+
+        PENDING = "PENDING"
+
+        # compact() when the journal has more than this many records per job
+        COMPACT_RATIO = 2
+
+        def __init__(self, path, sync=None):
             self.path = path
+            self.path_index = path + ".index"
+            self.sync = sync
+
+            self._fh = None
+            self._fh_pid = None
+            self._unsynced = 0
+
+            self._states = None
+            self._order = None
+            self._records = 0
+            self._cache = {}
 
-            if not exists(path):
+        def _load(self):
+            if self._states is not None:
                 return
 
-            for line in file(path).readlines():
-                line = line.strip()
-                state, command = line.split('\t', 1)
-                if state == "PENDING":
-                    self.pending.append(command)
+            states = {}
+            order = []
+            records = 0
+
+            if exists(self.path):
+                for line in file(self.path):
+                    if not line.endswith("\n"):
+                        break
+
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    state, command = line.split('\t', 1)
+                    if command not in states:
+                        order.append(command)
+                    states[command] = state
+                    records += 1
+
+            self._states = states
+            self._order = order
+            self._records = records
+            self._cache = {}
+
+        def repair(self):
+            """truncate partially written last line"""
+            if not exists(self.path):
+                return
+
+            size = getsize(self.path)
+            if not size:
+                return
+
+            fh = file(self.path, "r+")
+            offset = size
+            while offset > 0:
+                chunk_size = min(offset, 4096)
+                fh.seek(offset - chunk_size)
+                chunk = fh.read(chunk_size)
+
+                if offset == size and chunk.endswith("\n"):
+                    break
+
+                i = chunk.rfind("\n")
+                if i != -1:
+                    fh.truncate(offset - chunk_size + i + 1)
+                    break
+
+                offset -= chunk_size
+            else:
+                fh.truncate(0)
+
+            fh.close()
+            self.reload()
+
+        def _append(self, records):
+            if self._fh is None or self._fh_pid != os.getpid():
+                self._fh = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+                self._fh_pid = os.getpid()
+
+            # one write per record so concurrent appends don't interleave
+            for state, command in records:
+                os.write(self._fh, "%s\t%s\n" % (state, command))
+
+                if self._states is not None:
+                    if command not in self._states:
+                        self._order.append(command)
+                    self._states[command] = state
+
+                self._records += 1
+
+            self._cache = {}
+
+            if self.sync:
+                self._unsynced += len(records)
+                if self._unsynced >= self.sync:
+                    self.flush()
+
+        def flush(self):
+            """fsync records appended by this process"""
+            if self._unsynced and self._fh is not None and self._fh_pid == os.getpid():
+                os.fsync(self._fh)
+            self._unsynced = 0
+
+        def reload(self):
+            """forget loaded state (e.g., other processes appended records)"""
+            self._states = None
+            self._cache = {}
+
+        def record(self, command, state):
+            self._append([ (state, command) ])
+
+        @staticmethod
+        def result_state(result):
+            if result is None:
+                return "TIMEOUT"
+
+            return "EXIT=%s" % result
+
+        def record_result(self, command, result):
+            self.record(command, self.result_state(result))
+
+        def _select(self, pending):
+            key = 'pending' if pending else 'finished'
+            if key not in self._cache:
+                self._load()
+
+                states = self._states
+                if pending:
+                    val = [ command for command in self._order
+                            if states[command] == self.PENDING ]
                 else:
-                    self.finished.append((command, state))
+                    val = [ (command, states[command]) for command in self._order
+                            if states[command] != self.PENDING ]
+
+                self._cache[key] = val
+
+            return self._cache[key]
+
+        @property
+        def pending(self):
+            return self._select(True)
+
+        @property
+        def finished(self):
+            return self._select(False)
+
+        @property
+        def commands(self):
+            """all jobs, in the order they were first recorded"""
+            self._load()
+            return list(self._order)
+
+        def _read_index(self):
+            if not exists(self.path_index) or not exists(self.path):
+                return None
+
+            try:
+                index = eval(file(self.path_index).read())
+            except Exception:
+                return None
+
+            if index.get('size') != getsize(self.path):
+                return None
+
+            return index
+
+        @property
+        def counts(self):
+            """Returns dict of state -> number of jobs"""
+
+            if self._states is None:
+                index = self._read_index()
+                if index:
+                    return index['counts']
+
+            self._load()
+
+            counts = {}
+            for state in self._states.itervalues():
+                counts[state] = counts.get(state, 0) + 1
+
+            return counts
 
         def save(self):
-            fh = file(self.path, "w")
+            """write index of current journal"""
+            if not exists(self.path):
+                return
 
-            for job, result in self.finished:
-                print >> fh, "%s\t%s" % (result, job)
+            index = {'size': getsize(self.path),
+                     'counts': self.counts}
 
-            for job in self.pending:
-                print >> fh, "PENDING\t%s" % job
+            path_tmp = self.path_index + ".tmp"
+            print >> file(path_tmp, "w"), pprint.pformat(index)
+            os.rename(path_tmp, self.path_index)
 
+        @property
+        def fragmented(self):
+            self._load()
+            return self._records > len(self._order) * self.COMPACT_RATIO
+
+        def compact(self):
+            """Rewrite the journal with a single record per job"""
+            self._load()
+
+            path_tmp = self.path + ".tmp"
+            fh = file(path_tmp, "w")
+            for command in self._order:
+                fh.write("%s\t%s\n" % (self._states[command], command))
+
+            fh.flush()
+            os.fsync(fh.fileno())
             fh.close()
 
+            os.rename(path_tmp, self.path)
+
+            if self._fh is not None and self._fh_pid == os.getpid():
+                os.close(self._fh)
+            self._fh = None
+
+            self._records = len(self._order)
+            self.save()
+
+        def add(self, jobs):
+            """Generator that records jobs as pending as they are consumed"""
+            for job in jobs:
+                self.record(job, self.PENDING)
+                yield job
+
         def update(self, jobs=[], results=[]):
-            for job, result in results:
-                if result is None:
-                    state = "TIMEOUT"
-                else:
-                    state = "EXIT=%s" % result
+            self._load()
 
-                self.finished.append((job, state))
+            records = [ (self.PENDING, job) for job in jobs
+                        if self._states.get(job) != self.PENDING ]
 
-            self.pending = list((set(self.pending) | set(jobs)) - \
-                                 set([ job for job, result in results ]))
+            for job, result in results:
+                records.append((self.result_state(result), job))
 
+            self._append(records)
             self.save()
 
         def update_retry_failed(self):
-            finished = set(self.finished)
-            failed = set([(job, result) for job, result in finished if result != 'EXIT=0'])
-            ok = finished - failed
+            self._append([ (self.PENDING, job) for job, result in self.finished
+                           if result != 'EXIT=0' ])
+            self.save()
 
-            self.finished = list(ok)
-            self.pending += [ job for job, result in failed ]
+    class Events:
+        """Append-only stream of worker events, recorded along with the
+        status lines of the worker logs. Every event is a line:
 
-            self.save()
+            <timestamp>\t<worker_id>\t<type>\t<field>...
+
+        Where the fields of each type of event are listed in FIELDS. Only
+        the last field (e.g., a job's command) may contain tabs. Offsets
+        are of a job's output in its worker log, including rotated segments
+        (see Logs.WorkerReader).
+
+        Analyzing a session from its events doesn't require scanning the
+        worker logs. A partially written last line is ignored.
+        """
+
+        FIELDS = {
+            'launch': [ ('instanceid', str), ('ipaddress', str) ],
+            'setup': [ ('ipaddress', str), ('elapsed', float), ('stages', str) ],
+            'start': [ ('output_start', int), ('command', str) ],
+            'end': [ ('started', float), ('result', str),
+                     ('output_start', int), ('output_end', int), ('command', str) ],
+            'retry': [ ('retry', int), ('limit', int), ('command', str) ],
+            'destroy': [ ('instanceid', str) ],
+            'claim': [ ('instanceid', str), ('ipaddress', str) ],
+            'park': [ ('instanceid', str) ]
+        }
+
+        class Event:
+            def __init__(self, timestamp, worker_id, type, fields):
+                self.timestamp = timestamp
+                self.worker_id = worker_id
+                self.type = type
+
+                for name, val in fields:
+                    setattr(self, name, val)
+
+            def __repr__(self):
+                return "Event%s" % `self.timestamp, self.worker_id, self.type`
+
+        def __init__(self, path):
+            self.path = path
+
+            self._fh = None
+            self._fh_pid = None
+
+        def record(self, timestamp, worker_id, type, *fields):
+            if self._fh is None or self._fh_pid != os.getpid():
+                self._fh = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+                self._fh_pid = os.getpid()
+
+            fields = [ re.sub(r'[\t\n]', ' ', str(field)) for field in fields[:-1] ] + \
+                     [ str(fields[-1]).replace("\n", " ") ] if fields else []
+
+            # one write per event so concurrent appends don't interleave
+            os.write(self._fh, "\t".join([ "%.3f" % timestamp, str(worker_id), type ] + fields) + "\n")
+
+        def __iter__(self):
+            if not exists(self.path):
+                return
+
+            for line in file(self.path):
+                if not line.endswith("\n"):
+                    break
+
+                vals = line[:-1].split('\t', 3)
+                if len(vals) != 4 or vals[2] not in self.FIELDS:
+                    continue
+
+                timestamp, worker_id, type, vals = vals
+                fields = self.FIELDS[type]
+
+                vals = vals.split('\t', len(fields) - 1)
+                if len(vals) != len(fields):
+                    continue
+
+                yield self.Event(float(timestamp), int(worker_id), type,
+                                 [ (name, conv(val)) for (name, conv), val in zip(fields, vals) ])
+
+        def close(self):
+            if self._fh is not None and self._fh_pid == os.getpid():
+                os.close(self._fh)
+            self._fh = None
+
+    class Catalog:
+        """Catalog of sessions, so sessions can be looked up and listed
+        without scanning the sessions path. Every session has a fixed size
+        record at offset (id - 1) * RECORD_SIZE, a line of tab separated
+        FIELDS padded with spaces:
+
+            <id>\t<status>\t<started>\t<ended>\t<pid>\t<jobs>\t<ok>\t<failed>\t<pending>\t<command>
+
+        Where status is running, done (all jobs succeeded), failed (some
+        jobs failed) or stopped (some jobs are pending). Commands that don't
+        fit the record are truncated. Sessions only write their own record,
+        so sessions don't need to lock the catalog to update it.
+        """
+
+        RECORD_SIZE = 256
+
+        FIELDS = [ ('id', int), ('status', str), ('started', int), ('ended', int),
+                   ('pid', int), ('jobs', int), ('ok', int), ('failed', int),
+                   ('pending', int), ('command', str) ]
+
+        STATUSES = ('running', 'done', 'failed', 'stopped')
+
+        class Record:
+            def __init__(self, **fields):
+                for name, conv in Session.Catalog.FIELDS:
+                    setattr(self, name, fields.get(name, conv()))
+
+            def __repr__(self):
+                return "Record%s" % `self.id, self.status, self.command`
+
+        def __init__(self, path):
+            self.path = path
+
+        @classmethod
+        def _format(cls, record):
+            vals = [ str(getattr(record, name)) for name, conv in cls.FIELDS ]
+            vals = [ re.sub(r'[\t\n]', ' ', val) for val in vals ]
+
+            line = "\t".join(vals)
+            if len(line) > cls.RECORD_SIZE - 1:
+                line = line[:cls.RECORD_SIZE - 4] + "..."
+
+            return line.ljust(cls.RECORD_SIZE - 1) + "\n"
+
+        @classmethod
+        def _parse(cls, buf):
+            if len(buf) != cls.RECORD_SIZE or not buf.endswith("\n"):
+                return None
+
+            vals = buf.rstrip().split('\t', len(cls.FIELDS) - 1)
+            if len(vals) != len(cls.FIELDS):
+                return None
+
+            try:
+                return cls.Record(**dict([ (name, conv(val))
+                                           for (name, conv), val in zip(cls.FIELDS, vals) ]))
+            except ValueError:
+                return None
+
+        def get(self, id):
+            """Returns the record of session <id>, or None"""
+
+            if id < 1 or not exists(self.path):
+                return None
+
+            fh = file(self.path, "rb")
+            try:
+                fh.seek((id - 1) * self.RECORD_SIZE)
+                record = self._parse(fh.read(self.RECORD_SIZE))
+            finally:
+                fh.close()
+
+            if record and record.id == id:
+                return record
+
+            return None
+
+        def put(self, record):
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0644)
+            try:
+                os.lseek(fd, (record.id - 1) * self.RECORD_SIZE, 0)
+                os.write(fd, self._format(record))
+            finally:
+                os.close(fd)
+
+        def update(self, id, jobs, command, running=False, started=None, ended=None):
+            """Records a session's command and the counts of its Jobs"""
+
+            record = self.get(id)
+            if record is None:
+                record = self.Record(id=id, started=int(started or time.time()))
+
+            counts = jobs.counts
+
+            record.command = command
+            record.jobs = sum(counts.values())
+            record.ok = counts.get("EXIT=0", 0)
+            record.pending = counts.get(Session.Jobs.PENDING, 0)
+            record.failed = record.jobs - record.ok - record.pending
+
+            if running:
+                record.status = 'running'
+                record.pid = os.getpid()
+                record.ended = 0
+            else:
+                if record.pending:
+                    record.status = 'stopped'
+                elif record.failed:
+                    record.status = 'failed'
+                else:
+                    record.status = 'done'
+
+                record.ended = int(ended or time.time())
+
+            self.put(record)
+            return record
+
+        def scan(self, sessions_path):
+            """Adds sessions missing from the catalog (e.g., created by
+            older versions) by scanning the sessions path. Returns ids of
+            the sessions added."""
+
+            added = []
+            for id in sorted([ int(fname) for fname in os.listdir(sessions_path)
+                               if fname.isdigit() ]):
+                if self.get(id):
+                    continue
+
+                session_paths = Session.Paths(join(sessions_path, str(id)))
+                if not exists(session_paths.conf):
+                    continue
+
+                try:
+                    command = eval(file(session_paths.conf).read()).get('command')
+                except Exception:
+                    continue
+
+                started = getmtime(session_paths.conf)
+                ended = getmtime(session_paths.log) if exists(session_paths.log) else started
+
+                self.update(id, Session.Jobs(session_paths.jobs), command or '',
+                            started=started, ended=ended)
+                added.append(id)
+
+            return added
+
+        def records(self, last=None):
+            """Returns records ordered by id. If last is set, only the
+            records of the <last> most recent session ids"""
+
+            if not exists(self.path):
+                return []
+
+            fh = file(self.path, "rb")
+            try:
+                if last:
+                    size = getsize(self.path)
+                    fh.seek(max(0, size - size % self.RECORD_SIZE - last * self.RECORD_SIZE))
+
+                records = []
+                while True:
+                    buf = fh.read(self.RECORD_SIZE)
+                    if not buf:
+                        break
+
+                    # holes of ids without records read as zeros
+                    record = self._parse(buf)
+                    if record:
+                        records.append(record)
+            finally:
+                fh.close()
+
+            return records
 
     class Logs:
         class Worker(object):
+            class Filter:
+                """Streaming filter for output read from a pty.
+
+                Removes ssh's "Connection to ... closed." message and the
+                carriage returns a pty adds to line endings, and keeps only
+                the last version of lines overwritten with carriage returns
+                (e.g., progress bars). The incomplete last line is held back
+                until it is completed, because it may still be overwritten.
+
+                Most output has no carriage returns other than at line
+                endings, so we only visit overwritten lines one by one.
+                """
+
+                # not anchored: if the output didn't end with a newline, the
+                # message follows the incomplete last line of output
+                CONNECTION_CLOSED = re.compile(r'Connection to \S+ closed\.\r*\n')
+
+                # longer incomplete lines aren't held back
+                MAXLINE = 64 * 1024
+
+                def __init__(self):
+                    self.partial = ""
+
+                def _filter(self, buf):
+                    """filter complete lines"""
+
+                    buf = buf.replace("\r\n", "\n")
+                    if 'Connection to ' in buf:
+                        buf = self.CONNECTION_CLOSED.sub('', buf)
+
+                    i = buf.find("\r")
+                    if i == -1:
+                        return buf
+
+                    filtered = []
+                    pos = 0
+                    while i != -1:
+                        start = buf.rfind("\n", pos, i) + 1
+                        end = buf.find("\n", i)
+
+                        # removing ssh's message can leave a line unterminated
+                        if end == -1:
+                            end = len(buf)
+
+                        # the last version of the line is after the last \r
+                        line = buf[start:end].rstrip("\r")
+                        filtered.append(buf[pos:start])
+                        filtered.append(line[line.rfind("\r") + 1:])
+
+                        pos = end
+                        i = buf.find("\r", pos)
+
+                    filtered.append(buf[pos:])
+                    return "".join(filtered)
+
+                def __call__(self, buf):
+                    if self.partial:
+                        buf = self.partial + buf
+
+                    i = buf.rfind("\n") + 1
+                    buf, self.partial = self._filter(buf[:i]), buf[i:]
+
+                    if len(self.partial) > self.MAXLINE:
+                        buf += self.flush()
+
+                    return buf
+
+                def flush(self):
+                    """returns the incomplete last line, filtered as if it
+                    were complete"""
+
+                    if not self.partial:
+                        return ""
+
+                    buf = self._filter(self.partial + "\n")
+                    self.partial = ""
+
+                    if buf.endswith("\n"):
+                        buf = buf[:-1]
+
+                    return buf
+
+            class Status:
+                def __init__(self, worker):
+                    self.worker = worker
+
+                def write(self, buf):
+                    self.worker.write_status(buf)
+
+            # how often (in seconds) we touch the log when output is filtered out
+            TOUCH_INTERVAL = 1
+
             def fh(self):
                 if not self._fh:
-                    self._fh = file(join(self.path, str(os.getpid())), "a", 1)
+                    path = join(self.path, str(self.id or os.getpid()))
+                    if self._offset is None:
+                        self._offset = Session.Logs.WorkerReader(path).stat()[1]
+
+                    self._fh = file(path, "a", 0 if self.buffer_size else 1)
 
                 return self._fh
-            status = fh = property(fh)
+            fh = property(fh)
+
+            @property
+            def offset(self):
+                """offset in the log (including rotated segments) where the
+                next output will be, counting buffered output"""
+
+                self.fh
+                return self._offset + self._buffered
+
+            @property
+            def status(self):
+                return self.Status(self)
+
+            def __init__(self, path, tee=False, id=None, buffer_size=0, flush_interval=1,
+                         rotate=0, compress=0):
+                """If buffer_size, output is buffered until there is buffer_size
+                of it, or the oldest buffered output is flush_interval
+                seconds old, or a status line is written.
+
+                If rotate, the log is rotated into a segment (<id>.<n>) once it
+                is rotate bytes long. Segments are gzip'ed if compress, which
+                is the compression level.
+                """
 
-            def __init__(self, path, tee=False):
                 self._fh = None
                 self.path = path
                 self.tee = tee
+                self.id = id
+
+                self.buffer_size = buffer_size
+                self.flush_interval = flush_interval
+
+                self.rotate = rotate
+                self.compress = compress
+                self._segment = None
+
+                self.filter = self.Filter()
+                self._touched = 0
+
+                # where the last status line was written (see offset)
+                self._offset = None
+                self.status_offset = None
+
+                self._buffer = []
+                self._buffered = 0
+                self._buffered_since = None
 
             @staticmethod
-            def _filter(buf):
-                buf = re.sub(r'Connection to \S+ closed\.\r+\n', '', buf)
-                buf = re.sub(r'\r[^\r\n]+$', '', buf)
-                buf = re.sub(r'.*\r(?![\r\n])','', buf)
-                buf = re.sub(r'\r+\n', '\n', buf)
+            def compress_segment(path, level):
+                """gzip segment (atomically) and remove the uncompressed segment"""
+                path_tmp = path + ".gz.tmp"
+
+                src = file(path, "rb")
+                dst = gzip.GzipFile(path_tmp, "wb", level)
+                while True:
+                    buf = src.read(1024 * 1024)
+                    if not buf:
+                        break
+                    dst.write(buf)
+
+                src.close()
+                dst.close()
+
+                os.rename(path_tmp, path + ".gz")
+                os.remove(path)
+
+            def _rotate(self):
+                path = self._fh.name
+                self._fh.close()
+                self._fh = None
+
+                if self._segment is None:
+                    dpath, worker_id = split(path)
+                    parsed = [ Session.Logs.parse_worker_fname(fname) for fname in os.listdir(dpath) ]
+                    self._segment = max([ segment for id, segment, compressed in filter(None, parsed)
+                                          if id == int(worker_id) and segment ] or [ 0 ])
 
-                return buf
+                self._segment += 1
+                path_segment = "%s.%d" % (path, self._segment)
+                os.rename(path, path_segment)
+
+                # the watchdog needs a log to watch
+                self.fh
+
+                if self.compress:
+                    thread = threading.Thread(target=self.compress_segment,
+                                              args=(path_segment, self.compress))
+                    thread.start()
+
+            def _write(self, buf):
+                self.fh.write(buf)
+                self._offset += len(buf)
+                if self.rotate and self._fh.tell() >= self.rotate:
+                    self._rotate()
+
+            def flush(self):
+                if self._buffer:
+                    self._write("".join(self._buffer))
+
+                    self._buffer = []
+                    self._buffered = 0
+                    self._buffered_since = None
+
+                if self._fh:
+                    self._fh.flush()
+
+            def poll(self):
+                """flush buffered output that is older than flush_interval"""
+                if self._buffered_since and \
+                   time.time() - self._buffered_since >= self.flush_interval:
+                    self.flush()
+
+            def write_status(self, buf):
+                # status lines come after the output that preceded them
+                output = self.filter.flush()
+                self.status_offset = self.offset + len(output)
+                if not self.buffer_size:
+                    self._write(output + buf)
+                    return
+
+                self._buffer += [ output, buf ]
+                self.flush()
 
             def write(self, buf):
                 if self.tee:
@@ -119,12 +808,28 @@ class Session(object):
                     sys.stdout.flush()
 
                 # filter progress bars and other return-carriage crap
-                buf = self._filter(buf)
+                buf = self.filter(buf)
 
                 if buf:
-                    self.fh.write(buf)
-                else:
-                    os.utime(self.path, None)
+                    if not self.buffer_size:
+                        self._write(buf)
+                        return
+
+                    if not self._buffer:
+                        self._buffered_since = time.time()
+
+                    self._buffer.append(buf)
+                    self._buffered += len(buf)
+
+                    if self._buffered >= self.buffer_size:
+                        self.flush()
+                    else:
+                        self.poll()
+
+                # touch the log so the watchdog knows the job is alive
+                elif time.time() - self._touched >= self.TOUCH_INTERVAL:
+                    os.utime(self.fh.name, None)
+                    self._touched = time.time()
 
             def __getattr__(self, attr):
                 return getattr(self.fh, attr)
@@ -141,14 +846,286 @@ class Session(object):
             def __getattr__(self, attr):
                 return getattr(self.fh, attr)
 
-        def __init__(self, path_session_log, path_workers):
+        # workers that run inside the session process (e.g., --engine=events)
+        # don't have a pid of their own. Their logs are named pid * BASE + N,
+        # which is larger than any pid.
+        WORKER_ID_BASE = 10 ** 7
+
+        def __init__(self, path_session_log, path_workers, path_events=None):
             self.pid = os.getpid()
             self.path_session_log = path_session_log
             self.path_workers = path_workers
 
+            # worker events (see Session.Events)
+            self.events = Session.Events(path_events) if path_events else None
+
+            self.worker_id = None
+
+            # worker log output buffering and rotation (see Worker)
+            self.buffer_size = 0
+            self.flush_interval = 1
+            self.rotate = 0
+            self.compress = 0
+
             self._worker = None
             self._manager = None
 
+        @classmethod
+        def worker_pid(cls, worker_id):
+            """returns pid of the process that runs worker_id"""
+            if worker_id >= cls.WORKER_ID_BASE:
+                return worker_id / cls.WORKER_ID_BASE
+
+            return worker_id
+
+        WORKER_FNAME = re.compile(r'^(\d+)(?:\.(\d+)(\.gz)?)?$')
+
+        @classmethod
+        def parse_worker_fname(cls, fname):
+            """Returns (worker_id, segment, compressed) for a worker log file
+            name, or None. segment is None for the log being written."""
+
+            m = cls.WORKER_FNAME.match(fname)
+            if not m:
+                return None
+
+            worker_id, segment, compressed = m.groups()
+            return int(worker_id), int(segment) if segment else None, bool(compressed)
+
+        @classmethod
+        def worker_logs(cls, path_workers, fnames=None):
+            """Returns dict of worker_id -> paths of its rotated segments, in order.
+            A segment that is still being compressed is read uncompressed."""
+
+            if fnames is None:
+                fnames = os.listdir(path_workers)
+
+            segments = {}
+            for fname in fnames:
+                parsed = cls.parse_worker_fname(fname)
+                if not parsed:
+                    continue
+
+                worker_id, segment, compressed = parsed
+                worker_segments = segments.setdefault(worker_id, {})
+                if segment and (segment not in worker_segments or not compressed):
+                    worker_segments[segment] = join(path_workers, fname)
+
+            return dict([ (worker_id, [ worker_segments[segment]
+                                        for segment in sorted(worker_segments) ])
+                          for worker_id, worker_segments in segments.items() ])
+
+        class WorkerReader:
+            """Reads a worker log as a single file, including its rotated and
+            compressed segments.
+
+            Compressed segments are decompressed as they are read. Seeking
+            backwards in a compressed segment decompresses it to a temporary
+            file, once, which is used from then on.
+            """
+
+            BLOCKSIZE = 1024 * 1024
+
+            class Part:
+                def __init__(self, path, start, size):
+                    self.path = path
+                    self.start = start
+                    self.size = size
+                    self.fh = None
+
+                def read(self, offset, size):
+                    if not self.fh:
+                        self.fh = file(self.path, "rb")
+
+                    if self.fh.tell() != offset:
+                        self.fh.seek(offset)
+                    return self.fh.read(size)
+
+                def close(self):
+                    if self.fh:
+                        self.fh.close()
+                        self.fh = None
+
+            class CompressedPart(Part):
+                @staticmethod
+                def getsize(path):
+                    """uncompressed size of a (single member, < 4GB) gzip file"""
+                    fh = file(path, "rb")
+                    fh.seek(-4, 2)
+                    size = struct.unpack('<I', fh.read(4))[0]
+                    fh.close()
+
+                    return size
+
+                def __init__(self, path, start):
+                    Session.Logs.WorkerReader.Part.__init__(self, path, start, self.getsize(path))
+
+                    self.z = None
+                    self.pos = 0
+                    self.pending = ""
+                    self.decompressed = None
+
+                def _fill(self):
+                    if self.z is None:
+                        self.fh = file(self.path, "rb")
+                        self.z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+                    data = self.z.unconsumed_tail or self.fh.read(Session.Logs.WorkerReader.BLOCKSIZE)
+                    if not data:
+                        return False
+
+                    self.pending += self.z.decompress(data, Session.Logs.WorkerReader.BLOCKSIZE)
+                    return True
+
+                def _decompress(self):
+                    self.close()
+
+                    fh = tempfile.TemporaryFile()
+                    src = gzip.GzipFile(self.path, "rb")
+                    while True:
+                        buf = src.read(Session.Logs.WorkerReader.BLOCKSIZE)
+                        if not buf:
+                            break
+                        fh.write(buf)
+                    src.close()
+
+                    self.decompressed = fh
+
+                def read(self, offset, size):
+                    if self.decompressed is None and offset < self.pos:
+                        self._decompress()
+
+                    if self.decompressed:
+                        self.decompressed.seek(offset)
+                        return self.decompressed.read(size)
+
+                    # skip forward
+                    while self.pos < offset:
+                        if not self.pending and not self._fill():
+                            return ""
+
+                        skip = min(len(self.pending), offset - self.pos)
+                        self.pending = self.pending[skip:]
+                        self.pos += skip
+
+                    while len(self.pending) < size and self._fill():
+                        pass
+
+                    buf = self.pending[:size]
+                    self.pending = self.pending[size:]
+                    self.pos += len(buf)
+
+                    return buf
+
+                def close(self):
+                    Session.Logs.WorkerReader.Part.close(self)
+                    self.z = None
+                    self.pos = 0
+                    self.pending = ""
+
+                    if self.decompressed:
+                        self.decompressed.close()
+                        self.decompressed = None
+
+            def __init__(self, path, segments=None):
+                """path is the log being written, segments are the paths of its
+                rotated segments (default: look them up)"""
+
+                if segments is None:
+                    parsed = Session.Logs.parse_worker_fname(basename(path))
+                    segments = Session.Logs.worker_logs(dirname(path)).get(parsed[0], []) \
+                               if parsed else []
+
+                self.path = path
+                self.parts = []
+
+                offset = 0
+                for segment in segments:
+                    if segment.endswith(".gz"):
+                        part = self.CompressedPart(segment, offset)
+                    else:
+                        part = self.Part(segment, offset, getsize(segment))
+
+                    self.parts.append(part)
+                    offset += part.size
+
+                # the log being written has no fixed size
+                self.active = None
+                if exists(path):
+                    self.active = self.Part(path, offset, None)
+                    self.parts.append(self.active)
+
+                self.pos = 0
+
+            def stat(self):
+                """Returns (ino, size, mtime, segments) of the log. Rotation
+                changes ino, but not the contents up to the old size. ino and
+                mtime are of the log being written, as a segment's are changed
+                by compressing it."""
+
+                segments = len(self.parts)
+                ino = mtime = None
+                size = 0
+                if self.active:
+                    segments -= 1
+                    st = os.stat(self.active.path)
+                    ino, mtime = st.st_ino, st.st_mtime
+                    size = st.st_size
+
+                if segments:
+                    last = self.parts[segments - 1]
+                    size += last.start + last.size
+
+                return ino, size, mtime, segments
+
+            def seek(self, offset):
+                self.pos = offset
+
+            def tell(self):
+                return self.pos
+
+            def _part(self, offset):
+                for part in self.parts:
+                    if part.size is None or offset < part.start + part.size:
+                        return part
+
+                return None
+
+            def read(self, size=-1):
+                bufs = []
+                while size != 0:
+                    part = self._part(self.pos)
+                    if not part:
+                        break
+
+                    n = size
+                    if part.size is not None:
+                        left = part.start + part.size - self.pos
+                        n = left if size < 0 else min(size, left)
+
+                    buf = part.read(self.pos - part.start, n)
+                    if not buf:
+                        break
+
+                    bufs.append(buf)
+                    self.pos += len(buf)
+                    if size > 0:
+                        size -= len(buf)
+
+                return "".join(bufs)
+
+            def close(self):
+                for part in self.parts:
+                    part.close()
+
+        def for_worker(self, n):
+            """Returns logs for the n-th worker run inside this process"""
+            logs = copy.copy(self)
+            logs.worker_id = os.getpid() * self.WORKER_ID_BASE + n
+            logs._worker = None
+
+            return logs
+
         @property
         def worker(self):
             if self._worker:
@@ -156,7 +1133,11 @@ class Session(object):
 
             makedirs(self.path_workers)
 
-            worker = self.Worker(self.path_workers, True if os.getpid() == self.pid else False)
+            worker = self.Worker(self.path_workers,
+                                 False if self.worker_id else os.getpid() == self.pid,
+                                 self.worker_id,
+                                 self.buffer_size, self.flush_interval,
+                                 self.rotate, self.compress)
             self._worker = worker
             return worker
 
@@ -171,24 +1152,42 @@ class Session(object):
 
     @staticmethod
     def new_session_id(sessions_path):
-        while True:
-            session_ids = [ int(fname) for fname in os.listdir(sessions_path) 
-                            if fname.isdigit() ]
+        """Allocates a new session id by incrementing the last allocated
+        id in the sessions path's counter file, which we lock so
+        concurrent sessions get different ids. Without a counter (e.g.,
+        sessions created by older versions) we start from the highest
+        session id in the sessions path."""
 
-            if session_ids:
-                new_session_id = max(map(int, session_ids)) + 1
-            else:
-                new_session_id = 1
+        fd = os.open(join(sessions_path, 'session-id'), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
 
-            id = new_session_id
             try:
-                os.mkdir(join(sessions_path, "%d" % id))
-            except OSError, e:
-                if e.errno != errno.EEXIST:
-                    raise
-                continue
+                id = int(os.read(fd, 32))
+            except ValueError:
+                id = max([ int(fname) for fname in os.listdir(sessions_path)
+                           if fname.isdigit() ] + [ 0 ])
 
-            return id
+            while True:
+                id += 1
+                try:
+                    os.mkdir(join(sessions_path, "%d" % id))
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    continue
+
+                break
+
+            os.lseek(fd, 0, 0)
+            os.ftruncate(fd, 0)
+            os.write(fd, "%d\n" % id)
+            os.fsync(fd)
+        finally:
+            # closing releases the lock
+            os.close(fd)
+
+        return id
 
     def __init__(self, sessions_path, id=None):
         if not exists(sessions_path):
@@ -206,10 +1205,16 @@ class Session(object):
 
         self.paths = Session.Paths(path)
         self.jobs = self.Jobs(self.paths.jobs)
+        self.jobs.repair()
 
-        self.logs = self.Logs(self.paths.log, self.paths.workers)
+        self.logs = self.Logs(self.paths.log, self.paths.workers, self.paths.events)
+        self.catalog = self.Catalog(join(sessions_path, 'catalog'))
         self.id = id
 
+    def update_catalog(self, command, running=False):
+        """Records the session's command and job counts in the catalog"""
+        self.catalog.update(self.id, self.jobs, command, running)
+
     def taskconf(self, val=UNDEFINED):
         path = self.paths.conf
 
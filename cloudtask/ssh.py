@@ -17,6 +17,13 @@ from temp import TempFile
 import executil
 import hashlib
 
+import time
+import shutil
+import tempfile
+import subprocess
+
+from overlay import Overlay
+
 class PrivateKey:
     class Error(Exception):
         pass
@@ -61,7 +68,7 @@ class SSH:
             pass
 
         @classmethod
-        def argv(cls, identity_file=None, login_name=None, pty=False, *args):
+        def argv(cls, identity_file=None, login_name=None, pty=False, control_path=None, *args):
             argv = ['ssh']
 
             if pty:
@@ -76,6 +83,9 @@ class SSH:
             for opt in cls.OPTS:
                 argv += [ "-o", opt ]
 
+            if control_path:
+                argv += [ "-o", "ControlPath=" + control_path ]
+
             argv += args
 
             return argv
@@ -84,12 +94,13 @@ class SSH:
                      identity_file=None,
                      login_name=None,
                      callback=None,
-                     pty=False):
+                     pty=False,
+                     control_path=None):
             self.address = address
             self.command = command
             self.callback = callback
 
-            argv = self.argv(identity_file, login_name, pty, address, command)
+            argv = self.argv(identity_file, login_name, pty, control_path, address, command)
             Command.__init__(self, argv, pty=pty, setpgrp=True)
 
         def __str__(self):
@@ -104,17 +115,118 @@ class SSH:
             if self.exitcode != 0:
                 raise self.Error(self.output)
 
+    class Master:
+        """Persistent master connection that SSH commands are multiplexed over.
+
+        Saves a TCP connection + key exchange per command.
+        """
+        class Error(Exception):
+            pass
+
+        def __init__(self, address, identity_file=None, login_name=None, timeout=None):
+            self.pid = os.getpid()
+            self.address = address
+            self.process = None
+
+            self.tmpdir = tempfile.mkdtemp(prefix='cloudtask-ssh-')
+            self.path = join(self.tmpdir, 'master')
+
+            argv = SSH.Command.argv(identity_file, login_name, False, self.path,
+                                    '-N', '-o', 'ControlMaster=yes', address)
+
+            devnull = file(os.devnull, "r+")
+            self.process = subprocess.Popen(argv,
+                                            stdin=devnull, stdout=devnull, stderr=devnull,
+                                            close_fds=True, preexec_fn=os.setpgrp)
+            devnull.close()
+
+            started = time.time()
+            while not exists(self.path):
+                returncode = self.process.poll()
+                if returncode is not None:
+                    self.close()
+                    raise self.Error("ssh master exited (%d)" % returncode)
+
+                if timeout and time.time() - started > timeout:
+                    self.close()
+                    raise self.Error("ssh master timed out after %d seconds" % timeout)
+
+                time.sleep(0.1)
+
+        @property
+        def alive(self):
+            return self.process is not None and self.process.poll() is None
+
+        def close(self):
+            if not self.process:
+                return
+
+            if self.alive:
+                devnull = file(os.devnull, "r+")
+                subprocess.call(['ssh', '-o', 'ControlPath=' + self.path, '-O', 'exit', self.address],
+                                stdin=devnull, stdout=devnull, stderr=devnull)
+                devnull.close()
+
+                if self.process.poll() is None:
+                    self.process.terminate()
+                self.process.wait()
+
+            self.process = None
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+        def __del__(self):
+            if os.getpid() != self.pid:
+                return
+
+            self.close()
+
     TimeoutError = Command.TimeoutError
     TIMEOUT = Command.TIMEOUT
 
     def __init__(self, address,
-                 identity_file=None, login_name=None, callback=None):
+                 identity_file=None, login_name=None, callback=None, multiplex=True,
+                 ready_timeout=None):
+        """If ready_timeout, keep trying to reach sshd for up to that many seconds"""
         self.address = address
         self.identity_file = identity_file
         self.login_name = login_name
         self.callback = callback
+        self.master = None
+
+        self.wait_ready(ready_timeout)
+
+        if multiplex:
+            try:
+                self.master = self.Master(address, identity_file, login_name, self.TIMEOUT)
+            except self.Master.Error:
+                # fall back to a new connection per command
+                self.master = None
+
+    @property
+    def control_path(self):
+        if self.master and self.master.alive:
+            return self.master.path
 
-        self.ping()
+        return None
+
+    def close(self):
+        if self.master:
+            self.master.close()
+            self.master = None
+
+    def wait_ready(self, timeout=None, sleep=1):
+        started = time.time()
+        while True:
+            try:
+                return self.ping()
+            except self.Error:
+                if not timeout or time.time() - started > timeout:
+                    raise
+
+            if self.callback:
+                self.callback()
+
+            time.sleep(sleep)
 
     def ping(self, timeout=TIMEOUT):
         command = self.command('true')
@@ -123,21 +235,24 @@ class SSH:
         except (command.TimeoutError, command.Error), e:
             raise self.Error(str(e).strip())
 
+    def argv(self, command, pty=False):
+        """returns argv of ssh executing command (e.g., for running it ourselves)"""
+        return self.Command.argv(self.identity_file, self.login_name, pty, self.control_path,
+                                 self.address, command)
+
     def command(self, command, pty=False):
         return self.Command(self.address, command,
                             identity_file=self.identity_file,
                             login_name=self.login_name,
                             callback=self.callback,
-                            pty=pty)
-
-    def copy_id(self, key):
-        if not isinstance(key, PrivateKey):
-            key = PrivateKey(key)
+                            pty=pty,
+                            control_path=self.control_path)
 
+    def _authorize(self, public, fingerprint):
         command = 'mkdir -p $HOME/.ssh; cat >> $HOME/.ssh/authorized_keys'
 
         command = self.command(command)
-        command.tochild.write("%s %s\n" % (key.public, key.fingerprint))
+        command.tochild.write("%s %s\n" % (public, fingerprint))
         command.tochild.close()
 
         try:
@@ -145,24 +260,135 @@ class SSH:
         except command.Error, e:
             raise self.Error("can't add id to authorized keys: " + str(e))
 
+    def _unauthorize(self, fingerprint):
+        command = 'sed -i "/%s/d" $HOME/.ssh/authorized_keys' % fingerprint
+        command = self.command(command)
+
+        try:
+            command.close()
+        except command.Error, e:
+            raise self.Error("can't remove id from authorized-keys: " + str(e))
+
+    def copy_id(self, key):
+        if not isinstance(key, PrivateKey):
+            key = PrivateKey(key)
+
+        self._authorize(key.public, key.fingerprint)
+
     def remove_id(self, key):
         if not isinstance(key, PrivateKey):
             key = PrivateKey(key)
 
-        command = 'sed -i "/%s/d" $HOME/.ssh/authorized_keys' % key.fingerprint
-        command = self.command(command)
+        self._unauthorize(key.fingerprint)
+
+    # where workers cache overlay tarballs (relative to $HOME)
+    OVERLAYS = '.cloudtask/overlays'
+
+    SEED_KEY = '.ssh/cloudtask-seed'
+
+    def _overlay_paths(self, overlay):
+        """returns remote paths of cached overlay tarball and applied marker"""
+        path = "%s/%s" % (self.OVERLAYS, overlay.digest)
+        return path + ".tar.gz", path
+
+    def has_overlay(self, overlay):
+        tarball, marker = self._overlay_paths(overlay)
+        try:
+            self.command("test -e %s" % marker).close()
+        except self.Command.Error:
+            return False
+
+        return True
+
+    def _extract_overlay(self, overlay):
+        tarball, marker = self._overlay_paths(overlay)
+
+        # like rsync -rHEL: don't preserve ownership or existing dir metadata
+        command = self.command("tar --no-same-owner --no-overwrite-dir -C / -zxf %s && touch %s" %
+                               (tarball, marker))
+        try:
+            command.close(None)
+        except command.Error, e:
+            raise self.Error("can't extract overlay: " + str(e))
+
+    def _upload_overlay(self, overlay):
+        tarball, marker = self._overlay_paths(overlay)
+
+        command = self.command("mkdir -p %s && cat > %s.tmp && mv %s.tmp %s" %
+                               (self.OVERLAYS, tarball, tarball, tarball))
+
+        fh = file(overlay.tarball, "rb")
+        while True:
+            buf = fh.read(1024 * 1024)
+            if not buf:
+                break
+
+            command.tochild.write(buf)
+            if self.callback:
+                self.callback()
+
+        fh.close()
+        command.tochild.close()
 
         try:
             command.close()
         except command.Error, e:
-            raise self.Error("can't remove id from authorized-keys: " + str(e))
+            raise self.Error("can't upload overlay: " + str(e))
+
+    def seed_overlay(self, overlay, target):
+        """Copy overlay cached on this host to the target SSH host and apply it there.
+
+        The target temporarily authorizes a key generated on this host.
+        """
+        tarball, marker = self._overlay_paths(overlay)
+
+        command = self.command("mkdir -p .ssh; test -f %(key)s || ssh-keygen -q -N '' -f %(key)s; cat %(key)s.pub" %
+                               {'key': self.SEED_KEY})
+        try:
+            command.close()
+        except command.Error, e:
+            raise self.Error("can't get seed key: " + str(e))
+
+        public = " ".join(command.output.strip().splitlines()[-1].split()[:2])
+        fingerprint = hashlib.sha1(public).hexdigest()
+
+        target._authorize(public, fingerprint)
+        try:
+            target.command("mkdir -p %s" % self.OVERLAYS).close()
+
+            destination = target.address
+            if target.login_name:
+                destination = target.login_name + "@" + destination
+
+            opts = " ".join([ "-o " + opt for opt in self.Command.OPTS ])
+            command = self.command("scp -q -i %s %s %s %s:%s" %
+                                   (self.SEED_KEY, opts, tarball, destination, tarball))
+            try:
+                command.close(None)
+            except command.Error, e:
+                raise self.Error("can't seed overlay to %s: %s" % (target.address, e))
+        finally:
+            target._unauthorize(fingerprint)
+
+        target._extract_overlay(overlay)
 
     def apply_overlay(self, overlay_path):
+        if isinstance(overlay_path, Overlay):
+            overlay = overlay_path
+            if self.has_overlay(overlay):
+                return
+
+            self._upload_overlay(overlay)
+            self._extract_overlay(overlay)
+            return
+
         if not isdir(overlay_path):
             raise self.Error("overlay path '%s' is not a directory" % overlay_path)
 
         ssh_command = " ".join(self.Command.argv(self.identity_file,
-                                                 self.login_name))
+                                                 self.login_name,
+                                                 False,
+                                                 self.control_path))
         argv = [ 'rsync', '--timeout=%d' % self.TIMEOUT, '-rHEL', '-e', ssh_command,
                 overlay_path.rstrip('/') + '/', "%s:/" % self.address ]
 
@@ -45,7 +45,28 @@ Options:
     --pre=           Worker setup command
     --post=          Worker cleanup command
     --overlay=       Path to worker filesystem overlay
+    --overlay-fanout= Max workers the overlay is uploaded to at a time, the rest
+                     are seeded by workers that have it (default: 0 - disabled)
+    --pool-ttl=      Seconds workers we launched are parked in the warm pool after
+                     the session, for later sessions to claim (default: 0 - destroy)
     --split=         Number of workers to execute jobs in parallel
+    --split-max=     Scale the number of workers up to this many (requires --engine=events)
+    --split-min=     Don't scale the number of workers below this many (default: 1)
+    --target-time=   Seconds we scale the workers to finish queued jobs in (default: 3600)
+    --batch=         Number of jobs a worker executes per SSH round-trip (default: 1)
+    --readahead=     How many jobs to read ahead of the workers (default: 10000)
+    --journal-sync=  Fsync job results to the session every N jobs (default: 0 - never)
+    --log-buffer=    Bytes of job output buffered before it is written to the
+                     worker log (default: 65536, 0 - write every line)
+    --log-flush=     Seconds job output may be buffered (default: 1)
+    --log-rotate=    Rotate worker logs every N megabytes (default: 0 - never)
+    --log-compress=  Gzip level of rotated worker logs (default: 6, 0 - don't compress)
+    --engine=        How split workers are driven <processes|events> (default: processes)
+    --schedule=      Order jobs are executed in <fifo|longest|weighted> (default: fifo)
+
+                     fifo: in the order they are read
+                     longest: longest first, by durations in previous sessions
+                     weighted: longest first, by a weight in the first column
 
     --workers=       List of pre-launched workers to use
 
@@ -78,10 +99,16 @@ import signal
 import traceback
 import re
 import time
+import itertools
+import stat
 
-from session import Session
+from session import Session, makedirs
 
-from executor import CloudExecutor, CloudWorker
+from executor import CloudExecutor, EventExecutor, CloudWorker
+from overlay import Overlay
+from scheduler import Durations, Scheduler
+from results import Results
+from pool import Pool
 from command import fmt_argv
 
 from taskconf import TaskConf
@@ -90,6 +117,36 @@ from watchdog import Watchdog
 
 import ssh
 
+def read_jobs(fh, command, weights=None):
+    """Generator that lazily parses job inputs from fh into job commands.
+
+    If weights is a dictionary, the first column of each input is a weight
+    which is stored in weights by job command.
+    """
+
+    for line in iter(fh.readline, ''):
+        line = re.sub('#.*', '', line)
+        line = line.strip()
+        if not line:
+            continue
+        args = shlex.split(line)
+
+        if weights is not None:
+            try:
+                weight = float(args.pop(0))
+            except ValueError:
+                raise ValueError("bad job weight in '%s'" % line)
+
+        if isinstance(command, str):
+            job = command + ' ' + fmt_argv(args)
+        else:
+            job = fmt_argv(command + args)
+
+        if weights is not None:
+            weights[job] = weight
+
+        yield job
+
 class Task:
 
     COMMAND = None
@@ -122,7 +179,9 @@ class Task:
         sys.exit(1)
 
     @classmethod
-    def confirm(cls, taskconf, jobs):
+    def confirm(cls, taskconf, jobs, more=False):
+        """If more is True, jobs is just a preview of the first jobs"""
+
         def filter(job):
             job = re.sub('^\s*', '', job[len(taskconf.command):])
             return job
@@ -130,12 +189,15 @@ class Task:
         job_first = filter(jobs[0])
         job_last = filter(jobs[-1])
 
-        job_range = ("%s .. %s" % (job_first, job_last)
-                     if job_first != job_last else "%s" % job_first)
+        if more:
+            job_range = "%s .. %s ..." % (job_first, job_last)
+        else:
+            job_range = ("%s .. %s" % (job_first, job_last)
+                         if job_first != job_last else "%s" % job_first)
 
-        print >> sys.stderr, "About to launch %d cloud server%s to execute %d jobs (%s):" % (taskconf.split,
-                                                                                             "s" if taskconf.split and taskconf.split > 1 else "",
-                                                                                             len(jobs), job_range)
+        print >> sys.stderr, "About to launch %d cloud server%s to execute %d%s jobs (%s):" % (taskconf.split,
+                                                                                               "s" if taskconf.split and taskconf.split > 1 else "",
+                                                                                               len(jobs), "+" if more else "", job_range)
 
         print >> sys.stderr, "\n" + taskconf.fmt()
 
@@ -173,6 +235,11 @@ class Task:
         opt_retry = None
         opt_force = False
 
+        weights = None
+
+        # whether we can read the rest of the jobs without blocking
+        drain = True
+
         if cls.SESSIONS:
             opt_sessions = cls.SESSIONS
             if not opt_sessions.startswith('/'):
@@ -257,6 +324,14 @@ class Task:
                 if taskconf.split == 1:
                     taskconf.split = None
 
+            elif opt == '--batch':
+                taskconf.batch = int(val)
+                if taskconf.batch < 1:
+                    error("bad --batch value '%s'" % val)
+
+                if taskconf.batch == 1:
+                    taskconf.batch = None
+
             elif opt == '--backup-id':
                 try:
                     taskconf.backup_id = int(val)
@@ -269,10 +344,84 @@ class Task:
             elif opt[2:] in ('timeout', 'retries', 'strikes'):
                 setattr(taskconf, opt[2:], int(val))
 
+            elif opt == '--overlay-fanout':
+                taskconf.overlay_fanout = int(val)
+                if taskconf.overlay_fanout < 0:
+                    error("bad --overlay-fanout value '%s'" % val)
+
+            elif opt == '--journal-sync':
+                taskconf.journal_sync = int(val)
+                if taskconf.journal_sync < 0:
+                    error("bad --journal-sync value '%s'" % val)
+
+            elif opt == '--log-buffer':
+                taskconf.log_buffer = int(val)
+                if taskconf.log_buffer < 0:
+                    error("bad --log-buffer value '%s'" % val)
+
+            elif opt == '--log-flush':
+                taskconf.log_flush = int(val)
+                if taskconf.log_flush < 1:
+                    error("bad --log-flush value '%s'" % val)
+
+            elif opt == '--pool-ttl':
+                taskconf.pool_ttl = int(val)
+                if taskconf.pool_ttl < 0:
+                    error("bad --pool-ttl value '%s'" % val)
+
+            elif opt == '--log-rotate':
+                taskconf.log_rotate = int(val)
+                if taskconf.log_rotate < 0:
+                    error("bad --log-rotate value '%s'" % val)
+
+            elif opt == '--log-compress':
+                taskconf.log_compress = int(val)
+                if not 0 <= taskconf.log_compress <= 9:
+                    error("bad --log-compress value '%s'" % val)
+
+            elif opt == '--engine':
+                if val not in ('processes', 'events'):
+                    error("bad --engine value '%s'" % val)
+
+                taskconf.engine = val
+
+            elif opt in ('--split-min', '--split-max', '--target-time'):
+                attr = opt[2:].replace('-', '_')
+                setattr(taskconf, attr, int(val))
+                if getattr(taskconf, attr) < 1:
+                    error("bad %s value '%s'" % (opt, val))
+
+            elif opt == '--schedule':
+                if val not in ('fifo', 'longest', 'weighted'):
+                    error("bad --schedule value '%s'" % val)
+
+                taskconf.schedule = val
+
+            elif opt == '--readahead':
+                taskconf.readahead = int(val)
+                if taskconf.readahead < 1:
+                    error("bad --readahead value '%s'" % val)
+
             else:
                 opt = opt[2:]
                 taskconf[opt.replace('-', '_')] = val
 
+        if taskconf.batch and taskconf.engine == 'events':
+            error("--batch isn't supported by --engine=events")
+
+        if taskconf.split_max:
+            if taskconf.engine != 'events':
+                error("--split-max requires --engine=events")
+
+            if not taskconf.hub_apikey:
+                error("--split-max requires a HUB APIKEY to launch workers")
+
+            if taskconf.split_max < (taskconf.split or 1):
+                error("--split-max can't be smaller than --split")
+
+            if taskconf.split_min > taskconf.split_max:
+                error("--split-min can't be larger than --split-max")
+
         if taskconf.workers:
             if isinstance(taskconf.workers, str):
                 if isfile(taskconf.workers):
@@ -320,40 +469,54 @@ class Task:
             if os.isatty(sys.stdin.fileno()):
                 usage()
 
-            jobs = []
-            for line in sys.stdin.readlines():
-                line = re.sub('#.*', '', line)
-                line = line.strip()
-                if not line:
-                    continue
-                args = shlex.split(line)
+            if taskconf.schedule == 'weighted':
+                weights = {}
 
-                if isinstance(command, str):
-                    job = command + ' ' + fmt_argv(args)
-                else:
-                    job = fmt_argv(command + args)
+            jobs = read_jobs(sys.stdin, command, weights)
 
-                jobs.append(job)
+            # a pipe may never end (e.g., tail -f)
+            drain = stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode)
 
-            if not jobs:
-                error("no jobs, nothing to do")
+        # read ahead a preview of jobs, the rest is streamed while we work
+        jobs = iter(jobs)
+        try:
+            preview = list(itertools.islice(jobs, taskconf.readahead + 1))
+        except ValueError, e:
+            error(e)
+        more = len(preview) > taskconf.readahead
+
+        if not preview:
+            error("no jobs, nothing to do")
 
         split = taskconf.split if taskconf.split else 1
-        if split > len(jobs):
-            split = len(jobs)
+
+        # no point in launching more workers than there are job batches
+        if not more:
+            batch = taskconf.batch if taskconf.batch else 1
+            batches = (len(preview) + batch - 1) / batch
+
+            if split > batches:
+                split = batches
         taskconf.split = split
 
         if len(taskconf.workers) < split and not taskconf.hub_apikey:
             error("please provide a HUB APIKEY or more pre-launched workers")
 
         if os.isatty(sys.stderr.fileno()) and not opt_force :
-            cls.confirm(taskconf, jobs)
+            cls.confirm(taskconf, preview, more)
 
         if not session:
             session = Session(opt_sessions)
+
+            # record new jobs in the session as they are read. The preview
+            # was read already, so it's recorded up front
+            for job in session.jobs.add(preview):
+                pass
+            jobs = session.jobs.add(jobs)
         session.taskconf = taskconf
 
-        ok = cls.work(jobs, session, taskconf)
+        jobs = itertools.chain(preview, jobs)
+        ok = cls.work(jobs, session, taskconf, weights, drain)
 
         if reporter:
             reporter.report(session)
@@ -362,7 +525,9 @@ class Task:
             sys.exit(1)
 
     @classmethod
-    def work(cls, jobs, session, taskconf):
+    def work(cls, jobs, session, taskconf, weights=None, drain=True):
+        """If drain, jobs we didn't get to are read (and recorded as pending)
+        even if we stopped early. Otherwise only jobs already read are."""
 
         if taskconf.ssh_identity:
             sshkey = ssh.PrivateKey(taskconf.ssh_identity)
@@ -376,6 +541,55 @@ class Task:
         status("(pid %d)" % os.getpid())
         print >> session.logs.manager
 
+        session.update_catalog(taskconf.command, running=True)
+
+        session.logs.buffer_size = taskconf.log_buffer
+        session.logs.flush_interval = taskconf.log_flush
+        session.logs.rotate = taskconf.log_rotate * 1024 * 1024
+        session.logs.compress = taskconf.log_compress
+
+        overlay = None
+        if taskconf.overlay:
+            # packed once and cached alongside the sessions
+            overlay = Overlay(taskconf.overlay, join(dirname(session.paths.path), 'overlays'))
+            status("overlay %s" % overlay)
+            print >> session.logs.manager
+
+        pool = None
+        if taskconf.hub_apikey:
+            # a pool per Hub account, so its reaper can destroy all its workers
+            pools = join(dirname(session.paths.path), 'pools')
+            makedirs(pools)
+
+            pool = Pool(join(pools, Pool.account(taskconf.hub_apikey)),
+                        Pool.fingerprint(taskconf, overlay), taskconf.pool_ttl)
+
+            parked = pool.workers()
+            if parked:
+                status("%d workers parked in the warm pool" % len(parked))
+                print >> session.logs.manager
+
+                # destroys workers that expired while no reaper was running
+                pool.reaper(taskconf.hub_apikey)
+
+        scheduler = None
+        if taskconf.schedule != 'fifo':
+            durations = Durations(dirname(session.paths.path), taskconf.command,
+                                  exclude=session.id)
+            status("scheduling longest jobs first (%d durations from previous sessions)" %
+                   len(durations))
+            print >> session.logs.manager
+
+            def estimate(job):
+                # kept after use, auto-resume reorders pending jobs by them
+                if weights and job in weights:
+                    return weights.get(job)
+
+                return durations.get(job)
+
+            scheduler = Scheduler(estimate, taskconf.readahead)
+            jobs = scheduler(jobs)
+
         class CaughtSignal(CloudWorker.Terminated):
             pass
 
@@ -388,7 +602,8 @@ class Task:
 
         exception = None
         while True:
-            watchdog = Watchdog(session.logs.manager, session.paths.workers, taskconf)
+            watchdog = Watchdog(session.logs.manager, session.paths.workers, taskconf,
+                                session.logs.events)
 
             signal.signal(signal.SIGINT, terminate)
             signal.signal(signal.SIGTERM, terminate)
@@ -397,7 +612,15 @@ class Task:
 
             work_started = time.time()
             try:
-                executor = CloudExecutor(session.logs, taskconf, sshkey)
+                # workers record job results in the session as they finish
+                session_jobs = Session.Jobs(session.paths.jobs, taskconf.journal_sync)
+
+                if taskconf.engine == 'events' and (taskconf.split > 1 or taskconf.split_max):
+                    Executor = EventExecutor
+                else:
+                    Executor = CloudExecutor
+
+                executor = Executor(session.logs, taskconf, sshkey, session_jobs, overlay, pool)
                 for job in jobs:
                     executor(job)
 
@@ -420,7 +643,13 @@ class Task:
             watchdog.terminate()
             watchdog.join()
 
-            session.jobs.update(jobs, executor_results)
+            # jobs we didn't get to are recorded as pending as we read them
+            if exception is None or drain:
+                for job in jobs:
+                    pass
+
+            session.jobs.reload()
+            session.jobs.save()
 
             if len(session.jobs.pending) != 0 and executor_results and exception is None:
                 print >> session.logs.manager
@@ -428,24 +657,49 @@ class Task:
                 print >> session.logs.manager
 
                 jobs = list(session.jobs.pending)
-                if taskconf.split > len(jobs):
-                    taskconf.split = len(jobs)
+                if scheduler:
+                    jobs = scheduler.order(jobs)
+
+                batch = taskconf.batch if taskconf.batch else 1
+                batches = (len(jobs) + batch - 1) / batch
+                if taskconf.split > batches:
+                    taskconf.split = batches
             else:
                 break
 
-        session_results = [ result for job, result in session.jobs.finished ]
+        if pool and pool.workers():
+            pool.reaper(taskconf.hub_apikey)
+
+        if session.jobs.fragmented:
+            session.jobs.compact()
+
+        counts = session.jobs.counts
 
-        succeeded = session_results.count("EXIT=0")
-        timeouts = session_results.count("TIMEOUT")
-        errors = len(session_results) - succeeded - timeouts
+        succeeded = counts.get("EXIT=0", 0)
+        timeouts = counts.get("TIMEOUT", 0)
+        pending = counts.get("PENDING", 0)
 
-        pending = len(session.jobs.pending)
-        total = len(session.jobs.finished) + pending
+        total = sum(counts.values())
+        errors = total - pending - succeeded - timeouts
 
         print >> session.logs.manager
         status("(%d seconds): %d/%d !OK - %d pending, %d timeouts, %d errors, %d OK" % \
                (time.time() - work_started, total - succeeded, total, pending, timeouts, errors, succeeded))
 
+        session.update_catalog(taskconf.command)
+
+        if pending == 0:
+            # finished sessions are exported for queries across sessions.
+            # The session is done, so failing to export doesn't fail it.
+            results = Results(join(dirname(session.paths.path), 'results'))
+            try:
+                results.export(session.paths.path)
+            except (Results.Error, EnvironmentError), e:
+                status("can't export results: %s" % e)
+            except Exception, e:
+                status("can't export results: %s" % e)
+                traceback.print_exc(file=session.logs.manager)
+
         ok = (total - succeeded == 0)
         return ok
 
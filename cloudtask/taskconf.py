@@ -19,12 +19,26 @@ class TaskConf:
     pre = None
     post = None
     overlay = None
+    overlay_fanout = 0
+    pool_ttl = 0
 
     timeout = 3600
     retries = 0
     strikes = 0
 
     split = None
+    split_min = None
+    split_max = None
+    target_time = 3600
+    batch = None
+    readahead = 10000
+    journal_sync = 0
+    log_buffer = 65536
+    log_flush = 1
+    log_rotate = 0
+    log_compress = 6
+    engine = 'processes'
+    schedule = 'fifo'
     workers = []
 
     hub_apikey = None
@@ -82,10 +96,10 @@ class TaskConf:
         sio = StringIO()
 
         table = []
-        for attr in ('split', 'command', 'ssh-identity', 'hub-apikey',
+        for attr in ('split', 'split-min', 'split-max', 'batch', 'command', 'ssh-identity', 'hub-apikey',
                      'ec2-region', 'ec2-size', 'ec2-type',
                      'user', 'backup-id', 'ami-id', 'snapshot-id', 'workers',
-                     'overlay', 'post', 'pre', 'timeout', 'report'):
+                     'overlay', 'overlay-fanout', 'pool-ttl', 'post', 'pre', 'timeout', 'report'):
 
             val = self[attr.replace('-', '_')]
             if isinstance(val, list):
@@ -2,13 +2,21 @@ import os
 from os.path import isdir, isfile, join
 
 import time
+import errno
 import signal
+import select
 from multiprocessing import Process
 
+import ctypes
+import ctypes.util
+
 import traceback
 import re
 
 import logalyzer
+from session import Session, makedirs
+from logwatch import Inotify
+from executor import CloudWorker
 from _hub import Hub
 
 class Error(Exception):
@@ -26,15 +34,56 @@ def get_ppid(pid):
                           for key,val in [  re.split(r':\t\s*', line) for line in status.splitlines() ]])
     return int(status_dict['ppid'])
 
+SYS_pidfd_open = 434
+
+def pidfd_open(pid):
+    """Returns a file descriptor that becomes readable when pid exits,
+    or None if pidfd_open(2) isn't available (i.e., Linux < 5.3)"""
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.syscall(SYS_pidfd_open, pid, 0)
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:
+        return None
+
+    return fd
+
 class SessionWatcher(object):
     class Worker:
-        def __init__(self, pid, mtime):
+        def __init__(self, pid, mtime, path=None):
             self.pid = pid
             self.mtime = mtime
+            self.path = path
+
+    # how often we check if the session exists, if we can't be notified
+    POLL_INTERVAL = 1
+
+    # how often we check on stuck workers until they are gone
+    STUCK_INTERVAL = 10
+
+    # how much of a worker log we read back to find its last status line
+    STATUS_TAIL = 4096
+
+    def __init__(self, session_pid, workers_path, poll=False, command=None):
+        """If command is given, workers that are stuck running it are
+        detected separately (see wait)"""
 
-    def __init__(self, session_pid, workers_path):
         self.session_pid = session_pid
         self.workers_path = workers_path
+        self.command = command
+
+        self.inotify = None
+        self.pidfd = None
+        if not poll:
+            try:
+                self.inotify = Inotify()
+            except Inotify.Error:
+                pass
+
+            self.pidfd = pidfd_open(session_pid)
 
     def active_workers(self):
         """returns list of tuples (worker_pid, worker_log_mtime)"""
@@ -49,7 +98,7 @@ class SessionWatcher(object):
                 continue
 
             try:
-                worker_pid = int(fname)
+                worker_pid = Session.Logs.worker_pid(int(fname))
             except ValueError:
                 continue
 
@@ -57,19 +106,155 @@ class SessionWatcher(object):
                 continue
 
             mtime = os.stat(fpath).st_mtime
-            active_workers.append(self.Worker(worker_pid, mtime))
+            active_workers.append(self.Worker(worker_pid, mtime, fpath))
 
         return active_workers
     active_workers = property(active_workers)
 
-    def idletime(self):
-        mtimes = [ worker.mtime for worker in self.active_workers ]
+    @staticmethod
+    def _idletime(workers):
+        mtimes = [ worker.mtime for worker in workers ]
         if not mtimes:
             return None
 
         return time.time() - max(mtimes)
+
+    def idletime(self):
+        return self._idletime(self.active_workers)
     idletime = property(idletime)
 
+    def _last_status(self, worker):
+        """returns the title of the last status line in worker's log"""
+
+        reader = Session.Logs.WorkerReader(worker.path)
+        try:
+            size = reader.stat()[1]
+            reader.seek(max(0, size - self.STATUS_TAIL))
+            tail = reader.read(self.STATUS_TAIL)
+        finally:
+            reader.close()
+
+        titles = [ title for timestamp, title in logalyzer.WorkersLog.STATUS.findall(tail) ]
+        return titles[-1].rstrip() if titles else None
+
+    def _running_job(self, worker):
+        title = self._last_status(worker)
+        return title is not None and title.startswith(self.command + " ")
+
+    def session_exists(self):
+        # we are the session's child, so we are reparented when it exits
+        return os.getppid() == self.session_pid
+
+    def _wait_workers(self):
+        """Wait for a worker log to be written to, or the session to exit"""
+
+        makedirs(self.workers_path)
+        wd = self.inotify.add_watch(self.workers_path,
+                                    Inotify.IN_MODIFY | Inotify.IN_CREATE | Inotify.IN_MOVED_TO)
+        try:
+            # a worker may have started before we were watching
+            if self.active_workers:
+                return
+
+            while self.session_exists():
+                if self._select([ self.inotify ], None):
+                    for path, mask, fname in self.inotify.read():
+                        parsed = Session.Logs.parse_worker_fname(fname)
+                        if parsed and parsed[1] is None:
+                            return
+        finally:
+            self.inotify.rm_watch(wd)
+
+    def _select(self, fds, timeout):
+        """Wait up to timeout seconds (None - forever) for fds to be readable
+        or the session to exit. Returns readable fds."""
+
+        if self.pidfd is not None:
+            fds = fds + [ self.pidfd ]
+        elif timeout is None or timeout > self.POLL_INTERVAL:
+            timeout = self.POLL_INTERVAL
+
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+
+        return [ fd for fd in readable if fd != self.pidfd ]
+
+    def wait(self, timeout, stuck=None):
+        """Wait until the session exits (returns None) or its active workers
+        have been idle for longer than timeout seconds (returns idletime).
+
+        We don't poll the worker logs. If the session is idle for idletime,
+        it can't be stuck before another timeout - idletime seconds have
+        passed, so that's when we check it next. If there are no active
+        workers, we wait for a worker log to be written to (with inotify,
+        or by checking every second).
+
+        If stuck, the workers that run in a process of their own are also
+        watched one by one: stuck(worker) is called every STUCK_INTERVAL
+        seconds for a worker that is running a job and hasn't written to
+        its log in over timeout seconds, until it does.
+        """
+
+        # workers we found idle, but not running a job: path -> mtime
+        idle = {}
+
+        deadline = 0
+        while self.session_exists():
+            now = time.time()
+            if now < deadline:
+                self._select([], deadline - now)
+                continue
+
+            workers = self.active_workers
+            idletime = self._idletime(workers)
+            if idletime is None:
+                if self.inotify:
+                    self._wait_workers()
+                else:
+                    deadline = now + self.POLL_INTERVAL
+                continue
+
+            if idletime > timeout:
+                return idletime
+
+            deadline = now + timeout - idletime + 0.1
+            if not stuck or not self.command:
+                continue
+
+            # an idle worker may start a job without us noticing
+            deadline = min(deadline, now + timeout)
+
+            for worker in workers:
+                # workers in the session's process can't be stopped on their own
+                if worker.pid == self.session_pid or idle.get(worker.path) == worker.mtime:
+                    continue
+
+                if now - worker.mtime <= timeout:
+                    deadline = min(deadline, worker.mtime + timeout + 0.1)
+                    continue
+
+                if not self._running_job(worker):
+                    idle[worker.path] = worker.mtime
+                    continue
+
+                stuck(worker)
+                deadline = min(deadline, now + self.STUCK_INTERVAL)
+
+        return None
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
 class Retrier:
     def __init__(self, timeout, errorsleep, errorlog=None):
         self.timeout = timeout
@@ -103,34 +288,47 @@ class Watchdog:
     def log(self, s):
         self.logfh.write("# watchdog: %s\n" % s)
 
+    def stuck(self, worker):
+        """Stop a worker stuck running a job, so its job is put back into
+        the queue while the other workers keep going"""
+
+        signalled = self.stuck_workers.get(worker.pid)
+        if signalled is None:
+            self.log("worker %d stuck after %d seconds" % (worker.pid, time.time() - worker.mtime))
+            sig, signame = CloudWorker.STUCK_SIGNAL, "USR1"
+
+        # the worker didn't stop, no more Mr. Nice Guy
+        elif time.time() - signalled > self.SIGTERM_TIMEOUT:
+            sig, signame = signal.SIGKILL, "KILL"
+
+        else:
+            return
+
+        self.stuck_workers[worker.pid] = time.time()
+        try:
+            self.log("kill -%s %d" % (signame, worker.pid))
+            os.kill(worker.pid, sig)
+        except:
+            traceback.print_exc(file=self.logfh)
+
     def watch(self):
         timeout = self.taskconf.timeout * 2
 
         session_pid = os.getppid()
-        watcher = SessionWatcher(session_pid, self.path_workers)
+        watcher = SessionWatcher(session_pid, self.path_workers, command=self.taskconf.command)
 
-        idletime = None
-        
         # wait while the session exists and is not idle so long we consider it stuck
-        while pid_exists(session_pid):
-            time.sleep(1)
-
-            idletime = watcher.idletime
-            if idletime is None:
-                continue
-
-            if idletime > timeout:
-                break
-
+        idletime = watcher.wait(timeout, self.stuck)
+        watcher.close()
 
-        if idletime and idletime > timeout:
+        if idletime:
             self.log("session idle after %d seconds" % idletime)
 
             # SIGTERM active workers
-            for worker in watcher.active_workers:
+            for pid in set([ worker.pid for worker in watcher.active_workers ]):
                 try:
-                    self.log("kill -TERM %d" % worker.pid)
-                    os.kill(worker.pid, signal.SIGTERM)
+                    self.log("kill -TERM %d" % pid)
+                    os.kill(pid, signal.SIGTERM)
                 except:
                     traceback.print_exc(file=self.logfh)
 
@@ -143,10 +341,10 @@ class Watchdog:
                     break
 
             # no more Mr. Nice Guy: SIGKILL workers that are still alive
-            for worker in watcher.active_workers:
+            for pid in set([ worker.pid for worker in watcher.active_workers ]):
                 try:
-                    self.log("kill -KILL %d" % worker.pid)
-                    os.kill(worker.pid, signal.SIGKILL)
+                    self.log("kill -KILL %d" % pid)
+                    os.kill(pid, signal.SIGKILL)
                 except:
                     traceback.print_exc(file=self.logfh)
 
@@ -177,7 +375,9 @@ class Watchdog:
     def cleanup(self):
 
         def get_zombie_instances():
-            wl = logalyzer.WorkersLog(self.path_workers, self.taskconf.command)
+            wl = logalyzer.WorkersLog(self.path_workers, self.taskconf.command,
+                                      index=self.path_workers + ".index",
+                                      events=self.events.path if self.events else None)
             for worker in wl.workers:
                 if worker.instanceid and not worker.instancetime:
                     yield worker
@@ -198,14 +398,23 @@ class Watchdog:
             if zombie_worker.instanceid not in destroyed_instances:
                 continue
             worker_log = file("%s/%d" % (self.path_workers, zombie_worker.worker_id), "a")
-            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+            now = time.time()
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
             print >> worker_log, "\n# %s [watchdog] destroyed worker %s" % (timestamp, zombie_worker.instanceid)
             worker_log.close()
 
-    def __init__(self, logfh, path_workers, taskconf):
+            if self.events:
+                self.events.record(now, zombie_worker.worker_id, 'destroy', zombie_worker.instanceid)
+
+    def __init__(self, logfh, path_workers, taskconf, events=None):
+        """events is the session's Session.Events (if any)"""
         self.logfh = logfh
         self.path_workers = path_workers
         self.taskconf = taskconf
+        self.events = events
+
+        # pid -> when we signalled it was stuck
+        self.stuck_workers = {}
 
         self.process = Process(target=self.run)
         self.process.start()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# 
+# Copyright (c) 2012 Liraz Siri <liraz@turnkeylinux.org>
+# 
+# This file is part of CloudTask.
+# 
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+# 
+
+"""
+Compact the jobs journal of one or more sessions
+
+The jobs journal of a session records every change in the state of a job.
+Compaction rewrites it with a single record per job. Sessions in the old
+jobs file format are rewritten in the journal format and indexed.
+
+Don't compact a session that is still running.
+
+Usage examples:
+
+    cloudtask-compact-jobs ~/.cloudtask/1
+    cloudtask-compact-jobs ~/.cloudtask/*
+
+"""
+
+from os.path import *
+import sys
+import getopt
+
+from cloudtask.session import Session
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Usage: %s path/to/session [ ... ]" % sys.argv[0]
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def fatal(e):
+    print >> sys.stderr, "error: " + str(e)
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 
+                                       'h', [ 'help' ])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+    if not args:
+        usage()
+
+    for session_path in args:
+        if not isdir(session_path):
+            fatal("not a directory '%s'" % session_path)
+
+    for session_path in args:
+        path = Session.Paths(session_path).jobs
+        if not exists(path):
+            continue
+
+        jobs = Session.Jobs(path)
+        jobs.compact()
+
+        counts = jobs.counts
+        print "%s: %d jobs (%s)" % (session_path, sum(counts.values()),
+                                     ", ".join([ "%d %s" % (counts[state], state) 
+                                                 for state in sorted(counts) ]))
+
+if __name__ == "__main__":
+    main()
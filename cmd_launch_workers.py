@@ -46,6 +46,9 @@ Options:
 
     --install-updates  Install security updates (by default they're skipped)
 
+    --batch=N          Launch at least N workers per launch call (default: 10)
+    --concurrency=N    Run up to N launch calls at the same time (default: 8)
+
 Usage examples:
 
     # create workers.txt file with list of new worker addresses
@@ -64,7 +67,10 @@ import getopt
 import signal
 from sighandle import sighandle
 
+from Queue import Queue, Empty
+
 from cloudtask import Hub
+from cloudtask._hub import Launcher
 from lazyclass import lazyclass
 
 def usage(e=None):
@@ -96,12 +102,17 @@ def main():
         opts, args = getopt.gnu_getopt(sys.argv[1:], 
                                        'h', [ 'help',
                                               'install-updates',
-                                              'hub-apikey=' ] + 
+                                              'hub-apikey=',
+                                              'batch=',
+                                              'concurrency=' ] + 
                                             [ key.replace('_', '-') + '=' 
                                               for key in kwargs ])
     except getopt.GetoptError, e:
         usage(e)
 
+    opt_batch = Launcher.BATCH
+    opt_concurrency = Launcher.CONCURRENCY
+
     for opt, val in opts:
         if opt in ('-h', '--help'):
             usage()
@@ -112,6 +123,19 @@ def main():
         if opt == '--install-updates':
             kwargs['sec_updates'] = 'INSTALL'
 
+        if opt in ('--batch', '--concurrency'):
+            try:
+                val = int(val)
+                if val < 1:
+                    raise ValueError
+            except ValueError:
+                usage("illegal %s value '%s'" % (opt, val))
+
+            if opt == '--batch':
+                opt_batch = val
+            else:
+                opt_concurrency = val
+
         for key in kwargs:
             if opt == '--' + key.replace('_', '-'):
                 kwargs[key] = val
@@ -152,9 +176,28 @@ def main():
         def callback():
             return not stopped.value
 
-        for ipaddress, instanceid in Hub(hub_apikey).launch(howmany, logfh=sys.stderr, callback=callback, **kwargs):
-            print >> output, ipaddress
-            output.flush()
+        queue = Queue()
+        Launcher(Hub(hub_apikey), queue, sys.stderr, callback,
+                 opt_batch, opt_concurrency, **kwargs).launch(howmany)
+
+        launched = 0
+        for i in range(howmany):
+            # poll so SIGINT isn't blocked while we wait
+            while True:
+                try:
+                    instance = queue.get(timeout=1)
+                    break
+                except Empty:
+                    pass
+
+            if instance:
+                ipaddress, instanceid = instance
+                print >> output, ipaddress
+                output.flush()
+                launched += 1
+
+    if launched < howmany:
+        fatal("launched %d/%d workers" % (launched, howmany))
 
 if __name__ == "__main__":
     main()
@@ -13,6 +13,10 @@
 """
 Analyze session logs
 
+Options:
+
+    -j --jobs=N     Parse worker logs in N processes (default: 1)
+
 """
 
 from os.path import *
@@ -25,7 +29,7 @@ def usage(e=None):
     if e:
         print >> sys.stderr, "error: " + str(e)
 
-    print >> sys.stderr, "Usage: %s path/to/session [ path/to/outputs/ ]" % sys.argv[0]
+    print >> sys.stderr, "Usage: %s [ -opts ] path/to/session [ path/to/outputs/ ]" % sys.argv[0]
     print >> sys.stderr, __doc__.strip()
     sys.exit(1)
 
@@ -37,14 +41,25 @@ def main():
 
     try:
         opts, args = getopt.gnu_getopt(sys.argv[1:], 
-                                       'h', [ 'help' ])
+                                       'hj:', [ 'help', 'jobs=' ])
     except getopt.GetoptError, e:
         usage(e)
 
+    opt_jobs = 1
+
     for opt, val in opts:
         if opt in ('-h', '--help'):
             usage()
 
+        if opt in ('-j', '--jobs'):
+            try:
+                opt_jobs = int(val)
+            except ValueError:
+                opt_jobs = 0
+
+            if opt_jobs < 1:
+                fatal("bad --jobs value '%s'" % val)
+
     if len(args) < 1:
         usage()
 
@@ -61,7 +76,7 @@ def main():
     else:
         outputs_dir = None
 
-    print logalyzer.logalyzer(session_path, outputs_dir)
+    print logalyzer.logalyzer(session_path, outputs_dir, opt_jobs)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+"""
+Query job results across sessions
+
+Queries:
+
+    summary         Jobs and failures of each session (default)
+    slower          Jobs that took longer to succeed in recent sessions
+    flaky           Jobs that both succeeded and failed
+    history <job>   Every run of a job
+
+Options:
+
+    --sessions=PATH     Path where sessions are stored
+                        (default: $CLOUDTASK_SESSIONS or $HOME/.cloudtask)
+
+    --command=COMMAND   Only query sessions of this task command
+    --last=N            Only query the N most recent sessions
+    --recent=N          Sessions slower compares with those before them
+                        (default: 5)
+
+    --top=N             Print at most N rows (default: 20, 0 for all)
+    --no-update         Don't export finished sessions before querying
+
+"""
+
+import os
+from os.path import *
+import sys
+import time
+import getopt
+
+from cloudtask.results import Results
+from cloudtask.logalyzer import fmt_table, fmt_elapsed
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Usage: %s [ -opts ] [ query ]" % sys.argv[0]
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def fatal(e):
+    print >> sys.stderr, "error: " + str(e)
+    sys.exit(1)
+
+def fmt_timestamp(timestamp):
+    if timestamp is None:
+        return "-"
+
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+def fmt_exitcode(exitcode):
+    if exitcode == Results.TIMEOUT:
+        return "timeout"
+
+    if exitcode == Results.ABORTED:
+        return "aborted"
+
+    return "exit %d" % exitcode
+
+def main():
+
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:],
+                                       'h', [ 'help', 'sessions=', 'command=',
+                                              'last=', 'recent=', 'top=',
+                                              'no-update' ])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    opt_sessions = os.environ.get('CLOUDTASK_SESSIONS',
+                                  join(os.environ['HOME'], '.cloudtask'))
+    opt_command = None
+    opt_last = None
+    opt_recent = 5
+    opt_top = 20
+    opt_update = True
+
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == '--sessions':
+            opt_sessions = val
+
+        elif opt == '--command':
+            opt_command = val
+
+        elif opt in ('--last', '--recent', '--top'):
+            try:
+                val = int(val)
+            except ValueError:
+                val = -1
+
+            if val < (0 if opt == '--top' else 1):
+                fatal("bad %s value" % opt)
+
+            if opt == '--last':
+                opt_last = val
+            elif opt == '--recent':
+                opt_recent = val
+            else:
+                opt_top = val
+
+        elif opt == '--no-update':
+            opt_update = False
+
+    if not args:
+        args = [ 'summary' ]
+
+    query = args[0]
+    if query not in ('summary', 'slower', 'flaky', 'history'):
+        usage("unknown query '%s'" % query)
+
+    if (query == 'history') != (len(args) == 2) or len(args) > 2:
+        usage()
+
+    if not isdir(opt_sessions):
+        fatal("no such directory '%s'" % opt_sessions)
+
+    results = Results(join(opt_sessions, 'results'))
+
+    try:
+        if opt_update:
+            results.update(opt_sessions)
+
+        table = results.load()
+    except Results.Error, e:
+        fatal(e)
+
+    sessions = table.select(opt_command, opt_last)
+
+    if query == 'summary':
+        title = [ "session", "command", "started", "jobs", "failed", "worktime" ]
+        rows = [ (session.id, table.names[session.command], fmt_timestamp(started),
+                  jobs, failed, fmt_elapsed(worktime))
+                 for session, started, jobs, failed, worktime
+                 in reversed(table.summary(sessions)) ]
+
+    elif query == 'slower':
+        if len(sessions) <= opt_recent:
+            fatal("slower needs more than %d sessions to compare (see --recent)" % opt_recent)
+
+        title = [ "job", "runs before", "before", "runs recently", "recently", "change" ]
+        rows = [ (job, runs_before, fmt_elapsed(int(avg_before)),
+                  runs_after, fmt_elapsed(int(avg_after)),
+                  "+%d%%" % ((avg_after - avg_before) * 100 / max(avg_before, 1)))
+                 for job, runs_before, avg_before, runs_after, avg_after
+                 in table.slower(sessions, opt_recent) ]
+
+    elif query == 'flaky':
+        title = [ "job", "runs", "failures", "last failed" ]
+        rows = [ (job, runs, failures, "session %d" % last_failed)
+                 for job, runs, failures, last_failed in table.flaky(sessions) ]
+
+    elif query == 'history':
+        title = [ "session", "worker", "result", "started", "elapsed" ]
+        rows = [ (session.id, worker, fmt_exitcode(exitcode),
+                  fmt_timestamp(started), fmt_elapsed(elapsed))
+                 for session, worker, exitcode, started, elapsed
+                 in reversed(table.history(sessions, args[1])) ]
+
+    if opt_top:
+        rows = rows[:opt_top]
+
+    if rows:
+        print fmt_table(rows, title),
+
+if __name__ == "__main__":
+    main()
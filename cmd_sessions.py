@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+"""
+List sessions
+
+Arguments:
+
+    session-id      Only list these sessions
+
+Options:
+
+    --sessions=PATH     Path where sessions are stored
+                        (default: $CLOUDTASK_SESSIONS or $HOME/.cloudtask)
+
+    --last=N            List the N most recent sessions (default: 20, 0 for all)
+    --status=STATUS     Only list sessions with this status
+                        (running, done, failed or stopped)
+
+    --scan              Add sessions missing from the catalog (e.g., created
+                        by older versions) by scanning the sessions path
+
+"""
+
+import os
+from os.path import *
+import sys
+import time
+import getopt
+
+from cloudtask.session import Session
+from cloudtask.logalyzer import fmt_table, fmt_elapsed
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Usage: %s [ -opts ] [ session-id ... ]" % sys.argv[0]
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def fatal(e):
+    print >> sys.stderr, "error: " + str(e)
+    sys.exit(1)
+
+def fmt_timestamp(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+def main():
+
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:],
+                                       'h', [ 'help', 'sessions=', 'last=',
+                                              'status=', 'scan' ])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    opt_sessions = os.environ.get('CLOUDTASK_SESSIONS',
+                                  join(os.environ['HOME'], '.cloudtask'))
+    opt_last = 20
+    opt_status = None
+    opt_scan = False
+
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == '--sessions':
+            opt_sessions = val
+
+        elif opt == '--last':
+            try:
+                opt_last = int(val)
+            except ValueError:
+                opt_last = -1
+
+            if opt_last < 0:
+                fatal("bad --last value '%s'" % val)
+
+        elif opt == '--status':
+            if val not in Session.Catalog.STATUSES:
+                fatal("bad --status value '%s'" % val)
+
+            opt_status = val
+
+        elif opt == '--scan':
+            opt_scan = True
+
+    try:
+        ids = [ int(arg) for arg in args ]
+    except ValueError:
+        usage("session id must be an integer")
+
+    if not isdir(opt_sessions):
+        fatal("no such directory '%s'" % opt_sessions)
+
+    catalog = Session.Catalog(join(opt_sessions, 'catalog'))
+
+    if opt_scan:
+        added = catalog.scan(opt_sessions)
+        print >> sys.stderr, "added %d sessions to the catalog" % len(added)
+
+    if ids:
+        records = []
+        for id in ids:
+            record = catalog.get(id)
+            if not record:
+                fatal("no such session in catalog '%d'" % id)
+            records.append(record)
+
+    elif opt_status:
+        records = [ record for record in catalog.records()
+                    if record.status == opt_status ]
+        if opt_last:
+            records = records[-opt_last:]
+
+    else:
+        records = catalog.records(opt_last)
+
+    if not ids:
+        records.reverse()
+
+    now = time.time()
+
+    rows = []
+    for record in records:
+        elapsed = (record.ended if record.ended else now) - record.started
+        rows.append((record.id, record.status, fmt_timestamp(record.started),
+                     fmt_elapsed(max(0, int(elapsed))),
+                     "%d/%d" % (record.ok, record.jobs), record.failed, record.pending,
+                     record.pid if record.status == 'running' else '-',
+                     record.command))
+
+    if rows:
+        print fmt_table(rows, [ "session", "status", "started", "elapsed", "ok",
+                                "failed", "pending", "pid", "command" ]),
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+"""
+Replay the job durations of a session to compare schedules
+
+Simulates executing the session's jobs on its workers, in the order they
+were read (fifo) and longest first (see cloudtask --schedule), and prints
+how long each schedule takes to finish (makespan) and how busy it keeps
+the workers (efficiency).
+
+Options:
+
+    --split=       Number of workers to simulate (default: session's split)
+    --readahead=   Jobs are ordered within windows of this many jobs
+                   (default: session's readahead)
+
+Usage examples:
+
+    cloudtask-simulate-schedule ~/.cloudtask/1
+    cloudtask-simulate-schedule --split=20 ~/.cloudtask/1
+
+"""
+
+from os.path import *
+import sys
+import getopt
+
+from cloudtask.session import Session
+from cloudtask.taskconf import TaskConf
+from cloudtask.scheduler import Scheduler, simulate
+from cloudtask.logalyzer import WorkersLog, fmt_elapsed
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Usage: %s [ -opts ] path/to/session" % sys.argv[0]
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def fatal(e):
+    print >> sys.stderr, "error: " + str(e)
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:],
+                                       'h', [ 'help', 'split=', 'readahead=' ])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    opt_split = None
+    opt_readahead = None
+
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        try:
+            val = int(val)
+        except ValueError:
+            fatal("bad %s value '%s'" % (opt, val))
+
+        if val < 1:
+            fatal("bad %s value '%d'" % (opt, val))
+
+        if opt == '--split':
+            opt_split = val
+
+        elif opt == '--readahead':
+            opt_readahead = val
+
+    if len(args) != 1:
+        usage()
+
+    session_path = args[0]
+    if not isdir(session_path):
+        fatal("not a directory '%s'" % session_path)
+
+    paths = Session.Paths(session_path)
+    conf = eval(file(paths.conf).read())
+    command = conf['command']
+
+    split = opt_split or conf.get('split') or 1
+    readahead = opt_readahead or conf.get('readahead') or TaskConf.readahead
+
+    durations = dict([ ("%s %s" % (command, job.name), job.elapsed)
+                       for job in WorkersLog(paths.workers, command,
+                                             index=paths.workers + ".index",
+                                             events=paths.events).jobs ])
+
+    jobs = [ job for job in Session.Jobs(paths.jobs).commands
+             if job in durations ]
+
+    if not jobs:
+        fatal("no job durations recorded in '%s'" % session_path)
+
+    schedules = (('fifo', jobs),
+                 ('longest', list(Scheduler(durations.get, readahead)(jobs))))
+
+    worktime = sum(durations[job] for job in jobs)
+    print "%d jobs on %d workers, %s work time" % (len(jobs), split, fmt_elapsed(worktime))
+    print
+
+    for name, schedule in schedules:
+        makespan = simulate([ durations[job] for job in schedule ], split)
+        efficiency = worktime * 100 / (makespan * split) if makespan else 100
+
+        print "%-10s makespan %s, efficiency %d%%" % (name, fmt_elapsed(makespan), efficiency)
+
+if __name__ == "__main__":
+    main()
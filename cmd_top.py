@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of CloudTask.
+#
+# CloudTask is open source software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+
+"""
+Live view of a session's progress
+
+Shows jobs finished and pending, throughput and ETA, and what each worker
+is doing. The session's logs are tailed as they grow (with inotify, where
+available) so watching large sessions is cheap.
+
+Options:
+
+    -i --interval=SECS  Refresh the view every SECS seconds (default: 2)
+    -1 --once           Print the view once and exit
+       --poll           Poll the logs for changes instead of using inotify
+
+Usage examples:
+
+    cloudtask-top ~/.cloudtask/1
+    cloudtask-top --once ~/.cloudtask/1
+
+"""
+
+from os.path import *
+import sys
+import time
+import getopt
+import fcntl
+import struct
+import termios
+
+from cloudtask.dashboard import Dashboard
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Usage: %s [ -opts ] path/to/session" % sys.argv[0]
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def fatal(e):
+    print >> sys.stderr, "error: " + str(e)
+    sys.exit(1)
+
+def terminal_height():
+    try:
+        return struct.unpack('hh', fcntl.ioctl(sys.stdout, termios.TIOCGWINSZ, '1234'))[0]
+    except IOError:
+        return None
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:],
+                                       'hi:1', [ 'help', 'interval=', 'once', 'poll' ])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    opt_interval = 2
+    opt_once = False
+    opt_poll = False
+
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt in ('-i', '--interval'):
+            try:
+                opt_interval = float(val)
+            except ValueError:
+                opt_interval = 0
+
+            if opt_interval <= 0:
+                fatal("bad --interval value '%s'" % val)
+
+        elif opt in ('-1', '--once'):
+            opt_once = True
+
+        elif opt == '--poll':
+            opt_poll = True
+
+    if len(args) != 1:
+        usage()
+
+    session_path = args[0]
+    if not isdir(session_path):
+        fatal("not a directory '%s'" % session_path)
+
+    dashboard = Dashboard(session_path, opt_poll)
+    dashboard.update()
+
+    if opt_once:
+        print dashboard.fmt(),
+        return
+
+    try:
+        while True:
+            # clear screen
+            sys.stdout.write("\033[H\033[2J" + dashboard.fmt(height=terminal_height()))
+            sys.stdout.flush()
+
+            deadline = time.time() + opt_interval
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+
+                dashboard.update(timeout)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        dashboard.close()
+
+if __name__ == "__main__":
+    main()
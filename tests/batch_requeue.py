@@ -0,0 +1,153 @@
+#!/usr/bin/python
+"""Check that a worker cut short in the middle of a batch only puts back
+the jobs that didn't finish, so every job is journaled exactly once.
+
+We run batches on CloudWorkers with a fake SSH connection that replays
+the output of the batch script (per-job start and exit markers), and
+either dies after a few jobs or exits with failures until the worker
+strikes out. Whatever is left of the batch is then run by a healthy
+worker, like Parallelize does when it puts a job back into the queue.
+"""
+import re
+import shutil
+import tempfile
+from os.path import join
+
+from cloudtask.session import Session
+from cloudtask.executor import CloudWorker, Job, JobBatch
+
+class FakeLog:
+    offset = 0
+    status_offset = 0
+
+    def __init__(self):
+        self.status = self
+
+    def write(self, buf):
+        pass
+
+    def poll(self):
+        pass
+
+class FakeLogs:
+    worker_id = 1
+    events = None
+
+    def __init__(self):
+        self.worker = FakeLog()
+        self.manager = FakeLog()
+
+class FakeCommand:
+    """Replays the output of a batch script, exiting with exitcode(command)
+    or dying when the job at index <dies_at> starts"""
+
+    def __init__(self, script, exitcode, dies_at):
+        self.jobs = re.findall(r'^echo (\S+) (\d+) start; \((.*)$', script, re.M)
+        self.exitcodes = exitcode
+        self.dies_at = dies_at
+
+        self.running = True
+        self.exitcode = None
+        self.output = ""
+
+    def read(self, handler):
+        for token, i, command in self.jobs:
+            handler(self, "%s %s start\noutput of %s" % (token, i, command))
+            if int(i) == self.dies_at:
+                raise CloudWorker.WorkerDied("connection lost")
+
+            handler(self, "\n%s %s exit %d\n" % (token, i, self.exitcodes(command)))
+
+        self.running = False
+        self.exitcode = 0
+
+    def terminate(self):
+        pass
+
+class FakeSSH:
+    TIMEOUT = 30
+
+    def __init__(self, exitcode, dies_at):
+        self.exitcode = exitcode
+        self.dies_at = dies_at
+
+    def command(self, script, pty=False):
+        return FakeCommand(script, self.exitcode, self.dies_at)
+
+class Worker(CloudWorker):
+    def __init__(self, session_jobs, strikes=None, exitcode=lambda command: 0, dies_at=None):
+        self.pid = None
+        self.ipaddress = "10.0.0.1"
+        self.session_jobs = session_jobs
+        self.logs = FakeLogs()
+        self.signals = False
+        self.handle_stop = self._stop_handler(None)
+
+        self.strikes = strikes
+        self.strike = 0
+        self.timeout = None
+
+        self.ssh = FakeSSH(exitcode, dies_at)
+
+def run(jobs, *workers):
+    """Runs a batch of jobs on each worker in turn until one finishes it.
+    Returns the results of the worker that finished it."""
+
+    batch = JobBatch(jobs)
+    for worker in workers:
+        try:
+            return worker._execute_batch(batch)
+        except CloudWorker.Terminated:
+            continue
+
+    raise AssertionError("batch wasn't finished: %r" % [ job.command for job in batch.jobs ])
+
+def journaled(session_jobs):
+    results = {}
+    for line in file(session_jobs.path):
+        state, command = line.rstrip("\n").split("\t", 1)
+        if state != Session.Jobs.PENDING:
+            results[command] = results.get(command, 0) + 1
+
+    return results
+
+def check(tmpdir, name, commands, *workers_args):
+    session_jobs = Session.Jobs(join(tmpdir, name))
+    list(session_jobs.add(commands))
+
+    workers = [ Worker(session_jobs, **kwargs) for kwargs in workers_args ]
+    results = run([ Job(command, 1) for command in commands ], *workers)
+
+    assert set([ command for command, exitcode in results ]) <= set(commands)
+    assert journaled(session_jobs) == dict([ (command, 1) for command in commands ]), \
+           journaled(session_jobs)
+    assert not session_jobs.pending
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        commands = [ "job%d" % i for i in range(10) ]
+
+        # worker dies while running the 5th job of the batch
+        check(tmpdir, "died", commands,
+              dict(dies_at=4), dict())
+
+        # worker strikes out on the 3rd failure, jobs after it succeed
+        failing = set([ "job1", "job3", "job5" ])
+        check(tmpdir, "struck-out", commands,
+              dict(strikes=3, exitcode=lambda command: int(command in failing)),
+              dict())
+
+        # worker dies, then the next one strikes out, then one finishes
+        check(tmpdir, "died-struck-out", commands,
+              dict(dies_at=2),
+              dict(strikes=2, exitcode=lambda command: int(command in failing)),
+              dict())
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+"""Check analyzing a session from its worker events (Session.Events).
+
+We record worker logs and events the way CloudWorker does, and check
+that WorkersLog finds the same jobs and instance times from the events
+as from the logs, that the output offsets in the events are of the job's
+output in the worker log, that workers without events are still
+analyzed from their logs, and that a partially written or malformed
+event is skipped.
+"""
+import os
+import time
+import shutil
+import tempfile
+from os.path import join
+
+from cloudtask.session import Session
+from cloudtask.logalyzer import WorkersLog
+
+COMMAND = "build"
+
+# 2012-01-01 00:00:00 local time
+EPOCH = time.mktime((2012, 1, 1, 0, 0, 0, 0, 1, -1))
+
+class Worker:
+    """Records a worker log and events like CloudWorker"""
+
+    def __init__(self, paths, worker_id, events):
+        self.logs = Session.Logs.Worker(paths.workers, False, worker_id)
+        self.worker_id = worker_id
+        self.events = events
+
+    def status(self, now, msg, after_output=False):
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(EPOCH + now))
+        c = "\n" if after_output else ""
+        self.logs.write_status(c + "# %s [10.0.0.1] %s\n" % (timestamp, msg))
+        return EPOCH + now
+
+    def event(self, timestamp, type, *fields):
+        if self.events:
+            self.events.record(timestamp, self.worker_id, type, *fields)
+
+    def launch(self, now, instanceid, verb='launched', type='launch'):
+        self.event(self.status(now, "%s worker %s" % (verb, instanceid)), type, instanceid, "10.0.0.1")
+
+    def destroy(self, now, instanceid, verb='destroyed', type='destroy'):
+        self.event(self.status(now, "%s worker %s" % (verb, instanceid)), type, instanceid)
+
+    def job(self, now, elapsed, command, output, result):
+        started = self.status(now, command)
+        output_start = self.logs.offset
+        self.event(started, 'start', output_start, command)
+
+        self.logs.write(output)
+
+        ended = self.status(now + elapsed, "%s # %s" % (result, command), True)
+        self.event(ended, 'end', "%.3f" % started, result,
+                   output_start, self.logs.status_offset, command)
+        self.logs.flush()
+
+def record(paths, events):
+    """Records a session with three workers. Returns dict of job name ->
+    (result, elapsed, output)"""
+
+    expected = {}
+
+    def job(worker, now, elapsed, name, result):
+        output = "".join([ "%s: line %d\n" % (name, i) for i in range(elapsed) ])
+        worker.job(now, elapsed, "%s %s" % (COMMAND, name), output, result)
+        expected[name] = (result, elapsed, output.strip())
+
+    worker = Worker(paths, 1, events)
+    worker.launch(0, "i-1")
+    job(worker, 10, 30, "foo", "exit 0")
+    job(worker, 40, 20, "(a+b)*", "exit 1")
+    job(worker, 60, 5, "tab\there", "timeout")
+    worker.destroy(100, "i-1")
+
+    # claimed from and parked in the warm pool
+    worker = Worker(paths, 2, events)
+    worker.launch(5, "i-2", 'claimed', 'claim')
+    job(worker, 10, 50, "bar", "exit 0")
+    worker.destroy(70, "i-2", 'parked', 'park')
+
+    # a worker of a version that didn't record events
+    worker = Worker(paths, 3, None)
+    worker.launch(0, "i-3")
+    job(worker, 10, 15, "baz", "exit 2")
+
+    return expected
+
+def analyze(paths, events=None):
+    workerslog = WorkersLog(paths.workers, COMMAND, events=events)
+
+    jobs = dict([ (job.name, (job.result, job.elapsed, job.output))
+                  for job in workerslog.jobs ])
+    workers = sorted([ (worker.worker_id, worker.instanceid, worker.jobs,
+                        worker.instancetime, worker.worktime)
+                       for worker in workerslog.workers ])
+
+    return jobs, workers
+
+def test_analysis(tmpdir):
+    paths = Session.Paths(tmpdir)
+    os.mkdir(paths.workers)
+
+    events = Session.Events(paths.events)
+    expected = record(paths, events)
+    events.close()
+
+    scanned = analyze(paths)
+    from_events = analyze(paths, paths.events)
+
+    assert from_events == scanned
+    assert from_events[0] == expected
+    assert from_events[1] == [ (1, "i-1", 3, 100, 55), (2, "i-2", 1, 65, 50), (3, "i-3", 1, None, 15) ]
+
+    # the tails are read from the worker log when needed
+    for job in WorkersLog(paths.workers, COMMAND, events=paths.events).jobs:
+        assert job.output_tail == "\n".join(expected[job.name][2].splitlines()[-WorkersLog.TAIL_LINES:])
+
+    # analyzed from the events, not the worker logs
+    fh = file(join(paths.workers, "1"), "r+")
+    fh.truncate(0)
+    fh.close()
+
+    jobs, workers = analyze(paths, paths.events)
+    assert sorted(jobs) == sorted(expected)
+
+def test_events(path):
+    events = Session.Events(path)
+    events.record(EPOCH, 1, 'launch', "i-1", "10.0.0.1")
+    events.record(EPOCH + 1, 1, 'end', "%.3f" % EPOCH, "exit 0", 10, 20, "build\ttab\nnewline")
+    events.record(EPOCH + 2, 1, 'retry', 1, 3, "build foo")
+    events.close()
+
+    fh = file(path, "a")
+    fh.write("%.3f\t1\tunknown\tfoo\n" % EPOCH)
+    fh.write("%.3f\t1\tdestroy\n" % EPOCH)
+    fh.write("%.3f\t1\tdestroy\ti-1" % EPOCH)
+    fh.close()
+
+    parsed = list(Session.Events(path))
+    assert [ event.type for event in parsed ] == [ 'launch', 'end', 'retry' ]
+
+    launch, end, retry = parsed
+    assert (launch.timestamp, launch.worker_id, launch.instanceid) == (EPOCH, 1, "i-1")
+    assert (end.started, end.result, end.output_start, end.output_end) == (EPOCH, "exit 0", 10, 20)
+
+    # only the last field may contain tabs
+    assert end.command == "build\ttab newline"
+    assert (retry.retry, retry.limit, retry.command) == (1, 3, "build foo")
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.mkdir(join(tmpdir, "session"))
+        test_analysis(join(tmpdir, "session"))
+        test_events(join(tmpdir, "events"))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+if __name__ == "__main__":
+    main()
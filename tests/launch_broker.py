@@ -0,0 +1,129 @@
+#!/usr/bin/python
+"""Check launching workers through the Launcher, against an offline FakeHub.
+
+Requests that arrive together are coalesced into launch calls of at
+least <batch> workers, spread over up to <concurrency> concurrent launch
+calls. Every requested worker is put on the queue once, as an instance
+or None if it failed to launch (e.g., the launch call failed or we were
+stopped), and time to first worker and to full fleet are reported.
+"""
+import threading
+from Queue import Queue
+from StringIO import StringIO
+
+from cloudtask._hub import Launcher, FakeHub
+
+class Hub(FakeHub):
+    """FakeHub that records its launch calls, and fails to launch more
+    than <fails_after> workers in a call"""
+
+    def __init__(self, fails_after=None):
+        FakeHub.__init__(self, api_latency=0.001, poll_interval=0.01,
+                         boot_time=(0.01, 0.05), seed=0)
+        self.fails_after = fails_after
+        self.calls = []
+
+        self.running_calls = 0
+        self.max_running_calls = 0
+
+    def launch(self, howmany, logfh=None, callback=None, **kwargs):
+        with self.lock:
+            self.calls.append(howmany)
+            self.running_calls += 1
+            self.max_running_calls = max(self.max_running_calls, self.running_calls)
+
+        try:
+            for i, instance in enumerate(FakeHub.launch(self, howmany, logfh, callback, **kwargs)):
+                if self.fails_after is not None and i == self.fails_after:
+                    raise self.Error("launch failed")
+                yield instance
+        finally:
+            with self.lock:
+                self.running_calls -= 1
+
+def fleet(queue, howmany):
+    return [ queue.get(timeout=10) for i in range(howmany) ]
+
+def test_coalesce():
+    hub = Hub()
+    queue = Queue()
+    launcher = Launcher(hub, queue, batch=10, concurrency=8)
+
+    # requests within COALESCE seconds of each other
+    for i in range(3):
+        launcher.launch(5)
+
+    instances = fleet(queue, 15)
+    assert None not in instances and len(set(instances)) == 15
+    assert sorted(hub.calls) == [ 5, 10 ]
+    assert queue.empty()
+
+def test_spread():
+    hub = Hub()
+    queue = Queue()
+    logfh = StringIO()
+    launcher = Launcher(hub, queue, logfh, batch=10, concurrency=4)
+
+    launcher.launch(100)
+    instances = fleet(queue, 100)
+    assert None not in instances and len(set(instances)) == 100
+
+    assert hub.calls == [ 25, 25, 25, 25 ]
+    assert hub.max_running_calls == 4
+
+    assert 0 < launcher.time_first <= launcher.time_full
+    assert (launcher.requested, launcher.launched, launcher.failed) == (100, 100, 0)
+
+    log = logfh.getvalue()
+    assert "launched first worker in" in log
+    assert "launched 100/100 workers in" in log
+
+    # a request after the fleet was launched starts a new fleet
+    launcher.launch(3)
+    assert None not in fleet(queue, 3)
+    assert (launcher.requested, launcher.launched) == (3, 3)
+
+def test_failed():
+    hub = Hub(fails_after=3)
+    queue = Queue()
+    logfh = StringIO()
+    launcher = Launcher(hub, queue, logfh, batch=10, concurrency=2)
+
+    launcher.launch(20)
+    instances = fleet(queue, 20)
+
+    assert hub.calls == [ 10, 10 ]
+    assert len([ instance for instance in instances if instance ]) == 6
+    assert instances.count(None) == 14
+    assert (launcher.launched, launcher.failed) == (6, 14)
+    assert "launch failed" in logfh.getvalue()
+    assert "launched 6/20 workers in" in logfh.getvalue()
+
+def test_stopped():
+    hub = Hub()
+    queue = Queue()
+
+    stopped = threading.Event()
+    launcher = Launcher(hub, queue, callback=lambda: not stopped.is_set())
+
+    stopped.set()
+    launcher.launch(5)
+
+    assert fleet(queue, 5) == [ None ] * 5
+    assert hub.calls == []
+
+def main():
+    coalesce = Launcher.COALESCE
+    Launcher.COALESCE = 0.1
+    try:
+        test_coalesce()
+        test_spread()
+        test_failed()
+        test_stopped()
+    finally:
+        Launcher.COALESCE = coalesce
+
+    print "ok"
+
+if __name__ == "__main__":
+    main()
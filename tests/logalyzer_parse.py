@@ -0,0 +1,218 @@
+#!/usr/bin/python
+"""Check the streaming worker log parser (WorkersLog.parse_worker_log).
+
+Entries keep only the last TAIL_LINES lines of their bodies and the
+offsets of the rest, status lines are found wherever the blocks the log
+is read in are split, lines that aren't status lines (including lines
+too long to be one) stay in the body, a partially written last line
+isn't an entry yet, and parsing can resume from an entry's offset.
+
+Usage: logalyzer_parse.py [ --bench [ megabytes ] [ output-lines-per-job ] ]
+
+With --bench, we also generate a synthetic worker log of the given size
+(default: 2048MB), with jobs that output output-lines-per-job lines each
+(default: 100000), and compare how long the streaming parser and the old
+parser take to extract its jobs, and their peak memory. Each parser runs
+in a process of its own, so the peak memory is its own.
+"""
+import os
+import sys
+import re
+import hashlib
+import time
+import shutil
+import tempfile
+import resource
+from os.path import join
+
+from cloudtask.logalyzer import WorkersLog
+
+def status(minute, msg):
+    return "# 2012-01-01 00:%02d:00 [10.0.0.1] %s\n" % (minute, msg)
+
+OUTPUT = "".join([ "line %d\n" % i for i in range(1000) ])
+
+LOG = status(0, "launched worker i-1") + \
+      status(1, "build foo") + \
+      OUTPUT + \
+      "\n" + status(3, "exit 0 # build foo") + \
+      status(3, "build bar") + \
+      "# not a status line\n" + \
+      "x" * (WorkersLog.MAXLINE + 10) + "\n" + \
+      "tail\n" + \
+      "\n" + status(5, "exit 1 # build bar") + \
+      status(5, "build (a+b)*") + \
+      "\n" + status(6, "timeout # build (a+b)*")
+
+def parse(fpath, offset=0):
+    return [ (entry.offset, entry.title, entry.body, entry.body_start, entry.body_end)
+             for entry in WorkersLog.parse_worker_log(fpath, offset) ]
+
+def test_entries(fpath):
+    entries = list(WorkersLog.parse_worker_log(fpath))
+    assert [ entry.title for entry in entries ] == [
+        "launched worker i-1", "build foo", "exit 0 # build foo", "build bar",
+        "exit 1 # build bar", "build (a+b)*", "timeout # build (a+b)*" ]
+
+    # only the last lines of the body, the offsets are of all of it
+    foo = entries[1]
+    assert foo.body == "\n".join([ "line %d" % i for i in range(995, 1000) ])
+    assert LOG[foo.body_start:foo.body_end].strip() == OUTPUT.strip()
+
+    assert LOG[entries[2].offset:].startswith(status(3, "exit 0 # build foo"))
+
+    # not status lines, so they're part of the body
+    bar = entries[3]
+    assert bar.body.splitlines()[-1] == "tail"
+    assert LOG[bar.body_start:bar.body_end].startswith("# not a status line\nxxx")
+
+    jobs = WorkersLog.get_jobs(entries, "build")
+    assert [ (name, result, elapsed) for name, result, timestamp, elapsed, tail, start, end in jobs ] == \
+           [ ("foo", "exit 0", 120), ("bar", "exit 1", 120), ("(a+b)*", "timeout", 60) ]
+
+def test_blocks(fpath):
+    expected = parse(fpath)
+
+    blocksize = WorkersLog.BLOCKSIZE
+    keep = WorkersLog.KEEP
+    try:
+        for WorkersLog.BLOCKSIZE in (1, 7, 100, 4096):
+            for WorkersLog.KEEP in (0, 10, 64 * 1024):
+                assert parse(fpath) == expected, (WorkersLog.BLOCKSIZE, WorkersLog.KEEP)
+    finally:
+        WorkersLog.BLOCKSIZE = blocksize
+        WorkersLog.KEEP = keep
+
+def test_partial(tmpdir):
+    fpath = join(tmpdir, "partial")
+
+    # the last status line is still being written
+    file(fpath, "w").write(LOG + status(7, "build baz")[:20])
+    entries = parse(fpath)
+    assert entries[-1][1] == "timeout # build (a+b)*"
+
+    file(fpath, "a").write(status(7, "build baz")[20:] + "output of baz")
+    entries = parse(fpath)
+    assert entries[-1][1:3] == ("build baz", "output of baz")
+
+def test_resume(fpath):
+    entries = list(WorkersLog.parse_worker_log(fpath))
+
+    for i, entry in enumerate(entries):
+        assert parse(fpath, entry.offset) == parse(fpath)[i:]
+
+def usage():
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def old_parse_worker_log(fpath):
+    entries = []
+    body = ""
+    for line in file(fpath).readlines():
+        m = re.match(r'^# (\d{4}-\d+-\d+ \d\d:\d\d:\d\d) \[.*?\] (.*)', line)
+        if not m:
+            body += line
+            continue
+        else:
+            body = body.strip()
+            if entries and body:
+                entries[-1].body = body
+            body = ""
+            timestamp, title = m.groups()
+            entries.append(WorkersLog.LogEntry(timestamp, title))
+
+    return entries
+
+def generate(fpath, size, lines_per_job):
+    fh = file(fpath, "w")
+    line = "x" * 79 + "\n"
+
+    i = 0
+    while fh.tell() < size:
+        fh.write("# 2012-01-01 00:00:00 [127.0.0.1] echo %d\n" % i)
+        for j in range(lines_per_job):
+            fh.write(line)
+        fh.write("\n# 2012-01-01 00:01:00 [127.0.0.1] exit 0 # echo %d\n" % i)
+        i += 1
+
+    fh.close()
+    return i
+
+def bench(parse, fpath):
+    """Parses fpath in a child process. Returns (seconds, peak memory in
+    MB, digest of the job tails)"""
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+
+        started = time.time()
+        jobs = WorkersLog.get_jobs(list(parse(fpath)), 'echo')
+        elapsed = time.time() - started
+
+        tails = [ "\n".join(job[4].splitlines()[-WorkersLog.TAIL_LINES:]) for job in jobs ]
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        os.write(w, "%f %d %s" % (elapsed, maxrss, hashlib.md5("\n".join(tails)).hexdigest()))
+        os._exit(0)
+
+    os.close(w)
+    output = os.read(r, 1024)
+    os.close(r)
+
+    os.waitpid(pid, 0)
+    if not output:
+        raise Exception("parsing in child process failed")
+
+    elapsed, maxrss, digest = output.split()
+    return float(elapsed), int(maxrss), digest
+
+def benchmark(size, lines_per_job):
+    fd, fpath = tempfile.mkstemp(prefix='worker_log_')
+    os.close(fd)
+
+    try:
+        howmany = generate(fpath, size, lines_per_job)
+        print "%d jobs in %dMB worker log" % (howmany, os.stat(fpath).st_size / (1024 * 1024))
+
+        elapsed, maxrss, digest = bench(WorkersLog.parse_worker_log, fpath)
+        print "streaming parser: %.2f seconds (peak memory %dMB)" % (elapsed, maxrss)
+
+        elapsed, maxrss, old_digest = bench(old_parse_worker_log, fpath)
+        print "old parser:       %.2f seconds (peak memory %dMB)" % (elapsed, maxrss)
+
+        assert digest == old_digest
+    finally:
+        os.remove(fpath)
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] != "--bench" or len(args) > 3:
+        usage()
+
+    try:
+        size = int(args[1]) * 1024 * 1024 if len(args) > 1 else 2048 * 1024 * 1024
+        lines_per_job = int(args[2]) if len(args) > 2 else 100000
+    except ValueError:
+        usage()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fpath = join(tmpdir, "1")
+        file(fpath, "w").write(LOG)
+
+        test_entries(fpath)
+        test_blocks(fpath)
+        test_partial(tmpdir)
+        test_resume(fpath)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+    if args:
+        benchmark(size, lines_per_job)
+
+if __name__ == "__main__":
+    main()
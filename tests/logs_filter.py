@@ -0,0 +1,207 @@
+#!/usr/bin/python
+"""Check filtering pty output for worker logs (Session.Logs.Worker.Filter).
+
+Carriage returns keep only the last version of an overwritten line, even
+when the \\r or \\r\\n lands on a chunk boundary, ssh's "Connection to ...
+closed." message is removed (even after output that didn't end with a
+newline), an incomplete last line is held back until it is completed
+(or is longer than MAXLINE), and a status line comes after the output
+that preceded it.
+
+Usage: logs_filter.py [ --bench [ path/to/recorded-pty-stream ] ]
+
+With --bench, we also compare the old filter and the new filter on a pty
+stream fed to them in chunks of random size, like the reads from a pty.
+A pty stream can be recorded with script(1), e.g.:
+
+    script -q -c 'pip download numpy' stream
+
+Without a recorded stream, we generate one that mixes compiler-like
+output with progress bars.
+"""
+import os
+import sys
+import re
+import time
+import random
+import shutil
+import tempfile
+
+from cloudtask.session import Session
+
+Filter = Session.Logs.Worker.Filter
+
+def filtered(*chunks):
+    filter = Filter()
+    return "".join([ filter(chunk) for chunk in chunks ]) + filter.flush()
+
+def test_overwrite():
+    assert filtered("line\r\n") == "line\n"
+    assert filtered("10%\r50%\r100%\r\n") == "100%\n"
+    assert filtered("a\nprogress 10%\rprogress 20%\r\nb\n") == "a\nprogress 20%\nb\n"
+
+    # overwritten with a shorter line
+    assert filtered("downloading...\rdone\n") == "done\n"
+
+    # pty line endings with more than one \r
+    assert filtered("line\r\r\n") == "line\n"
+
+def test_chunk_boundaries():
+    assert filtered("progress 10%\r", "progress 20%\r\n") == "progress 20%\n"
+    assert filtered("line\r", "\nnext\n") == "line\nnext\n"
+    assert filtered("10%", "\r", "50%", "\r", "\n") == "50%\n"
+
+    stream = "gcc -c foo.c\r\n" + \
+             "".join([ "\r%3d%% [%-10s]" % (i, "=" * (i / 10)) for i in range(0, 101, 10) ]) + \
+             "\r\nwarning: foo\r\n" + \
+             "Connection to 10.0.0.1 closed.\r\n"
+    expected = "gcc -c foo.c\n100% [==========]\nwarning: foo\n"
+
+    assert filtered(stream) == expected
+
+    # every split of the stream into two and three chunks
+    for i in range(len(stream) + 1):
+        assert filtered(stream[:i], stream[i:]) == expected, i
+
+        for j in range(i, len(stream) + 1, 7):
+            assert filtered(stream[:i], stream[i:j], stream[j:]) == expected, (i, j)
+
+    # byte at a time
+    assert filtered(*list(stream)) == expected
+
+def test_connection_closed():
+    assert filtered("output\nConnection to 10.0.0.1 closed.\r\n") == "output\n"
+    assert filtered("Connection to host.example.com closed.\n") == ""
+
+    # output that didn't end with a newline
+    assert filtered("prompt> Connection to 10.0.0.1 closed.\r\n") == "prompt> "
+    assert filtered("50%\r100%Connection to 10.0.0.1 closed.\r\n") == "100%"
+    assert filtered("1\r22\r333Connection to 10.0.0.1 closed.\r\n") == "333"
+    assert filtered("downloading\rConnection to 10.0.0.1 closed.\r\n") == "downloading"
+    assert filtered("prompt> ", "Connection to 10.0.0.1", " closed.\r", "\n") == "prompt> "
+
+def test_partial_line():
+    filter = Filter()
+
+    # held back, because it may still be overwritten
+    assert filter("downloading 10%") == ""
+    assert filter("\rdownloading 90%") == ""
+    assert filter.flush() == "downloading 90%"
+    assert filter.flush() == ""
+
+    assert filter("done\nprompt> ") == "done\n"
+    assert filter.flush() == "prompt> "
+
+def test_maxline():
+    filter = Filter()
+
+    # incomplete lines longer than MAXLINE aren't held back
+    line = "x" * (Filter.MAXLINE + 1)
+    assert filter(line) == line
+    assert filter("y\n") == "y\n"
+
+    assert filter("x" * Filter.MAXLINE) == ""
+    assert filter.flush() == "x" * Filter.MAXLINE
+
+def test_status_order(tmpdir):
+    logs = Session.Logs.Worker(tmpdir, False, 1)
+
+    logs.write("compiling 10%")
+    logs.write("\rcompiling 100%")
+    logs.write_status("\n# 2012-01-01 00:00:00 [10.0.0.1] exit 0 # build foo\n")
+    logs.flush()
+
+    log = file(os.path.join(tmpdir, "1")).read()
+    assert log == "compiling 100%\n# 2012-01-01 00:00:00 [10.0.0.1] exit 0 # build foo\n"
+    assert log[logs.status_offset:].startswith("\n# ")
+
+def usage():
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def old_filter(buf):
+    buf = re.sub(r'Connection to \S+ closed\.\r+\n', '', buf)
+    buf = re.sub(r'\r[^\r\n]+$', '', buf)
+    buf = re.sub(r'.*\r(?![\r\n])','', buf)
+    buf = re.sub(r'\r+\n', '\n', buf)
+
+    return buf
+
+def generate(size):
+    random.seed(0)
+
+    chunks = []
+    total = 0
+    while total < size:
+        if random.random() < 0.9:
+            chunk = "gcc -O2 -c -o build/obj%d.o src/file%d.c\r\n" % (total, total)
+        else:
+            chunk = "".join([ "\r%3d%% [%-50s]" % (i, "=" * (i / 2)) for i in range(0, 101, 5) ]) + "\r\n"
+
+        chunks.append(chunk)
+        total += len(chunk)
+
+    chunks.append("Connection to 10.0.0.1 closed.\r\n")
+    return "".join(chunks)
+
+def split(stream, maxsize):
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        size = random.randint(1, maxsize)
+        chunks.append(stream[pos:pos + size])
+        pos += size
+
+    return chunks
+
+def bench(func, chunks):
+    started = time.time()
+    output = "".join([ func(chunk) for chunk in chunks ])
+    return time.time() - started, output
+
+def benchmark(stream):
+    chunks = split(stream, 4096)
+    print "%d bytes in %d chunks" % (len(stream), len(chunks))
+
+    elapsed, old_output = bench(old_filter, chunks)
+    print "old filter: %.2f seconds (%d bytes)" % (elapsed, len(old_output))
+
+    filter = Filter()
+    elapsed, output = bench(filter, chunks)
+    output += filter.flush()
+    print "new filter: %.2f seconds (%d bytes)" % (elapsed, len(output))
+
+    # the new filter's output doesn't depend on where chunks are split
+    sample = stream[:1024 * 1024]
+    for maxsize in (1, 7, 4096):
+        assert filtered(*split(sample, maxsize)) == filtered(sample)
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] != "--bench" or len(args) > 2:
+        usage()
+
+    test_overwrite()
+    test_chunk_boundaries()
+    test_connection_closed()
+    test_partial_line()
+    test_maxline()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        test_status_order(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+    if args:
+        if len(args) > 1:
+            stream = file(args[1]).read()
+        else:
+            stream = generate(20 * 1024 * 1024)
+
+        benchmark(stream)
+
+if __name__ == "__main__":
+    main()
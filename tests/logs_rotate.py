@@ -0,0 +1,281 @@
+#!/usr/bin/python
+"""Check rotated and compressed worker logs read as a single log.
+
+We write a worker log that is rotated into gzip'ed segments every few
+KB, and check that Session.Logs.WorkerReader reads it back as it was
+written: across segment boundaries, seeking backwards into a compressed
+segment, at the offsets the writer reported, and while a segment is
+still being compressed. WorkersLog parses jobs whose output spans a
+rotation like jobs in a plain log.
+
+Usage: logs_rotate.py [ --bench [ megabytes-per-worker | path/to/workers ] ]
+
+With --bench, we also write a session's worker logs twice: once as plain
+logs and once rotated every 4MB with the default compression level, and
+compare the disk space they take and how fast they parse. The logs are
+copied from the worker logs of a real session if a path is given.
+Otherwise we generate compiler-like job output between status lines (by
+default, 32MB per worker).
+"""
+import os
+import re
+import sys
+import gzip
+import time
+import random
+import shutil
+import tempfile
+import threading
+from os.path import join, isdir
+
+from cloudtask.session import Session
+from cloudtask.logalyzer import WorkersLog
+
+COMMAND = "build"
+ROTATE = 4096
+
+def wait_compressed():
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+
+def generate(dpath, rotate, compress, jobs=20):
+    """Writes a worker log. Returns (contents, offsets) where offsets are
+    (offset, status line) as reported by the writer"""
+
+    logs = Session.Logs.Worker(dpath, False, 1, 0, 1, rotate, compress)
+
+    written = []
+    offsets = []
+    for job in range(jobs):
+        for msg, seconds in (("%s job%d" % (COMMAND, job), 0), (None, job)):
+            if msg is None:
+                msg = "exit %d # %s job%d" % (job % 3 == 0, COMMAND, job)
+
+            status = "# 2012-01-01 00:%02d:%02d [10.0.0.1] %s\n" % (job, seconds, msg)
+            logs.write_status(status)
+            offsets.append((logs.status_offset, status))
+            written.append(status)
+
+            if msg.startswith(COMMAND):
+                for i in range(job * 10):
+                    line = "gcc -c -o obj%d.o src/job%d/file%d.c\n" % (i, job, i)
+                    logs.write(line)
+                    written.append(line)
+
+    logs.flush()
+    wait_compressed()
+
+    return "".join(written), offsets
+
+def test_reader(dpath):
+    contents, offsets = generate(dpath, ROTATE, 6)
+
+    segments = Session.Logs.worker_logs(dpath)[1]
+    assert len(segments) > 5
+    assert all([ segment.endswith(".gz") for segment in segments ])
+
+    reader = Session.Logs.WorkerReader(join(dpath, "1"))
+    ino, size, mtime, nsegments = reader.stat()
+    assert (size, nsegments) == (len(contents), len(segments))
+
+    assert reader.read() == contents
+
+    # reads across segment boundaries, compressed and the log being written
+    for part in reader.parts[:-1]:
+        end = part.start + part.size
+        for start, size in ((end - 10, 20), (end - 1, 1), (end, 10), (part.start, part.size + 100)):
+            reader.seek(start)
+            assert reader.read(size) == contents[start:start + size], (start, size)
+
+    # backwards, which decompresses the segment
+    for start in range(len(contents) - 100, 0, -997):
+        reader.seek(start)
+        assert reader.read(100) == contents[start:start + 100], start
+
+    # status lines are where the writer said they are
+    for offset, status in offsets:
+        reader.seek(offset)
+        assert reader.read(len(status)) == status
+
+    reader.close()
+
+    # rotation picks up after the last segment when the log is reopened
+    logs = Session.Logs.Worker(dpath, False, 1, 0, 1, ROTATE, 6)
+    assert logs.offset == len(contents)
+    logs.write("x" * ROTATE + "\n")
+    logs.flush()
+    wait_compressed()
+
+    assert len(Session.Logs.worker_logs(dpath)[1]) == len(segments) + 1
+
+def test_compressing(dpath):
+    contents, offsets = generate(dpath, ROTATE, 0)
+    segments = Session.Logs.worker_logs(dpath)[1]
+
+    # a segment that is still being compressed is read uncompressed
+    segment = segments[1]
+    partial = gzip.GzipFile(segment + ".gz", "wb")
+    partial.write(file(segment).read()[:100])
+    partial.close()
+
+    assert Session.Logs.worker_logs(dpath)[1] == segments
+    assert Session.Logs.WorkerReader(join(dpath, "1")).read() == contents
+
+    # compressed, the segment replaces the uncompressed one
+    Session.Logs.Worker.compress_segment(segment, 6)
+    assert Session.Logs.worker_logs(dpath)[1][1] == segment + ".gz"
+    assert Session.Logs.WorkerReader(join(dpath, "1")).read() == contents
+
+def jobs(dpath):
+    return sorted([ (job.name, job.result, job.elapsed, job.output_tail, job.output)
+                    for job in WorkersLog(dpath, COMMAND).jobs ])
+
+def test_parse(tmpdir):
+    plain = join(tmpdir, "plain")
+    rotated = join(tmpdir, "rotated")
+    os.mkdir(plain)
+    os.mkdir(rotated)
+
+    generate(plain, 0, 0)
+    generate(rotated, ROTATE, 6)
+
+    assert len(Session.Logs.worker_logs(plain)[1]) == 0
+    assert jobs(plain) == jobs(rotated)
+
+def usage():
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def synthetic(size, workers=4):
+    """Returns a function that writes a generated worker log of <size>
+    bytes for each of <workers> workers"""
+
+    def write(logs):
+        random.seed(logs.id)
+
+        total = 0
+        job = 0
+        while total < size:
+            job += 1
+            status = "# 2012-01-01 %02d:%02d:%02d [10.0.0.1] %s job%d\n" % \
+                     (job / 3600 % 24, job / 60 % 60, job % 60, COMMAND, job)
+            logs.write_status(status)
+
+            for i in range(random.randint(10, 2000)):
+                line = "gcc -O2 -Wall -c -o build/obj%d.o src/module%d/file%d.c\n" % (i, job, i)
+                logs.write(line)
+                total += len(line)
+
+            result = "# 2012-01-01 %02d:%02d:%02d [10.0.0.1] exit %d # %s job%d\n" % \
+                     (job / 3600 % 24, job / 60 % 60, job % 60, job % 7 == 0, COMMAND, job)
+            logs.write_status(result)
+
+    return range(1, workers + 1), write
+
+def replayed(workers_path):
+    """Returns a function that writes a copy of the worker logs in
+    workers_path, a session's workers directory"""
+
+    status = re.compile(r'^# \d{4}-\d+-\d+ \d\d:\d\d:\d\d \[')
+
+    def write(logs):
+        reader = Session.Logs.WorkerReader(join(workers_path, str(logs.id)))
+
+        partial = ""
+        while True:
+            buf = reader.read(1024 * 1024)
+            if not buf:
+                break
+
+            lines = (partial + buf).splitlines(True)
+            partial = lines.pop() if not lines[-1].endswith("\n") else ""
+            for line in lines:
+                if status.match(line):
+                    logs.write_status(line)
+                else:
+                    logs.write(line)
+
+        logs.write(partial)
+        reader.close()
+
+    worker_ids = [ int(fname) for fname in os.listdir(workers_path) if fname.isdigit() ]
+    return sorted(worker_ids), write
+
+def du(dpath):
+    return sum([ os.path.getsize(join(dpath, fname))
+                 for fname in os.listdir(dpath) ])
+
+def benchmark(tmpdir, worker_ids, write, command):
+    results = {}
+    sizes = {}
+    for name, rotate, compress in (('plain', 0, 0),
+                                   ('rotated', 4 * 1024 * 1024, 6)):
+        dpath = join(tmpdir, name)
+        os.mkdir(dpath)
+
+        for worker_id in worker_ids:
+            logs = Session.Logs.Worker(dpath, False, worker_id, 65536, 1, rotate, compress)
+            write(logs)
+            logs.flush()
+
+        wait_compressed()
+
+        started = time.time()
+        jobs = WorkersLog(dpath, command).jobs
+        elapsed = time.time() - started
+
+        results[name] = sorted([ (job.worker_id, job.name, job.result, job.output_tail)
+                                 for job in jobs ])
+        sizes[name] = du(dpath)
+
+        print "%s: %d files, %.1f MB on disk, %d jobs parsed in %.2f seconds (%.1f MB/s)" % \
+              (name, len(os.listdir(dpath)), sizes[name] / 1048576.0, len(jobs), elapsed,
+               sizes['plain'] / 1048576.0 / elapsed)
+
+    print "compressed to %.1f%% of the plain logs" % (sizes['rotated'] * 100.0 / sizes['plain'])
+    assert results['plain'] == results['rotated']
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] != "--bench" or len(args) > 2:
+        usage()
+
+    command = COMMAND
+    if len(args) > 1 and isdir(args[1]):
+        worker_ids, write = replayed(args[1])
+        conf = join(args[1], os.pardir, "conf")
+        if os.path.exists(conf):
+            command = eval(file(conf).read())['command']
+    else:
+        try:
+            size = int(args[1]) if len(args) > 1 else 32
+        except ValueError:
+            usage()
+
+        worker_ids, write = synthetic(size * 1024 * 1024)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ("reader", "compressing"):
+            os.mkdir(join(tmpdir, name))
+
+        test_reader(join(tmpdir, "reader"))
+        test_compressing(join(tmpdir, "compressing"))
+        test_parse(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+    if not args:
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        benchmark(tmpdir, worker_ids, write, command)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
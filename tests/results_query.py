@@ -0,0 +1,159 @@
+#!/usr/bin/python
+"""Check the columnar results store (Results) and its queries.
+
+Only finished sessions are exported, and only once, as they finish
+(update). Names are stored once. An interrupted export is ignored and
+truncated by the next one. The queries find the jobs that got slower,
+the flaky jobs and the history of a job, of the sessions selected.
+"""
+import os
+import time
+import shutil
+import tempfile
+from datetime import datetime
+from os.path import join
+
+from cloudtask.session import Session
+from cloudtask.results import Results
+
+# 2012-01-01 00:00:00 local time
+EPOCH = time.mktime((2012, 1, 1, 0, 0, 0, 0, 1, -1))
+
+class Job:
+    def __init__(self, name, result, elapsed, worker_id=1, started=0):
+        self.worker_id = worker_id
+        self.name = name
+        self.result = result
+        self.timestamp = datetime.fromtimestamp(EPOCH + started)
+        self.elapsed = elapsed
+
+def make_session(sessions_path, command, jobs, pending=()):
+    """Creates a session that ran jobs [ (name, result, elapsed) ] on a
+    worker, and didn't get to the pending jobs. Returns its id."""
+
+    session = Session(sessions_path)
+    print >> file(session.paths.conf, "w"), repr({ 'command': command })
+
+    os.mkdir(session.paths.workers)
+    logs = Session.Logs.Worker(session.paths.workers, False, 1)
+    now = 0
+    for name, result, elapsed in jobs:
+        for offset, msg in ((0, "%s %s" % (command, name)),
+                            (elapsed, "%s # %s %s" % (result, command, name))):
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(EPOCH + now + offset))
+            logs.write_status("# %s [10.0.0.1] %s\n" % (timestamp, msg))
+        now += elapsed
+
+    logs.flush()
+
+    session.jobs.update([ name for name, result, elapsed in jobs ] + list(pending))
+    session.jobs.update(results=[ (name, int(result.split()[1]) if result.startswith("exit") else None)
+                                  for name, result, elapsed in jobs ])
+
+    return session.id
+
+def test_update(sessions_path):
+    results = Results(join(sessions_path, 'results'))
+
+    finished = make_session(sessions_path, "build", [ ("foo", "exit 0", 10), ("bar", "exit 1", 20) ])
+    stopped = make_session(sessions_path, "build", [ ("foo", "exit 0", 10) ], pending=[ "bar" ])
+    timeout = make_session(sessions_path, "test", [ ("foo", "timeout", 30) ])
+
+    assert results.update(sessions_path) == [ finished, timeout ]
+    assert results.update(sessions_path) == []
+    assert not results.export(join(sessions_path, str(finished)))
+
+    table = results.load()
+    assert len(table) == 3
+    assert [ (session.id, table.names[session.command]) for session in table.select() ] == \
+           [ (finished, "build"), (timeout, "test") ]
+
+    rows = [ row[1:] for row in table.rows(table.select(), 'job', 'exitcode', 'elapsed') ]
+    assert [ (table.names[job], exitcode, elapsed) for job, exitcode, elapsed in rows ] == \
+           [ ("foo", 0, 10), ("bar", 1, 20), ("foo", Results.TIMEOUT, 30) ]
+
+    # the stopped session is exported once it finishes
+    session = Session(sessions_path, stopped)
+    session.jobs.update(results=[ ("bar", 0) ])
+    assert results.update(sessions_path) == [ stopped ]
+
+    # job names and commands are stored once
+    assert results.load().names == [ "build", "foo", "bar", "test" ]
+
+def test_interrupted(path):
+    results = Results(path)
+    results._export(1, "build", [ Job("foo", "exit 0", 10), Job("bar", "exit 1", 20) ])
+
+    # an export that was interrupted before it recorded the session
+    for fname in ('names', 'session', 'job', 'worker', 'exitcode', 'elapsed', 'started', 'exported'):
+        file(join(path, fname), "ab").write("garbage")
+
+    table = results.load()
+    assert len(table) == 2 and results.exported() == [ 1 ]
+
+    # the next export truncates the garbage before appending
+    results._export(2, "build", [ Job("baz", "exit 0", 5) ])
+
+    table = results.load()
+    assert results.exported() == [ 1, 2 ]
+    assert [ table.job_name(session.command, job) for session, job in table.rows(table.select(), 'job') ] == \
+           [ "build foo", "build bar", "build baz" ]
+
+    # truncated names file
+    file(join(path, 'names'), "w").write("build\n")
+    try:
+        results.load()
+    except Results.Error:
+        pass
+    else:
+        raise AssertionError("short names file wasn't detected")
+
+def test_queries(path):
+    results = Results(path)
+
+    # foo gets slower in the last 2 sessions, bar fails every other session
+    for id in range(1, 9):
+        foo = 100 if id <= 6 else 150
+        results._export(id, "build", [ Job("foo", "exit 0", foo, worker_id=id, started=id * 1000),
+                                       Job("bar", "exit %d" % (id % 2), 10),
+                                       Job("baz", "exit 0", 10) ])
+
+    results._export(9, "other", [ Job("foo", "exit 1", 1000) ])
+
+    table = results.load()
+    sessions = table.select("build")
+    assert [ session.id for session in sessions ] == range(1, 9)
+    assert [ session.id for session in table.select(last=3) ] == [ 7, 8, 9 ]
+
+    assert table.slower(sessions, 2) == [ ("build foo", 6, 100.0, 2, 150.0) ]
+    assert table.flaky(sessions) == [ ("build bar", 8, 4, 7) ]
+
+    summary = table.summary(sessions)
+    assert [ (session.id, jobs, failed, worktime) for session, started, jobs, failed, worktime in summary ][:2] == \
+           [ (1, 3, 1, 120), (2, 3, 0, 120) ]
+
+    history = table.history(table.select(), "build foo")
+    assert [ (session.id, worker, exitcode, elapsed) for session, worker, exitcode, started, elapsed in history ] == \
+           [ (id, id, 0, 100 if id <= 6 else 150) for id in range(1, 9) ]
+    assert history[0][3] == int(EPOCH) + 1000
+
+    # without the command, the job of every command
+    assert len(table.history(table.select(), "foo")) == 9
+    assert table.history(table.select(), "nosuchjob") == []
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ("sessions", "interrupted", "queries"):
+            os.mkdir(join(tmpdir, name))
+
+        test_update(join(tmpdir, "sessions"))
+        test_interrupted(join(tmpdir, "interrupted"))
+        test_queries(join(tmpdir, "queries"))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+if __name__ == "__main__":
+    main()
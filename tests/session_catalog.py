@@ -0,0 +1,144 @@
+#!/usr/bin/python
+"""Check allocating session ids and the session catalog.
+
+Concurrent processes allocating session ids from the locked counter get
+different ids, without a counter we carry on from the highest session id
+in the sessions path, and catalog records are written to and read from
+their fixed size slots.
+"""
+import os
+import shutil
+import tempfile
+from os.path import join, getsize
+
+from cloudtask.session import Session
+
+def test_concurrent_ids(sessions_path, processes=10, ids=50):
+    children = []
+    for i in range(processes):
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(r)
+            allocated = [ str(Session.new_session_id(sessions_path)) for j in range(ids) ]
+            os.write(w, " ".join(allocated))
+            os._exit(0)
+
+        os.close(w)
+        children.append((pid, r))
+
+    allocated = []
+    for pid, r in children:
+        output = ""
+        while True:
+            buf = os.read(r, 4096)
+            if not buf:
+                break
+            output += buf
+
+        os.close(r)
+        os.waitpid(pid, 0)
+
+        allocated += [ int(id) for id in output.split() ]
+
+    assert sorted(allocated) == range(1, processes * ids + 1)
+    assert int(file(join(sessions_path, 'session-id')).read()) == processes * ids
+
+def test_no_counter(sessions_path):
+    # sessions created by older versions
+    for id in (1, 2, 7):
+        os.mkdir(join(sessions_path, str(id)))
+    os.mkdir(join(sessions_path, "results"))
+
+    assert Session.new_session_id(sessions_path) == 8
+    assert Session.new_session_id(sessions_path) == 9
+
+    # a session directory created behind the counter's back is skipped
+    os.mkdir(join(sessions_path, "10"))
+    assert Session.new_session_id(sessions_path) == 11
+
+def test_records(path):
+    catalog = Session.Catalog(path)
+    size = Session.Catalog.RECORD_SIZE
+
+    assert catalog.get(1) is None
+    assert catalog.records() == []
+
+    record = Session.Catalog.Record(id=3, status='done', started=100, ended=160,
+                                    jobs=10, ok=9, failed=1, command="build\tfoo")
+    catalog.put(record)
+    assert getsize(path) == 3 * size
+
+    # holes of ids without records
+    assert catalog.get(1) is None
+    assert catalog.get(2) is None
+    assert catalog.get(4) is None
+
+    record = catalog.get(3)
+    assert (record.id, record.status, record.started, record.ended) == (3, 'done', 100, 160)
+    assert (record.jobs, record.ok, record.failed, record.pending) == (10, 9, 1, 0)
+    assert record.command == "build foo"
+
+    # commands that don't fit are truncated
+    catalog.put(Session.Catalog.Record(id=1, status='running', command="x" * 1000))
+    assert getsize(path) == 3 * size
+    assert catalog.get(1).command.endswith("...")
+    assert catalog.get(3).command == "build foo"
+
+    # records are rewritten in place
+    record.status = 'failed'
+    catalog.put(record)
+    assert getsize(path) == 3 * size
+    assert catalog.get(3).status == 'failed'
+
+    for id in range(4, 21):
+        catalog.put(Session.Catalog.Record(id=id, status='done', command="cmd%d" % id))
+
+    assert [ record.id for record in catalog.records() ] == [ 1, 3 ] + range(4, 21)
+    assert [ record.id for record in catalog.records(5) ] == range(16, 21)
+
+    # a corrupt record is skipped
+    fh = file(path, "r+b")
+    fh.seek(19 * size)
+    fh.write("garbage")
+    fh.close()
+
+    assert catalog.get(20) is None
+    assert [ record.id for record in catalog.records(5) ] == range(16, 20)
+
+def test_update(sessions_path):
+    session = Session(sessions_path)
+    session.jobs.update([ "job1", "job2", "job3" ])
+
+    record = session.catalog.update(session.id, session.jobs, "build", running=True)
+    assert (record.status, record.pid, record.jobs, record.pending) == ('running', os.getpid(), 3, 3)
+
+    session.jobs.update(results=[ ("job1", 0), ("job2", 1) ])
+    session.update_catalog("build")
+
+    record = session.catalog.get(session.id)
+    assert (record.status, record.jobs, record.ok, record.failed, record.pending) == \
+           ('stopped', 3, 1, 1, 1)
+    assert record.ended >= record.started
+
+    session.jobs.update(results=[ ("job3", 0) ])
+    session.update_catalog("build")
+    assert session.catalog.get(session.id).status == 'failed'
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ("concurrent", "no-counter", "update"):
+            os.mkdir(join(tmpdir, name))
+
+        test_concurrent_ids(join(tmpdir, "concurrent"))
+        test_no_counter(join(tmpdir, "no-counter"))
+        test_records(join(tmpdir, "catalog"))
+        test_update(join(tmpdir, "update"))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+"""Check the session's job journal (Session.Jobs), which resume and retry
+rely on: replaying a journal with a partially written last line,
+repair() truncating it, compact() replacing the journal atomically, and
+the index counts staying consistent with the journal after concurrent
+writers append to it.
+"""
+import os
+import shutil
+import tempfile
+from os.path import join, exists
+
+from cloudtask import session
+from cloudtask.session import Session
+
+def write(path, s):
+    fh = file(path, "w")
+    fh.write(s)
+    fh.close()
+
+def read(path):
+    return file(path).read()
+
+def replay(path):
+    """Returns (order, states) of a fresh replay of the journal"""
+    jobs = Session.Jobs(path)
+    return jobs.commands, dict(jobs.finished), jobs.pending
+
+def test_partial_line(tmpdir):
+    path = join(tmpdir, "partial")
+    write(path, "PENDING\tjob1\nPENDING\tjob2\nEXIT=0\tjob1\nEXIT=1\tjob2\nEXIT=0\tjo")
+
+    jobs = Session.Jobs(path)
+    assert jobs.commands == [ "job1", "job2" ]
+    assert jobs.finished == [ ("job1", "EXIT=0"), ("job2", "EXIT=1") ]
+    assert jobs.counts == { "EXIT=0": 1, "EXIT=1": 1 }
+
+    # a partial line with a command we haven't seen isn't a job
+    write(path, "PENDING\tjob1\nPENDING\tjob")
+    assert Session.Jobs(path).commands == [ "job1" ]
+
+def test_repair(tmpdir):
+    path = join(tmpdir, "repair")
+
+    write(path, "PENDING\tjob1\nEXIT=0\tjob1\nTIMEO")
+    jobs = Session.Jobs(path)
+    jobs.repair()
+    assert read(path) == "PENDING\tjob1\nEXIT=0\tjob1\n"
+
+    # records appended after repair aren't glued to the partial line
+    jobs.record_result("job2", 3)
+    assert replay(path)[1] == { "job1": "EXIT=0", "job2": "EXIT=3" }
+
+    # nothing to repair
+    jobs.repair()
+    assert read(path) == "PENDING\tjob1\nEXIT=0\tjob1\nEXIT=3\tjob2\n"
+
+    # partial line longer than the chunks repair reads backwards in
+    write(path, "PENDING\tjob1\n" + "PENDING\t" + "x" * 10000)
+    Session.Jobs(path).repair()
+    assert read(path) == "PENDING\tjob1\n"
+
+    # no complete line at all
+    write(path, "PENDING\t" + "x" * 10000)
+    Session.Jobs(path).repair()
+    assert read(path) == ""
+
+def test_compact(tmpdir):
+    path = join(tmpdir, "compact")
+
+    jobs = Session.Jobs(path)
+    jobs.update([ "job%d" % i for i in range(10) ])
+    for i in range(10):
+        jobs.record_result("job%d" % i, None)
+        jobs.record_result("job%d" % i, i % 2)
+
+    before = replay(path)
+    assert jobs.fragmented
+
+    # interrupted before the compacted journal replaced the old one
+    journal = read(path)
+
+    def rename(src, dst):
+        raise OSError("interrupted")
+
+    orig_rename = session.os.rename
+    session.os.rename = rename
+    try:
+        try:
+            jobs.compact()
+        except OSError:
+            pass
+        else:
+            raise AssertionError("compact() wasn't interrupted")
+    finally:
+        session.os.rename = orig_rename
+
+    assert read(path) == journal
+    assert replay(path) == before
+
+    jobs.compact()
+    assert replay(path) == before
+    assert len(read(path).splitlines()) == 10
+    assert not jobs.fragmented
+
+    # the index is valid for the compacted journal
+    assert Session.Jobs(path).counts == { "EXIT=0": 5, "EXIT=1": 5 }
+
+    # records appended after compacting go to the new journal
+    jobs.record_result("job1", 0)
+    assert replay(path)[1]["job1"] == "EXIT=0"
+    assert not exists(path + ".tmp")
+
+def test_concurrent_writers(tmpdir, writers=8, records=500):
+    path = join(tmpdir, "concurrent")
+
+    jobs = Session.Jobs(path)
+    jobs.update([ "job%d" % i for i in range(writers * records) ])
+
+    pids = []
+    for i in range(writers):
+        pid = os.fork()
+        if not pid:
+            # each worker process records results of its own jobs
+            worker_jobs = Session.Jobs(path, sync=100)
+            for j in range(i, writers * records, writers):
+                worker_jobs.record_result("job%d" % j, j % 3)
+            worker_jobs.flush()
+            os._exit(0)
+
+        pids.append(pid)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    # records weren't interleaved
+    lines = read(path).splitlines()
+    assert len(lines) == writers * records * 2
+    assert all([ line.split("\t")[0] in ("PENDING", "EXIT=0", "EXIT=1", "EXIT=2")
+                 for line in lines ])
+
+    counts = { "EXIT=0": 0, "EXIT=1": 0, "EXIT=2": 0 }
+    for j in range(writers * records):
+        counts["EXIT=%d" % (j % 3)] += 1
+
+    # the index the parent saved before the workers wrote is stale
+    assert Session.Jobs(path).counts == counts
+
+    jobs.reload()
+    jobs.save()
+
+    index = eval(read(path + ".index"))
+    assert index["size"] == os.path.getsize(path)
+    assert index["counts"] == counts
+    assert Session.Jobs(path).counts == counts
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        test_partial_line(tmpdir)
+        test_repair(tmpdir)
+        test_compact(tmpdir)
+        test_concurrent_writers(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+if __name__ == "__main__":
+    main()
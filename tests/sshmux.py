@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""Check multiplexing SSH commands over a master connection (SSH.Master).
+
+We put a fake ssh first in the PATH, which records its arguments and
+acts as a master connection when asked to. Commands go through the
+master while it is alive, and fall back to a connection of their own if
+the master fails to start or dies. Closing tears the master down,
+including in a forked process that inherited it.
+
+Usage: sshmux.py [ --bench [ address ] [ howmany ] ]
+
+With --bench, we also compare jobs/sec of per-command SSH connections vs
+a multiplexed master against a real sshd (default: localhost) with
+key-based auth configured, or skip that if it isn't reachable.
+"""
+import os
+import sys
+import time
+import socket
+import signal
+import shutil
+import tempfile
+from os.path import join, exists
+
+from cloudtask.ssh import SSH
+
+FAKE_SSH = """#!/bin/sh
+echo "$*" >> "$FAKE_SSH_LOG"
+
+path=
+master=
+for arg in "$@"; do
+    case "$arg" in
+        ControlPath=*) path="${arg#ControlPath=}" ;;
+        ControlMaster=yes) master=yes ;;
+    esac
+done
+
+if [ "$master" ]; then
+    [ "$FAKE_SSH_MASTER" = "fail" ] && exit 255
+    [ "$FAKE_SSH_MASTER" = "hang" ] || touch "$path"
+    exec sleep 60
+fi
+"""
+
+def commands():
+    """Returns the arguments of the ssh commands run since last called"""
+    path = os.environ['FAKE_SSH_LOG']
+    if not exists(path):
+        return []
+
+    lines = file(path).read().splitlines()
+    os.remove(path)
+    return lines
+
+def test_multiplexed():
+    ssh = SSH("10.0.0.1")
+    assert ssh.master.alive
+
+    control_path = ssh.control_path
+    assert exists(control_path)
+
+    commands()
+    for i in range(3):
+        ssh.command("true").close()
+
+    ran = commands()
+    assert len(ran) == 3
+    assert all([ "ControlPath=" + control_path in command for command in ran ])
+    assert "ControlPath=" + control_path in ssh.argv("true")
+
+    process = ssh.master.process
+    tmpdir = ssh.master.tmpdir
+
+    ssh.close()
+    assert ssh.control_path is None
+    assert process.poll() is not None
+    assert not exists(tmpdir)
+    assert [ command for command in commands() if "-O exit" in command ]
+
+    # closing twice is harmless
+    ssh.close()
+
+def test_fallback():
+    os.environ['FAKE_SSH_MASTER'] = "fail"
+    try:
+        ssh = SSH("10.0.0.1")
+    finally:
+        del os.environ['FAKE_SSH_MASTER']
+
+    assert ssh.master is None and ssh.control_path is None
+
+    commands()
+    ssh.command("true").close()
+    assert "ControlPath" not in commands()[0]
+
+    # the master dies during the session
+    ssh = SSH("10.0.0.1")
+    os.kill(ssh.master.process.pid, signal.SIGKILL)
+    ssh.master.process.wait()
+
+    assert ssh.control_path is None
+
+    commands()
+    ssh.command("true").close()
+    assert "ControlPath" not in commands()[0]
+
+    ssh.close()
+
+def test_timeout():
+    os.environ['FAKE_SSH_MASTER'] = "hang"
+    try:
+        started = time.time()
+        try:
+            master = SSH.Master("10.0.0.1", timeout=1)
+        except SSH.Master.Error:
+            pass
+        else:
+            raise AssertionError("master didn't time out")
+    finally:
+        del os.environ['FAKE_SSH_MASTER']
+
+    assert time.time() - started < 5
+
+def test_fork():
+    ssh = SSH("10.0.0.1")
+
+    # a forked process doesn't tear down the master it inherited
+    pid = os.fork()
+    if not pid:
+        ssh.master.__del__()
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert ssh.master.alive and exists(ssh.control_path)
+
+    ssh.close()
+
+def usage():
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def reachable(address, port=22):
+    try:
+        socket.create_connection((address, port), 5).close()
+    except socket.error:
+        return False
+
+    return True
+
+def bench(address, howmany, multiplex):
+    ssh = SSH(address, multiplex=multiplex)
+    started = time.time()
+    for i in range(howmany):
+        ssh.command('true').close()
+    elapsed = time.time() - started
+    ssh.close()
+
+    return elapsed
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] != "--bench" or len(args) > 3:
+        usage()
+
+    address = args[1] if len(args) > 1 else "localhost"
+    try:
+        howmany = int(args[2]) if len(args) > 2 else 100
+    except ValueError:
+        usage()
+
+    path = os.environ['PATH']
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fake_ssh = join(tmpdir, "ssh")
+        file(fake_ssh, "w").write(FAKE_SSH)
+        os.chmod(fake_ssh, 0755)
+
+        os.environ['PATH'] = tmpdir + ":" + os.environ['PATH']
+        os.environ['FAKE_SSH_LOG'] = join(tmpdir, "log")
+
+        test_multiplexed()
+        test_fallback()
+        test_timeout()
+        test_fork()
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+    if not args:
+        return
+
+    if not reachable(address):
+        print "no sshd reachable at %s, skipping benchmark" % address
+        return
+
+    for multiplex in (False, True):
+        elapsed = bench(address, howmany, multiplex)
+        print "multiplex=%-5s %d jobs in %.2f seconds (%.1f jobs/sec, %.1f ms/job)" % \
+              (multiplex, howmany, elapsed, howmany / elapsed, elapsed * 1000 / howmany)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+"""Check claiming, parking and reaping workers in the warm pool.
+
+Claims only return workers with a matching fingerprint that haven't
+expired, concurrent claims never return the same worker, and reaping
+only drops the workers that FakeHub destroyed. The fingerprint includes
+the post command, and a claimed worker runs the pre command again,
+since post ran before it was parked.
+"""
+import os
+import time
+import shutil
+import tempfile
+from os.path import join
+
+from cloudtask import executor
+from cloudtask.executor import CloudWorker
+from cloudtask.taskconf import TaskConf
+from cloudtask.pool import Pool
+from cloudtask._hub import FakeHub
+
+class FailingHub(FakeHub):
+    """FakeHub that fails to destroy some instances"""
+
+    def __init__(self, failing):
+        FakeHub.__init__(self, api_latency=0)
+        self.failing = failing
+
+    def destroy(self, *addresses):
+        return FakeHub.destroy(self, *[ address for address in addresses
+                                        if address not in self.failing ])
+
+class FakeLog:
+    offset = 0
+
+    def __init__(self):
+        self.status = self
+
+    def write(self, buf):
+        pass
+
+class FakeLogs:
+    worker_id = 1
+    events = None
+
+    def __init__(self):
+        self.worker = FakeLog()
+        self.manager = FakeLog()
+
+class FakeSSH:
+    """Records the commands run on workers"""
+
+    Error = executor.SSH.Error
+    commands = []
+
+    class Command:
+        def __init__(self, command):
+            FakeSSH.commands.append(command)
+
+        def close(self, timeout=None):
+            pass
+
+    def __init__(self, address, **kwargs):
+        pass
+
+    def command(self, command, pty=False):
+        return self.Command(command)
+
+    def copy_id(self, key):
+        pass
+
+    def remove_id(self, key):
+        pass
+
+    def close(self):
+        pass
+
+class FakeKey:
+    path = "/dev/null"
+
+def instanceids(workers):
+    return sorted([ worker.instanceid for worker in workers ])
+
+def test_claim(path):
+    pool = Pool(path, "a", 60)
+    other = Pool(path, "b", 60)
+    expired = Pool(path, "a", 1)
+
+    pool.park("10.0.0.1", "i-1")
+    other.park("10.0.0.2", "i-2")
+    expired.park("10.0.0.3", "i-3")
+    pool.park("10.0.0.4", "i-4")
+
+    # not parked if the ttl is 0
+    assert not Pool(path, "a", 0).park("10.0.0.5", "i-5")
+
+    time.sleep(1.1)
+
+    assert pool.claim(1) == [ ("10.0.0.1", "i-1") ]
+    assert pool.claim(10) == [ ("10.0.0.4", "i-4") ]
+    assert pool.claim(10) == []
+
+    # the other fingerprint's worker and the expired worker stay parked
+    assert instanceids(pool.workers()) == [ "i-2", "i-3" ]
+    assert other.claim(10) == [ ("10.0.0.2", "i-2") ]
+
+def test_concurrent_claims(path, processes=10, workers=100):
+    pool = Pool(path, "a", 60)
+    for i in range(workers):
+        pool.park("10.0.%d.%d" % (i / 256, i % 256), "i-%d" % i)
+
+    children = []
+    for i in range(processes):
+        r, w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(r)
+            claimed = []
+            while True:
+                instances = pool.claim(3)
+                if not instances:
+                    break
+                claimed += [ instanceid for ipaddress, instanceid in instances ]
+
+            os.write(w, "\n".join(claimed))
+            os._exit(0)
+
+        os.close(w)
+        children.append((pid, r))
+
+    claimed = []
+    for pid, r in children:
+        output = ""
+        while True:
+            buf = os.read(r, 4096)
+            if not buf:
+                break
+            output += buf
+
+        os.close(r)
+        os.waitpid(pid, 0)
+
+        claimed += output.split()
+
+    assert len(claimed) == len(set(claimed)) == workers
+    assert pool.workers() == []
+
+def test_reap(path):
+    pool = Pool(path, "a", 1)
+    for i in range(1, 5):
+        pool.park("10.0.0.%d" % i, "i-%d" % i)
+
+    Pool(path, "a", 60).park("10.0.0.5", "i-5")
+
+    # nothing expired yet
+    hub = FailingHub(failing=[ "i-2" ])
+    assert pool.reap(hub) == []
+
+    time.sleep(1.1)
+
+    assert sorted(pool.reap(hub)) == [ "i-1", "i-3", "i-4" ]
+    assert instanceids(pool.workers()) == [ "i-2", "i-5" ]
+
+    # the worker we failed to destroy is reaped next time around
+    assert pool.reap(FailingHub(failing=[])) == [ "i-2" ]
+    assert instanceids(pool.workers()) == [ "i-5" ]
+
+def test_fingerprint():
+    taskconf = TaskConf()
+    taskconf.pre = "apt-get install -y build-essential"
+    taskconf.post = "apt-get purge -y build-essential"
+
+    fingerprint = Pool.fingerprint(taskconf)
+    for attr, val in (('pre', None), ('post', None), ('user', 'admin'),
+                      ('overlay', '/tmp/overlay'), ('hub_apikey', 'APIKEY')):
+        other = TaskConf.fromdict(taskconf.dict())
+        other[attr] = val
+        assert Pool.fingerprint(other) != fingerprint, attr
+
+    assert Pool.fingerprint(TaskConf.fromdict(taskconf.dict())) == fingerprint
+
+def test_claimed_setup(path):
+    taskconf = TaskConf()
+    taskconf.hub_apikey = "APIKEY"
+    taskconf.pre = "pre"
+    taskconf.post = "post"
+
+    pool = Pool(path, Pool.fingerprint(taskconf), 60)
+    pool.park("10.0.0.1", "i-1")
+
+    ssh, hub = executor.SSH, executor.Hub
+    executor.SSH = FakeSSH
+    executor.Hub = lambda apikey: FakeHub(api_latency=0)
+    try:
+        for session in range(2):
+            claimed = pool.claim(1)
+            assert claimed == [ ("10.0.0.1", "i-1") ]
+
+            del FakeSSH.commands[:]
+            worker = CloudWorker(FakeLogs(), taskconf, FakeKey(), signals=False,
+                                 pool=pool, claimed=claimed[0])
+
+            # post ran before the worker was parked, so pre runs again
+            assert FakeSSH.commands == [ "pre" ]
+
+            worker._cleanup()
+            assert FakeSSH.commands == [ "pre", "post" ]
+            assert instanceids(pool.workers()) == [ "i-1" ]
+    finally:
+        executor.SSH, executor.Hub = ssh, hub
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        test_claim(join(tmpdir, "claim"))
+        test_concurrent_claims(join(tmpdir, "concurrent"))
+        test_reap(join(tmpdir, "reap"))
+        test_fingerprint()
+        test_claimed_setup(join(tmpdir, "setup"))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "ok"
+
+if __name__ == "__main__":
+    main()